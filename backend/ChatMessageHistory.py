@@ -1,17 +1,181 @@
-from langchain.schema import BaseChatMessageHistory, BaseMessage, HumanMessage, AIMessage
-from typing import List
+from langchain.schema import BaseChatMessageHistory, BaseMessage, HumanMessage, AIMessage, SystemMessage
+from typing import List, Optional, Sequence, Union
+from sqlalchemy import select, tuple_, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from models.database import Chat, Message
+import asyncio
 import json
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token plus per-message overhead)."""
+    return len(text) // 4 + 4
+
+def message_text(db_msg: Message) -> str:
+    """Plain text of a stored message."""
+    # Convert the content field from JSON array to string if needed
+    if isinstance(db_msg.content, list):
+        # Extract text content from the JSON structure
+        return next(
+            (item['value'] for item in db_msg.content if item['type'] == 'text'),
+            str(db_msg.content)  # Fallback to string representation
+        )
+    return str(db_msg.content)
+
+def to_langchain_messages(db_messages: Sequence[Message], summary: Optional[str] = None) -> List[BaseMessage]:
+    """Stored messages as chat messages, preceded by the rolling summary if there is one."""
+    messages: List[BaseMessage] = []
+    if summary:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation: {summary}"))
+    for db_msg in db_messages:
+        text_content = message_text(db_msg)
+        if db_msg.is_bot:
+            messages.append(AIMessage(content=text_content))
+        else:
+            messages.append(HumanMessage(content=text_content))
+    return messages
+
+def _window_page_query(chat_id: int, cursor: Optional[tuple], page_size: int):
+    """One newest-first page of a chat's messages, older than cursor=(created_at, id) if given."""
+    query = select(Message).where(Message.chat_id == chat_id)
+    if cursor is not None:
+        query = query.where(tuple_(Message.created_at, Message.id) < cursor)
+    return query.order_by(Message.created_at.desc(), Message.id.desc()).limit(page_size)
+
+def _fill_window(window: List[Message], page: Sequence[Message], remaining: int) -> tuple:
+    """Add messages from a newest-first page while they fit. Returns (remaining, full)."""
+    for db_msg in page:
+        tokens = estimate_tokens(message_text(db_msg))
+        # Always keep the newest message, even if it alone exceeds the budget
+        if window and tokens > remaining:
+            return remaining, True
+        window.append(db_msg)
+        remaining -= tokens
+    return remaining, False
+
+def _unsummarized_query(chat_id: int, window_start: Message, summarized: Optional[Message]):
+    query = select(Message).where(
+        Message.chat_id == chat_id,
+        tuple_(Message.created_at, Message.id) < (window_start.created_at, window_start.id)
+    )
+    if summarized is not None:
+        query = query.where(tuple_(Message.created_at, Message.id) > (summarized.created_at, summarized.id))
+    return query.order_by(Message.created_at.asc(), Message.id.asc())
+
+def clean_bot_message(content: str) -> str:
+    """Clean bot message content and extract response from JSON if present."""
+    try:
+        # Remove code block markers
+        cleaned = content.replace("```json", "").replace("```", "").strip()
+        
+        # Handle control characters and escape sequences
+        cleaned = cleaned.encode('utf-8').decode('unicode_escape')
+        cleaned = ''.join(char for char in cleaned if ord(char) >= 32 or char in '\n\r\t')
+        
+        # Parse JSON with relaxed rules
+        content_data = json.loads(cleaned, strict=False)
+        
+        # Extract response field if present
+        if "response" in content_data:
+            return content_data["response"]
+            
+        return cleaned
+    except json.JSONDecodeError:
+        # If JSON parsing fails, return cleaned content
+        return ''.join(char for char in content if ord(char) >= 32 or char in '\n\r\t')
+
+def _to_db_message(chat_id: int, message: BaseMessage) -> Message:
+    is_bot = isinstance(message, AIMessage)
+    # Clean message content
+    clean_content = clean_bot_message(message.content) if is_bot else message.content
+    return Message(
+        chat_id=chat_id,
+        content=[{"type": "text", "value": clean_content}],
+        is_bot=is_bot
+    )
+
+class _SyncSession:
+    """
+    A Session behind the AsyncSession methods the history uses, so its queries are written
+    once. Nothing here suspends, so a coroutine using it can be run with _run_sync.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def scalar(self, statement):
+        return self.session.scalar(statement)
+
+    async def scalars(self, statement):
+        return self.session.scalars(statement)
+
+    async def execute(self, statement):
+        return self.session.execute(statement)
+
+    async def get(self, entity, ident):
+        return self.session.get(entity, ident)
+
+    async def flush(self):
+        self.session.flush()
+
+    async def commit(self):
+        self.session.commit()
+
+    def add_all(self, instances):
+        self.session.add_all(instances)
+
+def _run_sync(coro):
+    """Drive a coroutine that never suspends to completion and return its result."""
+    try:
+        coro.send(None)
+    except StopIteration as done:
+        return done.value
+    coro.close()
+    raise RuntimeError("History coroutine suspended; only a sync Session can be used synchronously")
+
 class PostgresChatMessageHistory(BaseChatMessageHistory):
-    """Chat message history that stores messages in PostgreSQL."""
-    
-    def __init__(self, chat_id: int, db_session: Session):
+    """
+    Chat message history that stores messages in PostgreSQL, on a Session or an AsyncSession.
+
+    Both interfaces share one implementation. With an AsyncSession the async methods
+    (aget_messages, aadd_messages, aclear, ...) run on the event loop, which is what
+    RunnableWithMessageHistory uses under astream/ainvoke; the sync methods need a Session.
+    With a Session the sync methods run directly and the async ones in a worker thread.
+
+    Ids of bot messages it saves are appended to `saved_reply_ids`, if given, so the caller
+    learns which row holds its reply.
+    """
+
+    def __init__(
+        self,
+        chat_id: int,
+        db_session: Union[Session, AsyncSession],
+        token_budget: Optional[int] = None,
+        page_size: int = 50,
+        saved_reply_ids: Optional[List[int]] = None
+    ):
         self.chat_id = chat_id
         self.db_session = db_session
+        self.is_async = isinstance(db_session, AsyncSession)
+        self._db = db_session if self.is_async else _SyncSession(db_session)
+        # With a budget, only the newest messages that fit are loaded, plus the chat's rolling summary
+        self.token_budget = token_budget or None
+        self.page_size = page_size
+        self.saved_reply_ids = saved_reply_ids
+        self.window_start_id: Optional[int] = None  # Oldest message in the window, if older ones were left out
         self._messages: List[BaseMessage] = None  # Cache for messages
 
+    def _sync(self, coro):
+        if self.is_async:
+            coro.close()
+            raise TypeError("History on an AsyncSession: use the async methods, or pass a Session")
+        return _run_sync(coro)
+
+    async def _async(self, coro):
+        if self.is_async:
+            return await coro
+        return await asyncio.to_thread(_run_sync, coro)
+
     @property
     def messages(self) -> List[BaseMessage]:
         """Return list of messages."""
@@ -21,90 +185,118 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
 
     def get_messages(self) -> List[BaseMessage]:
         """Retrieve the messages from PostgreSQL."""
-        db_messages = (
-            self.db_session.query(Message)
-            .filter(Message.chat_id == self.chat_id)
-            .order_by(Message.created_at.asc())
-            .all()
-        )
-        
-        messages = []
-        for db_msg in db_messages:
-            # Convert the content field from JSON array to string if needed
-            if isinstance(db_msg.content, list):
-                # Extract text content from the JSON structure
-                text_content = next(
-                    (item['value'] for item in db_msg.content if item['type'] == 'text'),
-                    str(db_msg.content)  # Fallback to string representation
-                )
-            else:
-                text_content = str(db_msg.content)
-            
-            # Create appropriate message type
-            if db_msg.is_bot:
-                messages.append(AIMessage(content=text_content))
-            else:
-                messages.append(HumanMessage(content=text_content))
-        
-        self._messages = messages
-        return messages
+        return self._sync(self._load_messages())
 
-    def clean_bot_message(self, content: str) -> str:
-        """Clean bot message content and extract response from JSON if present."""
-        try:
-            # Remove code block markers
-            cleaned = content.replace("```json", "").replace("```", "").strip()
-            
-            # Handle control characters and escape sequences
-            cleaned = cleaned.encode('utf-8').decode('unicode_escape')
-            cleaned = ''.join(char for char in cleaned if ord(char) >= 32 or char in '\n\r\t')
-            
-            # Parse JSON with relaxed rules
-            content_data = json.loads(cleaned, strict=False)
-            
-            # Extract response field if present
-            if "response" in content_data:
-                return content_data["response"]
-                
-            return cleaned
-        except json.JSONDecodeError:
-            # If JSON parsing fails, return cleaned content
-            return ''.join(char for char in content if ord(char) >= 32 or char in '\n\r\t')
+    async def aget_messages(self) -> List[BaseMessage]:
+        return await self._async(self._load_messages())
+
+    def get_windowed_messages(self) -> List[BaseMessage]:
+        return self._sync(self._load_window())
+
+    async def aget_windowed_messages(self) -> List[BaseMessage]:
+        return await self._async(self._load_window())
+
+    def unsummarized_messages(self) -> List[Message]:
+        return self._sync(self._unsummarized())
+
+    async def aunsummarized_messages(self) -> List[Message]:
+        return await self._async(self._unsummarized())
+
+    def save_summary(self, summary: str, through_message_id: int) -> None:
+        self._sync(self._save_summary(summary, through_message_id))
+
+    async def asave_summary(self, summary: str, through_message_id: int) -> None:
+        await self._async(self._save_summary(summary, through_message_id))
 
     def add_message(self, message: BaseMessage) -> None:
         """Add a message to the store."""
-        # Determine if it's a bot message
-        is_bot = isinstance(message, AIMessage)
-        
-        # Clean message content
-        clean_content = self.clean_bot_message(message.content) if is_bot else message.content
-        
-        # Create new message in DB
-        db_message = Message(
-            chat_id=self.chat_id,
-            content=[{"type": "text", "value": clean_content}],
-            is_bot=is_bot
-        )
-        
-        self.db_session.add(db_message)
-        self.db_session.commit()
-        
-        # Update cache with original message
-        if self._messages is not None:
-            self._messages.append(message)
+        self.add_messages([message])
 
-    def add_user_message(self, message: str) -> None:
-        """Convenience method to add a user message."""
-        self.add_message(HumanMessage(content=message))
+    def add_messages(self, messages: Sequence[BaseMessage]) -> List[int]:
+        return self._sync(self._add(messages))
 
-    def add_ai_message(self, message: str) -> None:
-        """Convenience method to add an AI message."""
-        self.add_message(AIMessage(content=message))
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> List[int]:
+        return await self._async(self._add(messages))
 
     def clear(self) -> None:
         """Clear message history."""
-        self.db_session.query(Message).filter(
-            Message.chat_id == self.chat_id
-        ).delete()
-        self.db_session.commit()
+        self._sync(self._clear())
+
+    async def aclear(self) -> None:
+        await self._async(self._clear())
+
+    def clean_bot_message(self, content: str) -> str:
+        """Clean bot message content and extract response from JSON if present."""
+        return clean_bot_message(content)
+
+    async def _load_messages(self) -> List[BaseMessage]:
+        if self.token_budget is not None:
+            return await self._load_window()
+
+        db_messages = (await self._db.scalars(
+            select(Message).where(Message.chat_id == self.chat_id).order_by(Message.created_at.asc(), Message.id.asc())
+        )).all()
+        self._messages = to_langchain_messages(db_messages)
+        return self._messages
+
+    async def _load_window(self) -> List[BaseMessage]:
+        """
+        Newest messages that fit in the token budget, read newest-first a page at a time,
+        preceded by the chat's rolling summary of older turns.
+        """
+        summary = await self._db.scalar(select(Chat.summary).where(Chat.id == self.chat_id))
+        remaining = self.token_budget - (estimate_tokens(summary) if summary else 0)
+
+        window = []
+        cursor = None
+        self.window_start_id = None
+        while True:
+            page = (await self._db.scalars(_window_page_query(self.chat_id, cursor, self.page_size))).all()
+            remaining, full = _fill_window(window, page, remaining)
+            if full:
+                self.window_start_id = window[-1].id
+                break
+            if len(page) < self.page_size:
+                break
+            cursor = (page[-1].created_at, page[-1].id)
+
+        self._messages = to_langchain_messages(list(reversed(window)), summary)
+        return self._messages
+
+    async def _unsummarized(self) -> List[Message]:
+        """Messages older than the current window that the rolling summary does not cover yet."""
+        if self._messages is None:
+            await self._load_messages()
+        if self.window_start_id is None:
+            return []
+
+        summary_message_id = await self._db.scalar(select(Chat.summary_message_id).where(Chat.id == self.chat_id))
+        window_start = await self._db.get(Message, self.window_start_id)
+        summarized = await self._db.get(Message, summary_message_id) if summary_message_id is not None else None
+        return (await self._db.scalars(_unsummarized_query(self.chat_id, window_start, summarized))).all()
+
+    async def _save_summary(self, summary: str, through_message_id: int) -> None:
+        """Store an updated rolling summary covering messages up to through_message_id."""
+        await self._db.execute(
+            update(Chat).where(Chat.id == self.chat_id).values(summary=summary, summary_message_id=through_message_id)
+        )
+        await self._db.commit()
+
+    async def _add(self, messages: Sequence[BaseMessage]) -> List[int]:
+        """Add messages to the store in one commit and return their ids, in order."""
+        db_messages = [_to_db_message(self.chat_id, message) for message in messages]
+        self._db.add_all(db_messages)
+        await self._db.flush()
+        ids = [db_msg.id for db_msg in db_messages]
+        await self._db.commit()
+        # Update cache with original messages
+        if self._messages is not None:
+            self._messages.extend(messages)
+        if self.saved_reply_ids is not None:
+            self.saved_reply_ids.extend(db_msg.id for db_msg in db_messages if db_msg.is_bot)
+        return ids
+
+    async def _clear(self) -> None:
+        await self._db.execute(delete(Message).where(Message.chat_id == self.chat_id))
+        await self._db.commit()
         self._messages = []
@@ -0,0 +1,249 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from metrics import LatencyRecorder
+from models.database import Chat, Subject, Topic, Subtopic
+
+TYPE_RANK = {"subject": 0, "topic": 1, "subtopic": 2}  # Broader tags are suggested first
+_END = "\U0010ffff"  # Sorts after every character that appears in a tag name
+SHORT_PREFIX = 2  # Single-word queries up to this length have their results memoised
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def typo_budget(token: str) -> int:
+    """Edits tolerated in a query word: none for short words, where one edit changes too much."""
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 8 else 2
+
+def _common_prefix_length(a: str, b: str) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+class TagEntry:
+    __slots__ = ("id", "name", "type", "words", "rank")
+
+    def __init__(self, tag_id: int, name: str, tag_type: str, popularity: int = 0):
+        self.id = tag_id
+        self.name = name
+        self.type = tag_type
+        self.words = frozenset(tokenize(name))
+        self.rank = (TYPE_RANK[tag_type], -popularity, len(name), name, tag_id)
+
+def _rank(entry: TagEntry):
+    return entry.rank
+
+class TagIndex:
+    """
+    In-process autocomplete over subject, topic and subtopic names.
+
+    Every word of every name goes into one sorted list, and each word's postings (the tags
+    containing it) are kept in rank order: type, then how many chats use the tag. A query word
+    matches the words it is a prefix of, found with one bisect; merging their postings yields
+    tags best-first, so a lookup stops as soon as it has `limit` of them.
+
+    A query word that is no word's prefix is taken for a typo and matches the words with a
+    prefix within typo_budget edits of it instead. This pass walks the sorted list as an
+    implicit trie: words sharing a prefix share rows of the edit-distance table, and a prefix already too far away skips all
+    words under it with one bisect. As in most fuzzy search engines the first letter must be
+    right, which keeps the walk to one letter's words, and only table cells within max_edits of
+    the diagonal are computed.
+
+    Popularity is read when the index is built; rebuild() refreshes it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int], TagEntry] = {}
+        self._postings: Dict[str, List[TagEntry]] = {}  # word -> tags containing it, best rank first
+        self._words: List[str] = []
+        self._popularity: Dict[str, int] = {}  # lowercased tag name -> chats tagged with it
+        self._short_results: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+        self.built_at: Optional[float] = None
+        self.lookups = LatencyRecorder()
+
+    @property
+    def ready(self) -> bool:
+        return self.built_at is not None
+
+    def build(self, tags: Iterable[Tuple[str, int, str]], popularity: Dict[str, int]):
+        """Replace the whole index with (type, id, name) rows."""
+        popularity = {name.lower(): count for name, count in popularity.items()}
+        entries: Dict[Tuple[str, int], TagEntry] = {}
+        for tag_type, tag_id, name in tags:
+            entries[(tag_type, tag_id)] = TagEntry(tag_id, name, tag_type, popularity.get(name.lower(), 0))
+        postings: Dict[str, List[TagEntry]] = {}
+        for entry in sorted(entries.values(), key=_rank):
+            for word in entry.words:
+                postings.setdefault(word, []).append(entry)
+        words = sorted(postings)
+        with self._lock:
+            self._entries, self._postings, self._words = entries, postings, words
+            self._popularity = popularity
+            self._short_results = {}
+            self.built_at = time.time()
+
+    def rebuild(self, db: Session):
+        """Load every tag and the chat tag counts from the database."""
+        tags = [("subject", tag_id, name) for tag_id, name in db.execute(select(Subject.id, Subject.name))]
+        tags += [("topic", tag_id, name) for tag_id, name in db.execute(select(Topic.id, Topic.name))]
+        tags += [("subtopic", tag_id, name) for tag_id, name in db.execute(select(Subtopic.id, Subtopic.name))]
+        tag = func.unnest(Chat.tags).label("tag")
+        usage = select(tag, func.count()).group_by(tag)
+        self.build(tags, {name: count for name, count in db.execute(usage) if name})
+
+    def add(self, tags: Iterable[Tuple[str, int, str]]):
+        """Index newly inserted (type, id, name) rows; rows already indexed are skipped."""
+        with self._lock:
+            self._short_results.clear()
+            for tag_type, tag_id, name in tags:
+                if (tag_type, tag_id) in self._entries:
+                    continue
+                entry = TagEntry(tag_id, name, tag_type, self._popularity.get(name.lower(), 0))
+                self._entries[(tag_type, tag_id)] = entry
+                for word in entry.words:
+                    postings = self._postings.get(word)
+                    if postings is None:
+                        self._postings[word] = [entry]
+                        bisect.insort(self._words, word)
+                    else:
+                        bisect.insort(postings, entry, key=_rank)
+
+    def _prefix_words(self, token: str) -> List[str]:
+        start = bisect.bisect_left(self._words, token)
+        return self._words[start:bisect.bisect_left(self._words, token + _END, start)]
+
+    def _fuzzy_words(self, token: str, max_edits: int) -> Dict[str, int]:
+        """Words starting with token[0] with a prefix within max_edits edits of token, mapped to the fewest edits."""
+        words = self._words
+        i = bisect.bisect_left(words, token[0])
+        stop = bisect.bisect_left(words, token[0] + _END, i)
+        size = len(token)
+        max_depth = size + max_edits  # Deeper prefixes are more than max_edits longer than the token
+        cap = max_edits + 1  # Any distance above max_edits is stored as cap
+        rows = [[min(j, cap) for j in range(size + 1)]]  # rows[d]: edit distances after the first d letters of the path
+        best = [rows[0][-1]]  # best[d]: fewest edits for the whole token at any depth up to d
+        path = ""
+        found: Dict[str, int] = {}
+        while i < stop:
+            word = words[i]
+            depth = min(_common_prefix_length(path, word), len(rows) - 1)
+            del rows[depth + 1:], best[depth + 1:]
+            while depth < min(len(word), max_depth):
+                row, char = rows[depth], word[depth]
+                next_row = [cap] * (size + 1)
+                next_row[0] = row_min = min(depth + 1, cap)
+                # Cells further than max_edits off the diagonal are always above it
+                for j in range(max(1, depth + 1 - max_edits), min(size, depth + 1 + max_edits) + 1):
+                    value = row[j - 1] if token[j - 1] == char else row[j - 1] + 1
+                    if row[j] < value:
+                        value = row[j] + 1
+                    if next_row[j - 1] < value:
+                        value = next_row[j - 1] + 1
+                    if value < cap:
+                        next_row[j] = value
+                        if value < row_min:
+                            row_min = value
+                rows.append(next_row)
+                best.append(min(best[depth], next_row[-1]))
+                depth += 1
+                if row_min > max_edits:
+                    break
+            if depth < len(word):
+                # Going deeper cannot get closer, so every word under this prefix shares its result
+                prefix = word[:depth]
+                end = bisect.bisect_left(words, prefix + _END, i, stop)
+                if best[depth] <= max_edits:
+                    found.update(dict.fromkeys(words[i:end], best[depth]))
+                path, i = prefix, end
+            else:
+                if best[depth] <= max_edits:
+                    found[word] = best[depth]
+                path, i = word, i + 1
+        return found
+
+    def _candidates(self, words: Iterable[str]) -> Iterator[TagEntry]:
+        """Tags containing any of the words, best rank first. Caller holds the lock."""
+        return heapq.merge(*(self._postings[word] for word in words), key=_rank)
+
+    def _collect(self, token_words: List[Dict[str, int]], edits: int, limit: int, results: list, seen: set):
+        """
+        Append tags whose words match every query word with `edits` typos in total. The query
+        word with the fewest candidate tags drives the merge; the others filter.
+        """
+        if any(not words for words in token_words):
+            return
+        driver = min(range(len(token_words)), key=lambda t: sum(len(self._postings[word]) for word in token_words[t]))
+        for entry in self._candidates(token_words[driver]):
+            if len(results) == limit:
+                return
+            if (entry.type, entry.name) in seen:
+                continue
+            total = 0
+            for words in token_words:
+                matched = [words[word] for word in entry.words if word in words]
+                if not matched:
+                    break
+                total += min(matched)
+            else:
+                if total == edits:
+                    # The same name under different parents is one suggestion
+                    seen.add((entry.type, entry.name))
+                    results.append((entry, edits))
+
+    def suggest(self, query: str, limit: int = 10, fuzzy: bool = True) -> List[Dict[str, Any]]:
+        """Up to `limit` tags matching every word of the query, fewest typos first, then by rank."""
+        start = time.perf_counter()
+        tokens = tokenize(query)
+        with self._lock:
+            # One- and two-letter prefixes merge the most postings and are what everyone types first
+            short_key = (tokens[0], limit) if len(tokens) == 1 and len(tokens[0]) <= SHORT_PREFIX else None
+            items = self._short_results.get(short_key)
+            if items is None:
+                token_words = [dict.fromkeys(self._prefix_words(token), 0) for token in tokens]
+                if fuzzy:
+                    # Only a word that is no word's prefix is taken for a typo
+                    for token, words in zip(tokens, token_words):
+                        if not words and typo_budget(token):
+                            words.update(self._fuzzy_words(token, typo_budget(token)))
+                results: List[Tuple[TagEntry, int]] = []
+                seen: set = set()
+                if tokens:
+                    for edits in range(sum(max(words.values(), default=0) for words in token_words) + 1):
+                        self._collect(token_words, edits, limit, results, seen)
+                items = [
+                    {
+                        "id": entry.id,
+                        "name": entry.name,
+                        "type": entry.type,
+                        "popularity": -entry.rank[1],
+                        "typos": edits,
+                    }
+                    for entry, edits in results
+                ]
+                if short_key is not None:
+                    self._short_results[short_key] = items
+        self.lookups.record(time.perf_counter() - start)
+        return items
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "ready": self.ready,
+                "built_at": self.built_at,
+                "tags": len(self._entries),
+                "words": len(self._words),
+            }
+        stats["lookups"] = self.lookups.summary()
+        return stats
+
+tag_index = TagIndex()
@@ -0,0 +1,545 @@
+import os
+os.environ.setdefault("OPENAI_API_KEY", "stub")  # The stub server ignores the key
+
+import argparse
+import math
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from langchain.prompts import PromptTemplate
+from stub_llm_server import StubLLMServer
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    return {
+        "mean_ms": statistics.mean(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+def time_calls(fn: Callable[[], object], iterations: int, warmup: int = 5) -> List[float]:
+    """Run fn repeatedly and return per-call wall-clock durations in seconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def print_row(label: str, stats: Dict[str, float], extra: str = ""):
+    print(f"{label:<28} mean={stats['mean_ms']:8.2f}ms  p50={stats['p50_ms']:8.2f}ms  p99={stats['p99_ms']:8.2f}ms  {extra}")
+
+def bench_llm_registry(iterations: int = 200, latency: float = 0.0):
+    """
+    Compare building a client, prompt and chain per call (the old generator behaviour)
+    against the shared LLMRegistry, both talking to a local stub LLM server.
+    """
+    from generator import LLMRegistry, create_llm
+    from prompts import SUBJECT_CLASSIFICATION_PROMPT
+
+    server = StubLLMServer(latency=latency).start()
+    inputs = {
+        "question": "What is the derivative of x^2?",
+        "subjects_list": "Mathematics, Physics, Chemistry, Biology",
+    }
+    try:
+        def per_call():
+            llm = create_llm(base_url=server.base_url)
+            prompt = PromptTemplate.from_template(SUBJECT_CLASSIFICATION_PROMPT)
+            llm.invoke(prompt.format(**inputs))
+
+        server.reset_stats()
+        fresh = time_calls(per_call, iterations)
+        fresh_connections = server.connections
+
+        registry = LLMRegistry(base_url=server.base_url)
+        chain = registry.chains["subject_classification"]
+        server.reset_stats()
+        pooled = time_calls(lambda: chain.invoke(inputs), iterations)
+        pooled_connections = server.connections
+        registry.close()
+
+        print(f"LLM client overhead ({iterations} calls, stub latency {latency * 1000:.0f}ms)")
+        print_row("client per call", summarize(fresh), f"connections={fresh_connections}")
+        print_row("shared registry", summarize(pooled), f"connections={pooled_connections}")
+    finally:
+        server.stop()
+
+def synthetic_taxonomy(size: int) -> List[str]:
+    """Distinct, realistic-looking subject names."""
+    prefixes = ["Applied", "Theoretical", "Computational", "Introductory", "Advanced", "Molecular",
+                "Quantum", "Statistical", "Classical", "Modern", "Experimental", "Numerical"]
+    fields = ["Algebra", "Calculus", "Mechanics", "Chemistry", "Biology", "Economics", "Geometry",
+              "Optics", "Thermodynamics", "Linguistics", "Astronomy", "Genetics", "Topology",
+              "Probability", "Ecology", "Psychology", "Electronics", "Cryptography"]
+    names = []
+    for i in range(size):
+        prefix = prefixes[i % len(prefixes)]
+        field = fields[(i // len(prefixes)) % len(fields)]
+        round_ = i // (len(prefixes) * len(fields))
+        names.append(f"{prefix} {field}" + (f" {round_ + 1}" if round_ else ""))
+    return names
+
+def bench_prefilter(sizes=(50, 500, 5000), queries: int = 20, latency_per_token: float = 0.00002):
+    """
+    Prompt tokens and classification latency against taxonomy size, with and without
+    the local candidate prefilter. The stub server charges a per-prompt-token delay.
+    """
+    import asyncio
+    import generator
+    from generator import LLMRegistry, aclassify_question_subjects
+    from cache import classification_cache
+    from prefilter import CandidatePrefilter
+    from prompts import SUBJECT_CLASSIFICATION_PROMPT
+
+    server = StubLLMServer(reply='["Quantum Mechanics"]', latency_per_token=latency_per_token).start()
+    previous = (generator._registry, generator.candidate_prefilter, classification_cache.backend)
+    generator._registry = LLMRegistry(base_url=server.base_url)
+    classification_cache.backend = None
+    questions = [f"Why does the tunnelling probability fall with barrier width, case {i}?" for i in range(queries)]
+
+    async def timed_classifications(names: List[str]) -> List[float]:
+        samples = []
+        for question in questions:
+            start = time.perf_counter()
+            await aclassify_question_subjects(question, names)
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    def prompt_tokens(names: List[str]) -> int:
+        return len(SUBJECT_CLASSIFICATION_PROMPT.format(question=questions[0], subjects_list=", ".join(names))) // 4
+
+    loop = asyncio.new_event_loop()  # One loop, so the pooled async client keeps its connections
+    try:
+        print(f"Subject prefilter ({queries} queries per size, stub prefill {latency_per_token * 1e6:.0f}us/token)")
+        for size in sizes:
+            names = synthetic_taxonomy(size)
+            row = {}
+            for label, enabled in (("full list", False), ("prefilter", True)):
+                prefilter = CandidatePrefilter(enabled=enabled)
+                generator.candidate_prefilter = prefilter
+                build_start = time.perf_counter()
+                if enabled:
+                    prefilter.index_for(names)
+                build_ms = (time.perf_counter() - build_start) * 1000
+
+                narrowed, _ = prefilter.narrow(questions[0], names)
+                samples = loop.run_until_complete(timed_classifications(names))
+                row[label] = (prompt_tokens(narrowed), summarize(samples), build_ms)
+
+            for label, (tokens, stats, build_ms) in row.items():
+                print_row(f"{size:>5} subjects, {label}", stats, f"prompt_tokens={tokens}  index_build={build_ms:.1f}ms")
+    finally:
+        loop.run_until_complete(generator._registry.aclose())
+        loop.close()
+        generator._registry, generator.candidate_prefilter, classification_cache.backend = previous
+        server.stop()
+
+def legacy_stream_cleanup(chunks: List[str]) -> List[tuple]:
+    """
+    The buffer/split loop generate_chat_response used before StreamNormalizer.
+    Returns (input chunk index, text) for every write.
+    """
+    from generator import clean_llm_response
+
+    out = []
+    last_chunk_ended_with_space = False
+    buffer = ""
+    for index, text in enumerate(chunks):
+        buffer += text
+        if '\n' in buffer:
+            lines = buffer.split('\n')
+            buffer = lines[-1]
+            for line in lines[:-1]:
+                cleaned = clean_llm_response(line)
+                if cleaned:
+                    out.append((index, cleaned + '\n'))
+                    last_chunk_ended_with_space = False
+        elif buffer.endswith(('.', '!', '?', ':', ';')):
+            cleaned = clean_llm_response(buffer)
+            if cleaned:
+                if not last_chunk_ended_with_space and not cleaned.startswith(' '):
+                    out.append((index, ' '))
+                out.append((index, cleaned + ' '))
+                last_chunk_ended_with_space = True
+            buffer = ""
+    if buffer:
+        cleaned = clean_llm_response(buffer)
+        if cleaned:
+            if not last_chunk_ended_with_space and not cleaned.startswith(' '):
+                out.append((len(chunks) - 1, ' '))
+            out.append((len(chunks) - 1, cleaned))
+    return out
+
+def normalizer_stream_cleanup(chunks: List[str]) -> List[tuple]:
+    from streaming import StreamNormalizer
+
+    normalizer = StreamNormalizer()
+    out = []
+    for index, text in enumerate(chunks):
+        cleaned = normalizer.feed(text)
+        if cleaned:
+            out.append((index, cleaned))
+    out.append((len(chunks) - 1, normalizer.flush()))
+    return out
+
+def max_held_chars(chunks: List[str], writes: List[tuple]) -> int:
+    """Most input characters received between two consecutive writes."""
+    offsets = []
+    total = 0
+    for text in chunks:
+        total += len(text)
+        offsets.append(total)
+    held = 0
+    previous = 0
+    for index, _ in writes:
+        held = max(held, offsets[index] - previous)
+        previous = offsets[index]
+    return held
+
+def bench_stream_normalizer(size: int = 50_000, repeats: int = 3):
+    """Cleanup cost for a streamed response chunked at 1-5 characters, old loop vs StreamNormalizer."""
+    import random
+
+    markdown = (
+        "# Kinematics\n\nThe **velocity** of a particle is $v = \\frac{dx}{dt}$ and   its acceleration is\n"
+        "$$\na = \\frac{d^2 x}{dt^2}\n$$\nIntegrating twice gives the position. "
+    )
+    paragraph = "the quantity $x_i$ grows with each step and   the sum keeps accumulating terms "
+    texts = {
+        "markdown": (markdown * (size // len(markdown) + 1))[:size],
+        "no newlines": (paragraph * (size // len(paragraph) + 1))[:size],
+    }
+
+    rng = random.Random(0)
+    print(f"Stream cleanup ({size // 1000} KB response, chunks of 1-5 chars, best of {repeats})")
+    for label, text in texts.items():
+        chunks = []
+        i = 0
+        while i < len(text):
+            step = rng.randint(1, 5)
+            chunks.append(text[i:i + step])
+            i += step
+        for name, fn in (("legacy loop", legacy_stream_cleanup), ("StreamNormalizer", normalizer_stream_cleanup)):
+            best = min(time_calls(lambda: fn(chunks), 1, warmup=0)[0] for _ in range(repeats))
+            writes = fn(chunks)
+            print(
+                f"{label:<12} {name:<17} total={best * 1000:8.2f}ms  per_chunk={best / len(chunks) * 1e6:6.2f}us  "
+                f"writes={len(writes):5d}  max_held={max_held_chars(chunks, writes)} chars"
+            )
+
+def bench_provider_hedging(calls: int = 200, tail_rate: float = 0.05, tail_latency: float = 1.0, hedge_delay: float = 0.15):
+    """
+    Tail latency of a short classification call against two stub providers that each
+    stall on `tail_rate` of requests, with and without a hedged second request.
+    """
+    import asyncio
+    import generator
+    from generator import LLMRegistry
+
+    os.environ.setdefault("ANTHROPIC_API_KEY", "stub")
+    generator.ANTHROPIC_API_KEY = generator.ANTHROPIC_API_KEY or "stub"
+    openai_stub = StubLLMServer(reply='["Physics"]', latency=0.05, tail_rate=tail_rate, tail_latency=tail_latency, seed=1).start()
+    anthropic_stub = StubLLMServer(reply='["Physics"]', latency=0.06, tail_rate=tail_rate, tail_latency=tail_latency, seed=2).start()
+    inputs = {"question": "What is the derivative of x^2?", "subjects_list": "Mathematics, Physics"}
+
+    async def run(hedge: bool):
+        registry = LLMRegistry(providers={"openai": openai_stub.base_url, "anthropic": anthropic_stub.anthropic_base_url})
+        registry.router.hedge_delay = hedge_delay
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            await registry.ainvoke("subject_classification", inputs, hedge=hedge)
+            samples.append(time.perf_counter() - start)
+        await registry.aclose()
+        return samples, registry.router.hedges
+
+    try:
+        print(f"Provider hedging ({calls} calls, {tail_rate:.0%} of requests stall {tail_latency}s, hedge after {hedge_delay * 1000:.0f}ms)")
+        for label, hedge in (("failover only", False), ("hedged", True)):
+            samples, hedges = asyncio.run(run(hedge))
+            print_row(label, summarize(samples), f"p95={percentile(samples, 95) * 1000:.1f}ms  hedges={hedges}")
+    finally:
+        openai_stub.stop()
+        anthropic_stub.stop()
+
+def database_url() -> str:
+    """Postgres URL from the same POSTGRES_* variables main.py uses."""
+    return "postgresql://{}:{}@{}:{}/{}".format(
+        os.getenv("POSTGRES_USER", "postgres"),
+        os.getenv("POSTGRES_PASSWORD", "postgres"),
+        os.getenv("POSTGRES_HOST", "localhost"),
+        os.getenv("POSTGRES_PORT", "5432"),
+        os.getenv("POSTGRES_DB", "aichat"),
+    )
+
+def bench_history_window(lengths=(10, 100, 1000), iterations: int = 50, token_budget: int = 3000):
+    """
+    Compare loading a chat's full history against the token-budgeted window,
+    in prompt tokens and database time, for chats of increasing length.
+    """
+    from datetime import datetime, timedelta
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from ChatMessageHistory import PostgresChatMessageHistory, estimate_tokens
+    from models.database import Base, User, Chat, Message, upgrade_schema
+
+    engine = create_engine(database_url())
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+    db = sessionmaker(bind=engine)()
+
+    user = User(username=f"bench-history-{time.time_ns()}", email=None, hashed_password="x")
+    db.add(user)
+    db.commit()
+    try:
+        for length in lengths:
+            chat = Chat(user_id=user.id, title="History benchmark", tags=[])
+            db.add(chat)
+            db.flush()
+            start = datetime.utcnow() - timedelta(minutes=length)
+            db.bulk_save_objects([
+                Message(
+                    chat_id=chat.id,
+                    content=[{"type": "text", "value": f"Message {i}: " + "explain the chain rule step by step " * 8}],
+                    is_bot=bool(i % 2),
+                    created_at=start + timedelta(minutes=i)
+                )
+                for i in range(length)
+            ])
+            db.commit()
+
+            for label, budget in (("full", None), ("windowed", token_budget)):
+                history = PostgresChatMessageHistory(chat.id, db, token_budget=budget)
+                samples = time_calls(history.get_messages, iterations, warmup=2)
+                tokens = sum(estimate_tokens(str(message.content)) for message in history.get_messages())
+                print_row(f"history {label} n={length}", summarize(samples), f"prompt_tokens~{tokens}")
+    finally:
+        db.rollback()
+        chat_ids = [chat_id for (chat_id,) in db.query(Chat.id).filter(Chat.user_id == user.id)]
+        db.query(Message).filter(Message.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+        db.query(Chat).filter(Chat.user_id == user.id).delete(synchronize_session=False)
+        db.query(User).filter(User.id == user.id).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+        engine.dispose()
+
+def bench_chats_throughput(concurrency=(1, 16, 64), duration: float = 5.0):
+    """
+    Closed-loop throughput of GET /chats/ at increasing concurrency, served in-process
+    over ASGI against the real database. A DB-free probe request runs alongside; its
+    latency shows how long the event loop is held up by database calls.
+    """
+    import asyncio
+    import httpx
+    from main import app
+
+    async def run(workers: int):
+        transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 9999))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            token = (await client.post("/guest-token")).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            latencies, probes, errors = [], [], []
+            deadline = time.perf_counter() + duration
+
+            async def worker():
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.get("/chats/", headers=headers)
+                        response.raise_for_status()
+                    except Exception as e:
+                        errors.append(type(e).__name__)
+                        continue
+                    latencies.append(time.perf_counter() - start)
+
+            async def probe():
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    await client.get("/metrics/llm-singleflight")
+                    probes.append(time.perf_counter() - start)
+                    await asyncio.sleep(0.01)
+
+            start = time.perf_counter()
+            await asyncio.gather(probe(), *(worker() for _ in range(workers)))
+            return latencies, probes, errors, time.perf_counter() - start
+
+    print(f"GET /chats/ throughput ({duration:.0f}s per level, in-process ASGI)")
+    for workers in concurrency:
+        latencies, probes, errors, elapsed = asyncio.run(run(workers))
+        print_row(
+            f"/chats/ concurrency={workers}", summarize(latencies),
+            f"rps={len(latencies) / elapsed:7.1f}  errors={len(errors)}  probe p99={percentile(probes, 99) * 1000:.1f}ms"
+        )
+
+def bench_tags(sizes=(1_000, 10_000, 100_000), iterations: int = 20, searches=(None, "energy", "zzz")):
+    """
+    GET /tags/ database work at growing taxonomy sizes: loading every matching subject, topic
+    and subtopic and sorting in Python (the old endpoint) against the UNION ALL page and
+    capped count the endpoint now runs.
+    """
+    import random
+    from sqlalchemy import create_engine, delete, insert, select, text
+    from sqlalchemy.orm import sessionmaker
+    from models.database import GenerationJob, Subject, Topic, Subtopic
+    from main import tag_queries
+
+    engine = create_engine(database_url())
+    db = sessionmaker(bind=engine)()
+    words = ["energy", "motion", "cell", "matrix", "proof", "wave", "bond", "graph", "field", "series", "atom", "limit"]
+    rng = random.Random(0)
+
+    def load_all(search):
+        queries = [select(Subject), select(Topic), select(Subtopic)]
+        if search:
+            queries = [query.where(model.name.ilike(f"%{search}%")) for query, model in zip(queries, (Subject, Topic, Subtopic))]
+        tags = []
+        for tag_type, query in zip(("subject", "topic", "subtopic"), queries):
+            tags.extend({"id": row.id, "name": row.name, "type": tag_type} for row in db.scalars(query))
+        tags.sort(key=lambda tag: tag["name"])
+        return len(tags), tags[:10]
+
+    def union(search):
+        page_query, count_query = tag_queries(0, 10, search)
+        page = db.execute(page_query).all()
+        return len(page) if len(page) < 10 else db.scalar(count_query), page
+
+    def remove(subject_id):
+        db.rollback()
+        topic_ids = select(Topic.id).where(Topic.subject_id == subject_id)
+        db.execute(delete(Subtopic).where(Subtopic.topic_id.in_(topic_ids)))
+        db.execute(delete(Topic).where(Topic.subject_id == subject_id))
+        db.execute(delete(GenerationJob).where(GenerationJob.subject_id == subject_id))
+        db.execute(delete(Subject).where(Subject.id == subject_id))
+        db.commit()
+
+    print("GET /tags/ queries (first page of 10; sizes are benchmark rows on top of the existing taxonomy)")
+    try:
+        for size in sizes:
+            subject = Subject(name=f"Bench tags {time.time_ns()}")
+            db.add(subject)
+            db.commit()
+            try:
+                topic_count = max(1, size // 10)
+                topic_ids = db.scalars(insert(Topic).returning(Topic.id), [
+                    {"subject_id": subject.id, "name": f"{rng.choice(words).title()} topic {i}"} for i in range(topic_count)
+                ]).all()
+                db.execute(insert(Subtopic), [
+                    {"topic_id": rng.choice(topic_ids), "name": f"{rng.choice(words).title()} {rng.choice(words)} {i}"}
+                    for i in range(size - topic_count - 1)
+                ])
+                db.commit()
+                db.execute(text("ANALYZE subjects; ANALYZE topics; ANALYZE subtopics"))
+                db.commit()
+
+                for search in searches:
+                    for label, fn in (("load all", load_all), ("union all", union)):
+                        samples = time_calls(lambda: fn(search), iterations, warmup=2)
+                        print_row(f"{label} n={size} search={search!r}", summarize(samples))
+            finally:
+                remove(subject.id)
+    finally:
+        db.close()
+        engine.dispose()
+
+def bench_tag_suggest(sizes=(1_000, 10_000, 100_000), iterations: int = 200):
+    """
+    In-memory tag autocomplete lookups at growing taxonomy sizes, for prefixes as typed
+    keystroke by keystroke and for words with typos (which take the fuzzy pass).
+    """
+    import random
+    from autocomplete import TagIndex
+
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 11))) for _ in range(15_000)]
+    real = ["Classical Mechanics", "Quantum Mechanics", "Thermodynamics", "Linear Algebra", "Organic Chemistry"]
+    queries = {
+        "prefix": ["m", "me", "mec", "mech", "quantum m", "linear alg", "thermo"],
+        "typo": ["mechnics", "qantum mech", "thermodynamcs", "orgnic chem"],
+    }
+
+    print("Tag autocomplete lookups (limit 10)")
+    for size in sizes:
+        tags = [("subject", i, name) for i, name in enumerate(real)]
+        tags += [
+            ("subtopic", i, " ".join(rng.choice(vocabulary) for _ in range(3)).capitalize())
+            for i in range(size - len(real))
+        ]
+        index = TagIndex()
+        start = time.perf_counter()
+        index.build(tags, {"Quantum Mechanics": 5})
+        build = time.perf_counter() - start
+        for label, batch in queries.items():
+            samples = []
+            for query in batch:
+                samples += time_calls(lambda: index.suggest(query), iterations // len(batch), warmup=1)
+            print_row(f"{label} n={size}", summarize(samples), f"build={build * 1000:.0f}ms" if label == "prefix" else "")
+
+def bench_taxonomy_tree(sizes=((20, 10, 10), (100, 20, 15), (500, 20, 20)), iterations: int = 200):
+    """
+    Cost of /taxonomy/ per snapshot version (serialize plus compress, paid once) against a
+    repeat load (a cached body lookup), with body sizes, for subjects x topics x subtopics.
+    """
+    from precompressed import available_encodings
+    from taxonomy import TaxonomySnapshot
+
+    print("Taxonomy tree (first load per version vs repeat load)")
+    for subjects, topics_per, subtopics_per in sizes:
+        subject_rows = [(s, f"Subject {s}") for s in range(subjects)]
+        topic_rows = [
+            (s * topics_per + t, s, f"Topic {s}.{t}", t, 0.5) for s in range(subjects) for t in range(topics_per)
+        ]
+        subtopic_rows = [
+            (topic_id * subtopics_per + u, topic_id, f"Subtopic {topic_id}.{u} with a longer name", 0.25)
+            for topic_id, *_ in topic_rows for u in range(subtopics_per)
+        ]
+        snapshot = TaxonomySnapshot.build(1, subject_rows, topic_rows, subtopic_rows)
+        start = time.perf_counter()
+        body = snapshot.tree_body()
+        serialize = time.perf_counter() - start
+        timings = []
+        for encoding in available_encodings():
+            start = time.perf_counter()
+            body.encode(encoding)
+            timings.append(f"{encoding}={(time.perf_counter() - start) * 1000:.0f}ms")
+        repeat = time_calls(lambda: snapshot.tree_body().cached("gzip"), iterations)
+        sizes_kb = " ".join(f"{coding}={size / 1024:.0f}KB" for coding, size in body.sizes().items())
+        requests = 1 + subjects + len(topic_rows)
+        print_row(
+            f"{subjects}x{topics_per}x{subtopics_per}",
+            summarize(repeat),
+            f"serialize={serialize * 1000:.0f}ms {' '.join(timings)} {sizes_kb} (was {requests} requests)",
+        )
+
+BENCHMARKS = {
+    "llm-registry": bench_llm_registry,
+    "prefilter": bench_prefilter,
+    "stream-normalizer": bench_stream_normalizer,
+    "history-window": bench_history_window,
+    "provider-hedging": bench_provider_hedging,
+    "chats-throughput": bench_chats_throughput,
+    "tags": bench_tags,
+    "tag-suggest": bench_tag_suggest,
+    "taxonomy-tree": bench_taxonomy_tree,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backend micro-benchmarks")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="Benchmarks to run")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        BENCHMARKS[name]()
+        print()
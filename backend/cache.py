@@ -0,0 +1,274 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+from config import (
+    CLASSIFICATION_CACHE_BACKEND,
+    CLASSIFICATION_CACHE_SIZE,
+    CLASSIFICATION_CACHE_TTL,
+    REDIS_URL
+)
+
+class LRUCacheBackend:
+    """Bounded in-process LRU cache with per-entry TTL."""
+
+    def __init__(self, maxsize: int = CLASSIFICATION_CACHE_SIZE, ttl: float = CLASSIFICATION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # In-process, so there is no I/O to wait for
+    async def aget(self, key: str) -> Optional[Any]:
+        return self.get(key)
+
+    async def aget_many(self, keys: List[str]) -> List[Optional[Any]]:
+        return [self.get(key) for key in keys]
+
+    async def aset(self, key: str, value: Any):
+        self.set(key, value)
+
+    async def astats(self) -> Dict[str, Any]:
+        return self.stats()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+class RedisCacheBackend:
+    """
+    Shared cache for multiple workers.
+
+    Clearing is a single INCR of a generation counter, seen by every worker. Each entry is
+    stored with the generation it was written under, and a read fetches the counter and the
+    entry in one MGET, so an entry from before the last clear is a miss and every lookup is
+    one round trip. Capacity is bounded by the Redis maxmemory/LRU policy plus the TTL.
+
+    The a* methods use redis.asyncio, for callers on the event loop; the others use a
+    blocking client, for callers on worker threads.
+    """
+
+    def __init__(self, url: str = REDIS_URL, ttl: float = CLASSIFICATION_CACHE_TTL, prefix: str = "classification"):
+        import redis  # Optional dependency, only needed for the shared backend
+        import redis.asyncio
+
+        self.client = redis.Redis.from_url(url)
+        self.async_client = redis.asyncio.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_key = f"{prefix}:generation"
+        self._generation = 0  # Last generation read; new entries are written under it
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:entry:{key}"
+
+    def _decode(self, generation: Optional[bytes], raw: Optional[bytes]) -> Optional[Any]:
+        self._generation = int(generation or 0)
+        if raw is not None:
+            entry_generation, value = json.loads(raw)
+            if entry_generation == self._generation:
+                self.hits += 1
+                return value
+            self.stale += 1
+        self.misses += 1
+        return None
+
+    def _encode(self, value: Any) -> str:
+        # If another worker cleared since the last read, the entry is written stale and reads as a miss
+        return json.dumps([self._generation, value])
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._decode(*self.client.mget(self.generation_key, self._key(key)))
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return self._decode(*await self.async_client.mget(self.generation_key, self._key(key)))
+
+    async def aget_many(self, keys: List[str]) -> List[Optional[Any]]:
+        if not keys:
+            return []
+        generation, *raws = await self.async_client.mget(self.generation_key, *[self._key(key) for key in keys])
+        return [self._decode(generation, raw) for raw in raws]
+
+    def set(self, key: str, value: Any):
+        self.client.set(self._key(key), self._encode(value), ex=max(1, int(self.ttl)))
+
+    async def aset(self, key: str, value: Any):
+        await self.async_client.set(self._key(key), self._encode(value), ex=max(1, int(self.ttl)))
+
+    def clear(self):
+        self._generation = int(self.client.incr(self.generation_key))
+
+    def _stats(self, generation: Optional[bytes], info: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "backend": "redis",
+            "generation": int(generation or 0),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": int(info.get("evicted_keys", 0)),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return self._stats(self.client.get(self.generation_key), self.client.info("stats"))
+
+    async def astats(self) -> Dict[str, Any]:
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.get(self.generation_key)
+            pipe.info("stats")
+            generation, info = await pipe.execute()
+        return self._stats(generation, info)
+
+def normalize_question(question: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation so trivial variants share a key."""
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+def hash_candidates(candidates: Iterable[str]) -> str:
+    """Order-independent hash of a candidate list."""
+    joined = "\x1f".join(sorted(set(candidates)))
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+class ClassificationCache:
+    """
+    Caches classification results keyed on the normalized question, a hash of the candidates
+    and the taxonomy version.
+
+    invalidate() only reaches this process's memory backend (Redis is shared), so keys also
+    carry the taxonomy version: when a change bumps it in the database, each worker starts
+    keying under the new version as soon as its taxonomy snapshot reloads, and results
+    cached against the old taxonomy are misses there too.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.taxonomy_version = 0
+
+    def observe_taxonomy_version(self, version: int):
+        """Key entries under `version` from now on. Called when a taxonomy snapshot is loaded."""
+        self.taxonomy_version = version
+
+    def make_key(self, kind: str, question: str, candidates: Iterable[str], context: str = "") -> str:
+        question_hash = hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+        return f"{kind}:v{self.taxonomy_version}:{context}:{question_hash}:{hash_candidates(candidates)}"
+
+    def get(self, kind: str, question: str, candidates: Iterable[str], context: str = "") -> Optional[list]:
+        if self.backend is None:
+            return None
+        try:
+            return self.backend.get(self.make_key(kind, question, candidates, context))
+        except Exception as e:
+            print(f"Classification cache read failed: {str(e)}")
+            return None
+
+    def set(self, kind: str, question: str, candidates: Iterable[str], value: list, context: str = ""):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(self.make_key(kind, question, candidates, context), value)
+        except Exception as e:
+            print(f"Classification cache write failed: {str(e)}")
+
+    async def aget(self, kind: str, question: str, candidates: Iterable[str], context: str = "") -> Optional[list]:
+        """get() for callers on the event loop."""
+        if self.backend is None:
+            return None
+        try:
+            return await self.backend.aget(self.make_key(kind, question, candidates, context))
+        except Exception as e:
+            print(f"Classification cache read failed: {str(e)}")
+            return None
+
+    async def aget_many(self, kind: str, questions: List[str], candidates: Iterable[str], context: str = "") -> List[Optional[list]]:
+        """aget() for many questions against the same candidates, in one backend round trip."""
+        if self.backend is None or not questions:
+            return [None] * len(questions)
+        candidates = list(candidates)
+        try:
+            return await self.backend.aget_many([self.make_key(kind, question, candidates, context) for question in questions])
+        except Exception as e:
+            print(f"Classification cache read failed: {str(e)}")
+            return [None] * len(questions)
+
+    async def aset(self, kind: str, question: str, candidates: Iterable[str], value: list, context: str = ""):
+        """set() for callers on the event loop."""
+        if self.backend is None:
+            return
+        try:
+            await self.backend.aset(self.make_key(kind, question, candidates, context), value)
+        except Exception as e:
+            print(f"Classification cache write failed: {str(e)}")
+
+    def invalidate(self):
+        """Drop every cached result. Called whenever the taxonomy changes."""
+        if self.backend is None:
+            return
+        try:
+            self.backend.clear()
+        except Exception as e:
+            print(f"Classification cache invalidation failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        if self.backend is None:
+            return {"backend": "none"}
+        return {**self.backend.stats(), "taxonomy_version": self.taxonomy_version}
+
+    async def astats(self) -> Dict[str, Any]:
+        """stats() for callers on the event loop."""
+        if self.backend is None:
+            return {"backend": "none"}
+        return {**await self.backend.astats(), "taxonomy_version": self.taxonomy_version}
+
+def create_classification_cache(backend: str = CLASSIFICATION_CACHE_BACKEND) -> ClassificationCache:
+    """Build the cache selected by CLASSIFICATION_CACHE_BACKEND."""
+    if backend == "redis":
+        return ClassificationCache(RedisCacheBackend())
+    if backend == "memory":
+        return ClassificationCache(LRUCacheBackend())
+    return ClassificationCache(None)
+
+classification_cache = create_classification_cache()
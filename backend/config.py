@@ -9,3 +9,89 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
 MODEL_NAME = "o1-mini"
 ANTHROPIC_MODEL = "claude-3-5-sonnet-20241022"
 TEMPERATURE = 1
+
+# LLM HTTP client pool (shared by every generator entry point)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # Point at a local stub server for benchmarks
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))  # seconds
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))  # seconds
+
+# Classification result cache
+CLASSIFICATION_CACHE_BACKEND = os.getenv("CLASSIFICATION_CACHE_BACKEND", "memory")  # memory, redis or none
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "10000"))
+CLASSIFICATION_CACHE_TTL = float(os.getenv("CLASSIFICATION_CACHE_TTL", "86400"))  # seconds
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Hierarchical (subject -> topic -> subtopic) classification
+CLASSIFICATION_MAX_CONCURRENCY = int(os.getenv("CLASSIFICATION_MAX_CONCURRENCY", "8"))
+CLASSIFICATION_TIME_BUDGET = float(os.getenv("CLASSIFICATION_TIME_BUDGET", "10"))  # seconds
+
+# Local similarity prefilter for classification candidates
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "true").lower() == "true"
+PREFILTER_TOP_K = int(os.getenv("PREFILTER_TOP_K", "25"))  # Only lists longer than this are narrowed
+PREFILTER_ANSWER_THRESHOLD = float(os.getenv("PREFILTER_ANSWER_THRESHOLD", "0.85"))  # Answer without the LLM above this score
+PREFILTER_ANSWER_MARGIN = float(os.getenv("PREFILTER_ANSWER_MARGIN", "0.2"))  # ...and this far ahead of the runner-up
+
+# Batch classification (many questions per LLM call)
+BATCH_CLASSIFICATION_SIZE = int(os.getenv("BATCH_CLASSIFICATION_SIZE", "25"))  # Questions packed into one prompt
+BATCH_CLASSIFICATION_CONCURRENCY = int(os.getenv("BATCH_CLASSIFICATION_CONCURRENCY", "4"))  # Packed calls in flight
+BATCH_CLASSIFICATION_MAX_RETRIES = int(os.getenv("BATCH_CLASSIFICATION_MAX_RETRIES", "2"))
+
+# Conversation history window
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))  # 0 loads the full history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))  # Messages fetched per query while filling the window
+
+# Coalesce identical concurrent LLM calls into one request
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# LLM backend: "openai" or "fake" (local deterministic model for tests and load tests)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.2"))  # Seconds before the first token
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "100"))  # 0 emits instantly
+FAKE_LLM_CHUNK_SIZES = tuple(int(size) for size in os.getenv("FAKE_LLM_CHUNK_SIZES", "1,4").split(","))  # Min,max tokens per chunk
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))  # Share of calls that fail
+FAKE_LLM_REPLY_TOKENS = int(os.getenv("FAKE_LLM_REPLY_TOKENS", "200"))  # Length of chat replies
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+# LLM dispatch scheduler (priority classes: interactive > classification > title > background)
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))  # 0 = unlimited
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))  # 0 = unlimited
+LLM_CONCURRENCY_INTERACTIVE = int(os.getenv("LLM_CONCURRENCY_INTERACTIVE", "32"))
+LLM_CONCURRENCY_CLASSIFICATION = int(os.getenv("LLM_CONCURRENCY_CLASSIFICATION", "16"))
+LLM_CONCURRENCY_TITLE = int(os.getenv("LLM_CONCURRENCY_TITLE", "8"))
+LLM_CONCURRENCY_BACKGROUND = int(os.getenv("LLM_CONCURRENCY_BACKGROUND", "4"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))  # Seconds a non-background call may wait for a slot
+
+# Multiple LLM providers: failover, hedging and adaptive primary selection
+LLM_PROVIDERS = [provider.strip() for provider in os.getenv("LLM_PROVIDERS", "openai").split(",") if provider.strip()]  # e.g. "openai,anthropic"
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL") or None
+ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "8192"))
+LLM_PROVIDER_MAX_RETRIES = int(os.getenv("LLM_PROVIDER_MAX_RETRIES", "0"))  # SDK retries per provider when failover is available
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "1.0"))  # Seconds before a hedged request goes to the next provider
+LLM_HEDGE_PRIORITIES = [priority.strip() for priority in os.getenv("LLM_HEDGE_PRIORITIES", "classification,title").split(",") if priority.strip()]
+
+# Two-phase textbook generation (chapter list, then each chapter's subtopics)
+TEXTBOOK_CHAPTER_CONCURRENCY = int(os.getenv("TEXTBOOK_CHAPTER_CONCURRENCY", "4"))  # Chapters generated in parallel per subject
+TEXTBOOK_MAX_RETRIES = int(os.getenv("TEXTBOOK_MAX_RETRIES", "2"))  # Extra attempts per chapter (and for the chapter list)
+
+# Subject generation jobs
+GENERATION_JOB_CONCURRENCY = int(os.getenv("GENERATION_JOB_CONCURRENCY", "2"))  # Subjects generated at the same time
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "5"))  # A job fails for good after this many attempts
+GENERATION_JOB_BACKOFF = float(os.getenv("GENERATION_JOB_BACKOFF", "60"))  # Seconds before the first retry; doubles per attempt
+GENERATION_JOB_MAX_BACKOFF = float(os.getenv("GENERATION_JOB_MAX_BACKOFF", "3600"))
+GENERATION_JOB_POLL_INTERVAL = float(os.getenv("GENERATION_JOB_POLL_INTERVAL", "30"))  # Seconds between checks for due retries
+GENERATION_SWEEP_MINUTES = float(os.getenv("GENERATION_SWEEP_MINUTES", "360"))  # Reconciliation scan for empty subjects without a job
+
+# Async database pool used by the API endpoints
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))  # Extra connections allowed under load
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+
+# Taxonomy snapshot
+TAXONOMY_VERSION_CHECK_SECONDS = float(os.getenv("TAXONOMY_VERSION_CHECK_SECONDS", "5"))  # How stale another worker's taxonomy change can look here
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))  # Precompressed responses smaller than this are sent uncompressed
+
+# Tag search
+TAG_INDEX_REFRESH_MINUTES = float(os.getenv("TAG_INDEX_REFRESH_MINUTES", "10"))  # Full rebuild of the autocomplete index, picking up other workers' inserts and chat tag counts
+TAG_COUNT_LIMIT = int(os.getenv("TAG_COUNT_LIMIT", "1000"))  # /tags/ stops counting matches here and reports the total as capped
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from config import (
+    FAKE_LLM_LATENCY,
+    FAKE_LLM_TOKENS_PER_SECOND,
+    FAKE_LLM_CHUNK_SIZES,
+    FAKE_LLM_ERROR_RATE,
+    FAKE_LLM_REPLY_TOKENS,
+    FAKE_LLM_SEED
+)
+
+FILLER = (
+    "The derivative measures how a function changes as its input changes. "
+    "For example, the derivative of $x^2$ is $2x$, which gives the slope of the tangent line at every point. "
+)
+
+class FakeLLMError(Exception):
+    """Injected failure, raised with probability `error_rate` before the first token."""
+
+def _listed(prompt: str, label: str) -> List[str]:
+    match = re.search(rf"^Available {label}: (.*)$", prompt, re.MULTILINE)
+    if not match:
+        return []
+    return [name.strip() for name in match.group(1).split(",") if name.strip()]
+
+def _pick(question: str, names: List[str]) -> List[str]:
+    """Names whose words appear in the question, or else the first name."""
+    words = set(re.findall(r"[a-z0-9]+", question.lower()))
+    matches = [name for name in names if set(re.findall(r"[a-z0-9]+", name.lower())) <= words]
+    return matches or names[:1]
+
+def default_reply(prompt: str, reply_tokens: int = FAKE_LLM_REPLY_TOKENS) -> str:
+    """Well-formed answer for whichever prompt in prompts.py this is."""
+    question = re.search(r"^Question: (.*)$", prompt, re.MULTILINE)
+    question = question.group(1) if question else ""
+
+    for label in ("Subjects", "Topics", "Subtopics"):
+        names = _listed(prompt, label)
+        if names:
+            numbered = re.findall(r"^(\d+)\. (.*)$", prompt.split("Questions:", 1)[-1], re.MULTILINE)
+            if "Questions:" in prompt and numbered:
+                return json.dumps({number: _pick(text, names) for number, text in numbered})
+            return json.dumps(_pick(question, names))
+
+    if '"title"' in prompt:
+        text = re.search(r"^Question or Content: (.*)$", prompt, re.MULTILINE)
+        words = (text.group(1) if text else "Untitled").split()[:4]
+        return json.dumps({"title": " ".join(words)})
+
+    chapter = re.search(r'List the subtopics of the chapter "(.+?)" only', prompt)
+    if chapter:
+        name = chapter.group(1)
+        return json.dumps({"subtopics": [
+            {"subtopic": f"Core Definitions in {name}", "difficulty": 0.2},
+            {"subtopic": f"Basic Methods in {name}", "difficulty": 0.3}
+        ]})
+
+    subject = re.search(r"chapter list of a detailed, comprehensive, and accurate Text Book on (.+?)\. ", prompt)
+    if subject:
+        name = subject.group(1)
+        return json.dumps({"chapters": [
+            {"chapter": f"Introduction to {name}", "difficulty": 0.1},
+            {"chapter": f"Foundations of {name}", "difficulty": 0.3},
+            {"chapter": f"Methods of {name}", "difficulty": 0.5}
+        ]})
+
+    subject = re.search(r"Only include topics within (.+?),", prompt)
+    if subject:
+        name = subject.group(1)
+        return json.dumps({name: {
+            f"Introduction to {name}": {
+                "subtopics": [{"subtopic": f"History of {name}", "difficulty": 0.1}],
+                "difficulty": 0.1
+            },
+            f"Foundations of {name}": {
+                "subtopics": [
+                    {"subtopic": f"Core Definitions in {name}", "difficulty": 0.2},
+                    {"subtopic": f"Basic Methods in {name}", "difficulty": 0.3}
+                ],
+                "difficulty": 0.3
+            }
+        }})
+
+    if "running summary" in prompt:
+        return "The student has been working through derivatives and asked for worked examples."
+
+    words = (FILLER * (reply_tokens // len(FILLER.split()) + 1)).split()[:reply_tokens]
+    return " ".join(words)
+
+class FakeChatModel(BaseChatModel):
+    """
+    Local stand-in for ChatOpenAI with a controllable cost model, for tests and load tests.
+
+    A call waits `latency` seconds (time to first token), then produces its reply at
+    `tokens_per_second`, in chunks of a random size within `chunk_sizes` (in tokens).
+    `error_rate` of calls raise FakeLLMError. Replies are deterministic per prompt, and
+    chunking and injected errors follow a seeded sequence.
+    """
+
+    latency: float = FAKE_LLM_LATENCY
+    tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND
+    chunk_sizes: Tuple[int, int] = FAKE_LLM_CHUNK_SIZES
+    error_rate: float = FAKE_LLM_ERROR_RATE
+    reply_tokens: int = FAKE_LLM_REPLY_TOKENS
+    seed: int = FAKE_LLM_SEED
+    reply: Optional[str] = None  # Fixed reply for every prompt instead of default_reply
+
+    def model_post_init(self, __context: Any):
+        self._rng = random.Random(self.seed)
+        self._rng_lock = threading.Lock()
+        self._calls = 0
+
+    @property
+    def calls(self) -> int:
+        """Calls made to this model so far."""
+        return self._calls
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _prompt(self, messages: List[BaseMessage]) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _plan(self, messages: List[BaseMessage]) -> Tuple[List[str], bool]:
+        """Split the reply into chunks and decide whether this call fails."""
+        text = self.reply if self.reply is not None else default_reply(self._prompt(messages), self.reply_tokens)
+        tokens = re.findall(r"\S+\s*|\s+", text)
+        low, high = self.chunk_sizes
+        with self._rng_lock:
+            self._calls += 1
+            fail = self._rng.random() < self.error_rate
+            chunks = []
+            i = 0
+            while i < len(tokens):
+                size = self._rng.randint(low, high)
+                chunks.append("".join(tokens[i:i + size]))
+                i += size
+        return chunks, fail
+
+    def _delay(self, chunk: str) -> float:
+        return len(re.findall(r"\S+", chunk)) / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        chunks, fail = self._plan(messages)
+        time.sleep(self.latency)
+        if fail:
+            raise FakeLLMError("Injected fake LLM failure")
+        for chunk in chunks:
+            time.sleep(self._delay(chunk))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        chunks, fail = self._plan(messages)
+        await asyncio.sleep(self.latency)
+        if fail:
+            raise FakeLLMError("Injected fake LLM failure")
+        for chunk in chunks:
+            await asyncio.sleep(self._delay(chunk))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        chunks, fail = self._plan(messages)
+        time.sleep(self.latency + sum(self._delay(chunk) for chunk in chunks))
+        if fail:
+            raise FakeLLMError("Injected fake LLM failure")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(chunks)))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        chunks, fail = self._plan(messages)
+        await asyncio.sleep(self.latency + sum(self._delay(chunk) for chunk in chunks))
+        if fail:
+            raise FakeLLMError("Injected fake LLM failure")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(chunks)))])
@@ -1,208 +1,834 @@
 from langchain_openai import ChatOpenAI
+from langchain_anthropic import ChatAnthropic
 from langchain.prompts import PromptTemplate
-from langchain_core.runnables import RunnableWithMessageHistory
+from langchain_core.runnables import RunnableWithMessageHistory, ConfigurableFieldSpec
 from langchain_core.prompts import ChatPromptTemplate
+import hashlib
 import json
-from typing import Dict, Any, List, Callable, AsyncGenerator
-from sqlalchemy.orm import Session
-from config import OPENAI_API_KEY, MODEL_NAME, TEMPERATURE
+import threading
+import httpx
+from typing import Dict, Any, List, Callable, AsyncGenerator, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import (
+    OPENAI_API_KEY,
+    ANTHROPIC_API_KEY,
+    MODEL_NAME,
+    ANTHROPIC_MODEL,
+    ANTHROPIC_BASE_URL,
+    ANTHROPIC_MAX_TOKENS,
+    TEMPERATURE,
+    OPENAI_BASE_URL,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY,
+    LLM_TIMEOUT,
+    CLASSIFICATION_MAX_CONCURRENCY,
+    CLASSIFICATION_TIME_BUDGET,
+    BATCH_CLASSIFICATION_SIZE,
+    BATCH_CLASSIFICATION_CONCURRENCY,
+    BATCH_CLASSIFICATION_MAX_RETRIES,
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_PAGE_SIZE,
+    LLM_BACKEND,
+    LLM_PROVIDERS,
+    LLM_PROVIDER_MAX_RETRIES,
+    LLM_HEDGE_PRIORITIES
+)
 from prompts import (
-    TOPIC_GENERATION_PROMPT, 
+    CHAPTER_LIST_PROMPT,
+    CHAPTER_SUBTOPICS_PROMPT,
     SUBJECT_CLASSIFICATION_PROMPT,
     TOPIC_CLASSIFICATION_PROMPT,
+    SUBTOPIC_CLASSIFICATION_PROMPT,
+    BATCH_SUBJECT_CLASSIFICATION_PROMPT,
     TITLE_GENERATION_PROMPT,
+    HISTORY_SUMMARY_PROMPT,
     CHAT_JSON_RESPONSE_PROMPT
 )
 from enum import Enum
-from ChatMessageHistory import PostgresChatMessageHistory
+from ChatMessageHistory import PostgresChatMessageHistory, estimate_tokens, message_text
+from models.database import Chat, Message
+from cache import classification_cache
+from prefilter import candidate_prefilter
+from singleflight import llm_singleflight
+from fake_llm import FakeChatModel
+from llm_scheduler import llm_scheduler
+from providers import ProviderRouter
+from streaming import StreamNormalizer
 from langchain.chains import SequentialChain
 import asyncio
 
-def create_llm():
-    """Create and return a ChatOpenAI instance."""
+def create_llm(
+    http_client: Optional[httpx.Client] = None,
+    http_async_client: Optional[httpx.AsyncClient] = None,
+    base_url: Optional[str] = None,
+    streaming: bool = True,
+    backend: str = LLM_BACKEND,
+    provider: str = "openai",
+    max_retries: Optional[int] = None
+):
+    """
+    Create and return the chat model selected by LLM_BACKEND and the provider
+    (ChatOpenAI by default, ChatAnthropic for provider="anthropic").
+    """
+    if backend == "fake":
+        return FakeChatModel()
+    if backend != "openai":
+        raise ValueError(f"Unknown LLM_BACKEND: {backend}")
+    retries = {} if max_retries is None else {"max_retries": max_retries}
+    if provider == "anthropic":
+        # The Anthropic SDK keeps its own connection pool
+        return ChatAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            model=ANTHROPIC_MODEL,
+            temperature=TEMPERATURE,
+            max_tokens=ANTHROPIC_MAX_TOKENS,
+            streaming=streaming,
+            base_url=base_url or ANTHROPIC_BASE_URL,
+            default_request_timeout=LLM_TIMEOUT,
+            **retries
+        )
+    if provider != "openai":
+        raise ValueError(f"Unknown LLM provider: {provider}")
     return ChatOpenAI(
         api_key=OPENAI_API_KEY,
         model_name=MODEL_NAME,
         temperature=TEMPERATURE,
-        streaming=True
+        streaming=streaming,
+        base_url=base_url or OPENAI_BASE_URL,
+        http_client=http_client,
+        http_async_client=http_async_client,
+        **retries
     )
 
-def generate_subject_content(subject: str) -> Dict[str, Any]:
-    """Generate and parse content for a given academic subject."""
-    llm = create_llm()
-    
-    # Create prompt template with double curly braces for JSON structure
-    prompt = PromptTemplate.from_template(
-        TOPIC_GENERATION_PROMPT
+def _get_session_history(
+    chat_id: int,
+    db_session: AsyncSession,
+    saved_reply_ids: Optional[List[int]] = None
+) -> PostgresChatMessageHistory:
+    """History factory for the shared chat chain; its arguments come from the call config."""
+    return PostgresChatMessageHistory(
+        chat_id=int(chat_id),
+        db_session=db_session,
+        token_budget=HISTORY_TOKEN_BUDGET or None,
+        page_size=HISTORY_PAGE_SIZE,
+        saved_reply_ids=saved_reply_ids
     )
-    
-    # Generate content
-    formatted_prompt = prompt.format(subject=subject)
-    response = llm.invoke(formatted_prompt)
-    
-    try:
-        # Extract content from AIMessage and parse JSON
-        content_str = response.content.replace("```json", "").replace("```", "")
-        content = json.loads(content_str)
-        return content
-    except json.JSONDecodeError as e:
-        raise Exception(f"Failed to parse JSON response: {str(e)}\nResponse: {response.content}")
-
-def validate_content_structure(content: Dict[str, Any], subject: str) -> bool:
-    """Validate the structure of the generated content."""
-    if not isinstance(content, dict) or subject not in content:
+
+def _strip_json_response(content: str) -> str:
+    """Remove code fences and stray wrapping quotes from a JSON LLM response."""
+    content_str = content.strip().replace("```json", "").replace("```", "").strip()
+    if content_str.startswith(("'", '"')):
+        content_str = content_str[1:]
+    if content_str.endswith(("'", '"')):
+        content_str = content_str[:-1]
+    return content_str
+
+def _parse_json_response(response) -> Any:
+    return json.loads(_strip_json_response(response.content))
+
+# A provider answer that fails these checks counts as a failure and is retried elsewhere
+RESPONSE_VALIDATORS = {
+    "chapter_list": _parse_json_response,
+    "chapter_subtopics": _parse_json_response,
+    "subject_classification": _parse_json_response,
+    "topic_classification": _parse_json_response,
+    "subtopic_classification": _parse_json_response,
+    "batch_subject_classification": _parse_json_response,
+    "title_generation": _parse_json_response,
+}
+
+class LLMRegistry:
+    """
+    Process-wide LLM clients and prebuilt prompts/chains.
+
+    Holds one pooled sync and async HTTP client (keep-alive, bounded connections)
+    so calls reuse warm connections instead of paying a new TCP/TLS handshake,
+    and parses every prompt template once.
+    """
+
+    PROMPTS = {
+        "chapter_list": CHAPTER_LIST_PROMPT,
+        "chapter_subtopics": CHAPTER_SUBTOPICS_PROMPT,
+        "subject_classification": SUBJECT_CLASSIFICATION_PROMPT,
+        "topic_classification": TOPIC_CLASSIFICATION_PROMPT,
+        "subtopic_classification": SUBTOPIC_CLASSIFICATION_PROMPT,
+        "batch_subject_classification": BATCH_SUBJECT_CLASSIFICATION_PROMPT,
+        "title_generation": TITLE_GENERATION_PROMPT,
+        "history_summary": HISTORY_SUMMARY_PROMPT,
+        "chat": CHAT_JSON_RESPONSE_PROMPT,
+    }
+
+    def __init__(
+        self,
+        llm=None,
+        base_url: Optional[str] = None,
+        providers: Optional[Dict[str, Optional[str]]] = None,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        timeout: float = LLM_TIMEOUT
+    ):
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http_client = httpx.Client(limits=limits, timeout=timeout)
+        self.http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+        # provider -> (streaming llm, completion llm); `providers` maps each provider to a base URL
+        if llm is not None:
+            self.provider_llms = {"default": (llm, llm)}
+        else:
+            if providers is None:
+                providers = {name: base_url if name == "openai" else None for name in LLM_PROVIDERS}
+            # With somewhere to fail over to, SDK retries would only delay it
+            max_retries = LLM_PROVIDER_MAX_RETRIES if len(providers) > 1 else None
+            self.provider_llms = {
+                name: (
+                    create_llm(self.http_client, self.http_async_client, url, provider=name, max_retries=max_retries),
+                    # Whole-response JSON calls don't benefit from SSE, and a non-streamed response
+                    # is read to the end so its connection goes back to the pool
+                    create_llm(self.http_client, self.http_async_client, url, streaming=False, provider=name, max_retries=max_retries)
+                )
+                for name, url in providers.items()
+            }
+        self.providers = list(self.provider_llms)
+        self.llm, self.completion_llm = self.provider_llms[self.providers[0]]
+
+        self.prompts = {
+            name: PromptTemplate.from_template(template)
+            for name, template in self.PROMPTS.items()
+        }
+        self.provider_chains = {
+            provider: {
+                name: prompt | (llm if name == "chat" else completion_llm)
+                for name, prompt in self.prompts.items()
+            }
+            for provider, (llm, completion_llm) in self.provider_llms.items()
+        }
+        self.chains = self.provider_chains[self.providers[0]]
+        self.router = ProviderRouter(self.provider_chains) if len(self.providers) > 1 else None
+
+        # A chat stream can only fail over before its first token, which with_fallbacks handles
+        chat = self.chains["chat"]
+        if self.router is not None:
+            chat = chat.with_fallbacks([self.provider_chains[provider]["chat"] for provider in self.providers[1:]])
+
+        # Built once; the per-request chat id and DB session are passed through the config
+        self.chat_chain = RunnableWithMessageHistory(
+            chat,
+            get_session_history=_get_session_history,
+            input_messages_key="input",
+            history_messages_key="history",
+            history_factory_config=[
+                ConfigurableFieldSpec(
+                    id="chat_id",
+                    annotation=int,
+                    name="Chat ID",
+                    description="Chat whose message history is used.",
+                    default=None,
+                    is_shared=True
+                ),
+                ConfigurableFieldSpec(
+                    id="db_session",
+                    annotation=AsyncSession,
+                    name="DB Session",
+                    description="Session used to read and write message history.",
+                    default=None,
+                    is_shared=True
+                ),
+                ConfigurableFieldSpec(
+                    id="saved_reply_ids",
+                    annotation=list,
+                    name="Saved reply IDs",
+                    description="List that receives the ids of the reply messages this call saves.",
+                    default=None,
+                    is_shared=True
+                ),
+            ]
+        )
+
+    def invoke(self, chain_name: str, inputs: Dict[str, Any]):
+        """Run a chain, failing over between providers when there is more than one."""
+        if self.router is None:
+            return self.chains[chain_name].invoke(inputs)
+        return self.router.invoke(chain_name, inputs, validate=RESPONSE_VALIDATORS.get(chain_name))
+
+    async def ainvoke(
+        self,
+        chain_name: str,
+        inputs: Dict[str, Any],
+        hedge: bool = False,
+        on_hedge: Optional[Callable[[], None]] = None
+    ):
+        """Async variant of invoke; `hedge` also races a delayed request on the next provider."""
+        if self.router is None:
+            return await self.chains[chain_name].ainvoke(inputs)
+        return await self.router.ainvoke(
+            chain_name,
+            inputs,
+            validate=RESPONSE_VALIDATORS.get(chain_name),
+            hedge=hedge,
+            on_hedge=on_hedge
+        )
+
+    def close(self):
+        """Close the sync HTTP client."""
+        self.http_client.close()
+
+    async def aclose(self):
+        """Close both pooled HTTP clients."""
+        self.http_client.close()
+        await self.http_async_client.aclose()
+
+_registry: Optional[LLMRegistry] = None
+_registry_lock = threading.Lock()
+
+def init_llm_registry(**kwargs) -> LLMRegistry:
+    """Build (or rebuild) the process-wide registry. Called from the app lifespan at startup."""
+    global _registry
+    with _registry_lock:
+        previous = _registry
+        _registry = LLMRegistry(**kwargs)
+    if previous is not None:
+        previous.close()
+    return _registry
+
+def get_llm_registry() -> LLMRegistry:
+    """Return the process-wide registry, building it on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = LLMRegistry()
+    return _registry
+
+def _flight_key(chain_name: str, inputs: Dict[str, Any]) -> str:
+    """Identity of an LLM call: the chain plus its exact inputs."""
+    payload = json.dumps([chain_name, inputs], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+# Scheduler priority class and typical completion length of each chain
+CHAIN_PRIORITIES = {
+    "chat": "interactive",
+    "subject_classification": "classification",
+    "topic_classification": "classification",
+    "subtopic_classification": "classification",
+    "batch_subject_classification": "classification",
+    "title_generation": "title",
+    "chapter_list": "background",
+    "chapter_subtopics": "background",
+    "history_summary": "background",
+}
+EXPECTED_OUTPUT_TOKENS = {
+    "chat": 1000,
+    "batch_subject_classification": 500,
+    "title_generation": 20,
+    "chapter_list": 800,
+    "chapter_subtopics": 400,
+    "history_summary": 300,
+}
+
+def _prompt_tokens(registry: LLMRegistry, chain_name: str, inputs: Dict[str, Any]) -> int:
+    return estimate_tokens(registry.prompts[chain_name].format(**inputs))
+
+def _invoke_chain(chain_name: str, inputs: Dict[str, Any]):
+    """
+    Invoke a registry chain, sharing the call with identical concurrent callers and
+    waiting for a slot in the chain's scheduler priority class.
+    """
+    registry = get_llm_registry()
+
+    def call():
+        prompt_tokens = _prompt_tokens(registry, chain_name, inputs)
+        estimate = prompt_tokens + EXPECTED_OUTPUT_TOKENS.get(chain_name, 50)
+        with llm_scheduler.slot(CHAIN_PRIORITIES[chain_name], estimate) as ticket:
+            response = registry.invoke(chain_name, inputs)
+            ticket.used_tokens = prompt_tokens + estimate_tokens(str(response.content))
+            return response
+
+    return llm_singleflight.do(_flight_key(chain_name, inputs), call)
+
+async def _ainvoke_chain(chain_name: str, inputs: Dict[str, Any]):
+    """Async variant of _invoke_chain."""
+    registry = get_llm_registry()
+    priority = CHAIN_PRIORITIES[chain_name]
+
+    async def call():
+        prompt_tokens = _prompt_tokens(registry, chain_name, inputs)
+        estimate = prompt_tokens + EXPECTED_OUTPUT_TOKENS.get(chain_name, 50)
+        async with llm_scheduler.aslot(priority, estimate) as ticket:
+            response = await registry.ainvoke(
+                chain_name,
+                inputs,
+                hedge=priority in LLM_HEDGE_PRIORITIES,
+                on_hedge=lambda: llm_scheduler.charge_hedge(ticket, estimate)
+            )
+            # A cancelled hedge was still billed for its prompt
+            ticket.used_tokens = prompt_tokens * (1 + ticket.hedges) + estimate_tokens(str(response.content))
+            return response
+
+    return await llm_singleflight.ado(_flight_key(chain_name, inputs), call)
+
+def validate_chapter_structure(chapter: Dict[str, Any]) -> bool:
+    """Validate one chapter of generated content: {"subtopics": [{"subtopic", "difficulty"}, ...], ...}."""
+    if not isinstance(chapter, dict) or "subtopics" not in chapter:
         return False
-    
-    subject_content = content[subject]
-    if not isinstance(subject_content, dict):
+    if not isinstance(chapter["subtopics"], list):
         return False
-    
-    for chapter in subject_content.values():
-        if not isinstance(chapter, dict) or "subtopics" not in chapter:
+    for topic in chapter["subtopics"]:
+        if not isinstance(topic, dict) or "subtopic" not in topic or "difficulty" not in topic:
             return False
-        if not isinstance(chapter["subtopics"], list):
+        if not isinstance(topic["difficulty"], (int, float)) or not 0 <= topic["difficulty"] <= 1:
             return False
-        for topic in chapter["subtopics"]:
-            if not isinstance(topic, dict) or "subtopic" not in topic or "difficulty" not in topic:
-                return False
-            if not isinstance(topic["difficulty"], (int, float)) or not 0 <= topic["difficulty"] <= 1:
-                return False
-    
     return True
 
+async def agenerate_chapter_list(subject: str) -> List[Dict[str, Any]]:
+    """First phase of textbook generation: the ordered chapters of a subject with their difficulty."""
+    response = await _ainvoke_chain("chapter_list", {"subject": subject})
+    parsed = json.loads(_strip_json_response(response.content))
+    chapters = parsed.get("chapters") if isinstance(parsed, dict) else parsed
+    if not isinstance(chapters, list) or not chapters:
+        raise ValueError(f"No chapter list in response: {response.content}")
+
+    seen = set()
+    result = []
+    for chapter in chapters:
+        if not isinstance(chapter, dict) or not isinstance(chapter.get("chapter"), str):
+            raise ValueError(f"Malformed chapter entry: {chapter}")
+        difficulty = chapter.get("difficulty")
+        if not isinstance(difficulty, (int, float)) or not 0 <= difficulty <= 1:
+            raise ValueError(f"Invalid difficulty for chapter {chapter['chapter']}: {difficulty}")
+        name = chapter["chapter"].strip()
+        if name and name not in seen:
+            seen.add(name)
+            result.append({"chapter": name, "difficulty": difficulty})
+    return result
+
+async def agenerate_chapter(subject: str, chapter: Dict[str, Any], chapters: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Second phase: one chapter's subtopics with the chapter's difficulty.
+    Raises ValueError if the response fails validate_chapter_structure, so the caller can retry.
+    """
+    response = await _ainvoke_chain("chapter_subtopics", {
+        "subject": subject,
+        "chapter": chapter["chapter"],
+        "chapters_list": "\n".join(f"- {entry['chapter']}" for entry in chapters)
+    })
+    parsed = json.loads(_strip_json_response(response.content))
+    content = {
+        "subtopics": parsed.get("subtopics") if isinstance(parsed, dict) else parsed,
+        "difficulty": chapter["difficulty"]
+    }
+    if not validate_chapter_structure(content) or not content["subtopics"]:
+        raise ValueError(f"Invalid subtopics for chapter {chapter['chapter']}: {response.content}")
+    return content
+
 def classify_question_subjects(question: str, available_subjects: list[str]) -> list[str]:
     """
     Classify which subjects a question belongs to from a list of available subjects.
     """
-    llm = create_llm()
-    
-    # Create prompt template
-    prompt = PromptTemplate.from_template(SUBJECT_CLASSIFICATION_PROMPT)
+    cached = classification_cache.get("subject", question, available_subjects)
+    if cached is not None:
+        return cached
+
+    # Narrow long candidate lists locally, or answer outright when the match is unambiguous
+    candidates, answer = candidate_prefilter.narrow(question, available_subjects)
+    if answer is not None:
+        classification_cache.set("subject", question, available_subjects, answer)
+        return answer
+
+    response = None
     
     try:
-        # Format prompt with question and subjects
-        formatted_prompt = prompt.format(
-            question=question,
-            subjects_list=", ".join(available_subjects)
-        )
-        
         # Get classification response
-        response = llm.invoke(formatted_prompt)
-        
-        # Clean and parse JSON response
-        content_str = response.content.strip()
-        # Remove any markdown code blocks if present
-        content_str = content_str.replace("```json", "").replace("```", "").strip()
+        response = _invoke_chain("subject_classification", {
+            "question": question,
+            "subjects_list": ", ".join(candidates)
+        })
         
-        # Additional cleanup for common issues
-        if content_str.startswith("'") or content_str.startswith('"'):
-            content_str = content_str[1:]
-        if content_str.endswith("'") or content_str.endswith('"'):
-            content_str = content_str[:-1]
-            
-        # Parse JSON response
-        subjects = json.loads(content_str)
+        subjects = json.loads(_strip_json_response(response.content))
         
         # Validate subjects are from available list
         valid_subjects = [s for s in subjects if s in available_subjects]
+        classification_cache.set("subject", question, available_subjects, valid_subjects)
         
         return valid_subjects
     except Exception as e:
         print(f"Error classifying question: {str(e)}")
-        print(f"Raw response content: {response.content}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
         return []
 
 def classify_question_topics(question: str, subject: str, available_topics: list[str]) -> list[str]:
     """
     Classify which topics within a subject are most relevant to a question.
     """
-    llm = create_llm()
-    prompt = PromptTemplate.from_template(TOPIC_CLASSIFICATION_PROMPT)
+    cached = classification_cache.get("topic", question, available_topics, subject)
+    if cached is not None:
+        return cached
+
+    # Narrow long candidate lists locally, or answer outright when the match is unambiguous
+    candidates, answer = candidate_prefilter.narrow(question, available_topics)
+    if answer is not None:
+        classification_cache.set("topic", question, available_topics, answer, subject)
+        return answer
+
+    response = None
     
     try:
-        formatted_prompt = prompt.format(
-            question=question,
-            subject=subject,
-            topics_list=", ".join(available_topics)
-        )
+        response = _invoke_chain("topic_classification", {
+            "question": question,
+            "subject": subject,
+            "topics_list": ", ".join(candidates)
+        })
         
-        response = llm.invoke(formatted_prompt)
-        
-        # Clean and parse JSON response
-        content_str = response.content.strip()
-        content_str = content_str.replace("```json", "").replace("```", "").strip()
-        
-        if content_str.startswith(("'", '"')):
-            content_str = content_str[1:]
-        if content_str.endswith(("'", '"')):
-            content_str = content_str[:-1]
-            
-        topics = json.loads(content_str)
+        topics = json.loads(_strip_json_response(response.content))
         valid_topics = [t for t in topics if t in available_topics]
+        classification_cache.set("topic", question, available_topics, valid_topics, subject)
         
         return valid_topics
     except Exception as e:
         print(f"Error classifying topics: {str(e)}")
-        print(f"Raw response content: {response.content}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
         return []
 
 def classify_question_subtopics(question: str, subject: str, available_subtopics: list[str]) -> list[str]:
     """
     Classify which subtopics within a subject are most relevant to a question.
     """
-    llm = create_llm()
-    # Use SUBTOPIC_CLASSIFICATION_PROMPT from prompts
-    from prompts import SUBTOPIC_CLASSIFICATION_PROMPT
-    prompt = PromptTemplate.from_template(SUBTOPIC_CLASSIFICATION_PROMPT)
+    cached = classification_cache.get("subtopic", question, available_subtopics, subject)
+    if cached is not None:
+        return cached
+
+    # Narrow long candidate lists locally, or answer outright when the match is unambiguous
+    candidates, answer = candidate_prefilter.narrow(question, available_subtopics)
+    if answer is not None:
+        classification_cache.set("subtopic", question, available_subtopics, answer, subject)
+        return answer
+
+    response = None
     
     try:
-        formatted_prompt = prompt.format(
-            question=question,
-            subject=subject,
-            subtopics_list=", ".join(available_subtopics)
-        )
+        response = _invoke_chain("subtopic_classification", {
+            "question": question,
+            "subject": subject,
+            "subtopics_list": ", ".join(candidates)
+        })
         
-        response = llm.invoke(formatted_prompt)
-        
-        content_str = response.content.strip().replace("```json", "").replace("```", "").strip()
-        if content_str.startswith(("'", '"')):
-            content_str = content_str[1:]
-        if content_str.endswith(("'", '"')):
-            content_str = content_str[:-1]
-            
-        subtopics = json.loads(content_str)
+        subtopics = json.loads(_strip_json_response(response.content))
         valid_subtopics = [s for s in subtopics if s in available_subtopics]
+        classification_cache.set("subtopic", question, available_subtopics, valid_subtopics, subject)
         return valid_subtopics
     except Exception as e:
         print(f"Error classifying subtopics: {str(e)}")
-        print(f"Raw response content: {response.content}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
         return []
 
 def generate_title(text: str) -> str:
     """Generate a concise title (max 4 words) for a given text."""
-    llm = create_llm()
-    prompt = PromptTemplate.from_template(TITLE_GENERATION_PROMPT)
+    response = None
     
     try:
-        formatted_prompt = prompt.format(text=text)
-        response = llm.invoke(formatted_prompt)
-        
-        # Clean and parse JSON response
-        content_str = response.content.strip()
-        content_str = content_str.replace("```json", "").replace("```", "").strip()
+        response = _invoke_chain("title_generation", {"text": text})
         
-        if content_str.startswith(("'", '"')):
-            content_str = content_str[1:]
-        if content_str.endswith(("'", '"')):
-            content_str = content_str[:-1]
-            
-        title_data = json.loads(content_str)
+        title_data = json.loads(_strip_json_response(response.content))
         return title_data["title"]
     except Exception as e:
         print(f"Error generating title: {str(e)}")
-        print(f"Raw response content: {response.content}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
         return ""
 
+async def _aclassify(
+    kind: str,
+    inputs: Dict[str, Any],
+    available: list[str],
+    list_key: str,
+    label: str,
+    context: str = ""
+) -> list[str]:
+    """Run a classification chain with ainvoke and keep only names from the available list."""
+    cached = await classification_cache.aget(kind, inputs["question"], available, context)
+    if cached is not None:
+        return cached
+
+    candidates, answer = candidate_prefilter.narrow(inputs["question"], available)
+    if answer is not None:
+        await classification_cache.aset(kind, inputs["question"], available, answer, context)
+        return answer
+    inputs = {**inputs, list_key: ", ".join(candidates)}
+
+    response = None
+
+    try:
+        response = await _ainvoke_chain(f"{kind}_classification", inputs)
+        selected = json.loads(_strip_json_response(response.content))
+        valid = [name for name in selected if name in available]
+        await classification_cache.aset(kind, inputs["question"], available, valid, context)
+        return valid
+    except Exception as e:
+        print(f"Error classifying {label}: {str(e)}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
+        return []
+
+async def aclassify_question_subjects(question: str, available_subjects: list[str]) -> list[str]:
+    """Async variant of classify_question_subjects that does not block the event loop."""
+    return await _aclassify(
+        "subject",
+        {"question": question},
+        available_subjects,
+        "subjects_list",
+        "question"
+    )
+
+async def aclassify_question_topics(question: str, subject: str, available_topics: list[str]) -> list[str]:
+    """Async variant of classify_question_topics that does not block the event loop."""
+    return await _aclassify(
+        "topic",
+        {"question": question, "subject": subject},
+        available_topics,
+        "topics_list",
+        "topics",
+        subject
+    )
+
+async def aclassify_question_subtopics(question: str, subject: str, available_subtopics: list[str]) -> list[str]:
+    """Async variant of classify_question_subtopics that does not block the event loop."""
+    return await _aclassify(
+        "subtopic",
+        {"question": question, "subject": subject},
+        available_subtopics,
+        "subtopics_list",
+        "subtopics",
+        subject
+    )
+
+async def aclassify_questions_batch(
+    questions: List[str],
+    available_subjects: list[str],
+    batch_size: int = BATCH_CLASSIFICATION_SIZE,
+    max_concurrency: int = BATCH_CLASSIFICATION_CONCURRENCY,
+    max_retries: int = BATCH_CLASSIFICATION_MAX_RETRIES
+) -> Dict[str, Any]:
+    """
+    Classify many questions against the same subject list, packing `batch_size`
+    questions into each prompt and running up to `max_concurrency` packed calls at once.
+
+    Items missing from (or malformed in) a batch response are re-packed and retried
+    up to `max_retries` times. Returns per-question results (None if the item never
+    parsed) and throughput stats.
+    """
+    if batch_size < 1 or max_concurrency < 1:
+        raise ValueError("batch_size and max_concurrency must be at least 1")
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results: List[Optional[list[str]]] = [None] * len(questions)
+    stats = {"llm_calls": 0, "cache_hits": 0, "local_answers": 0, "retried": 0}
+
+    pending: List[int] = []
+    cached_results = await classification_cache.aget_many("subject", questions, available_subjects)
+    for i, (question, cached) in enumerate(zip(questions, cached_results)):
+        if cached is not None:
+            results[i] = cached
+            stats["cache_hits"] += 1
+            continue
+        _, answer = candidate_prefilter.narrow(question, available_subjects)
+        if answer is not None:
+            results[i] = answer
+            await classification_cache.aset("subject", question, available_subjects, answer)
+            stats["local_answers"] += 1
+            continue
+        pending.append(i)
+
+    async def classify_batch(indices: List[int]) -> List[int]:
+        """Classify one packed prompt; return the indices that failed to parse."""
+        # Offer the union of each question's shortlisted subjects
+        candidates = []
+        for i in indices:
+            narrowed, _ = candidate_prefilter.narrow(questions[i], available_subjects)
+            candidates.extend(name for name in narrowed if name not in candidates)
+        questions_list = "\n".join(
+            f"{number}. {' '.join(questions[i].split())}"
+            for number, i in enumerate(indices, start=1)
+        )
+
+        async with semaphore:
+            stats["llm_calls"] += 1
+            try:
+                response = await _ainvoke_chain("batch_subject_classification", {
+                    "questions_list": questions_list,
+                    "subjects_list": ", ".join(candidates)
+                })
+                parsed = json.loads(_strip_json_response(response.content))
+            except Exception as e:
+                print(f"Error classifying question batch: {str(e)}")
+                return indices
+
+        if not isinstance(parsed, dict):
+            return indices
+        failed = []
+        for number, i in enumerate(indices, start=1):
+            selected = parsed.get(str(number))
+            if not isinstance(selected, list):
+                failed.append(i)
+                continue
+            results[i] = [name for name in selected if name in available_subjects]
+            await classification_cache.aset("subject", questions[i], available_subjects, results[i])
+        return failed
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt:
+            stats["retried"] += len(pending)
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        failures = await asyncio.gather(*[classify_batch(batch) for batch in batches])
+        pending = [i for failed in failures for i in failed]
+
+    elapsed = loop.time() - start
+    stats.update({
+        "questions": len(questions),
+        "failed": len(pending),
+        "elapsed_s": round(elapsed, 3),
+        "questions_per_second": round(len(questions) / elapsed, 2) if elapsed > 0 else None
+    })
+    return {"results": results, "stats": stats}
+
+async def aclassify_question_hierarchy(
+    question: str,
+    taxonomy: Dict[str, Dict[str, List[str]]],
+    max_concurrency: int = CLASSIFICATION_MAX_CONCURRENCY,
+    time_budget: float = CLASSIFICATION_TIME_BUDGET
+) -> Dict[str, Any]:
+    """
+    Walk subject -> topic -> subtopic classification in one call.
+
+    `taxonomy` maps subject name -> topic name -> subtopic names. Topic classification
+    for every relevant subject, and subtopic classification for every relevant topic,
+    run concurrently with at most `max_concurrency` LLM calls in flight. Whatever has
+    finished when `time_budget` seconds run out is returned with `partial` set.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + time_budget
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tree: Dict[str, Dict[str, List[str]]] = {}
+
+    async def bounded(classify: Callable, *args):
+        # The coroutine is created once a slot is free, so a call cancelled while waiting
+        # for one never exists unawaited
+        async with semaphore:
+            return await classify(*args)
+
+    async def classify_subtopics(subject: str, topic: str):
+        subtopics = taxonomy[subject].get(topic) or []
+        if subtopics:
+            tree[subject][topic] = await bounded(aclassify_question_subtopics, question, subject, subtopics)
+
+    async def classify_topics(subject: str):
+        topics = taxonomy.get(subject) or {}
+        if not topics:
+            return
+        relevant_topics = await bounded(aclassify_question_topics, question, subject, list(topics))
+        tree[subject] = {topic: [] for topic in relevant_topics}
+        await asyncio.gather(*[classify_subtopics(subject, topic) for topic in relevant_topics])
+
+    partial = False
+    relevant_subjects: List[str] = []
+    try:
+        relevant_subjects = await asyncio.wait_for(
+            aclassify_question_subjects(question, list(taxonomy)),
+            timeout=time_budget
+        )
+    except asyncio.TimeoutError:
+        partial = True
+
+    for subject in relevant_subjects:
+        tree[subject] = {}
+
+    tasks = [asyncio.create_task(classify_topics(subject)) for subject in relevant_subjects]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - loop.time()))
+        if pending:
+            partial = True
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    return {
+        "subjects": [
+            {
+                "name": subject,
+                "topics": [
+                    {"name": topic, "subtopics": subtopics}
+                    for topic, subtopics in topics.items()
+                ]
+            }
+            for subject, topics in tree.items()
+        ],
+        "partial": partial,
+        "elapsed_ms": round((loop.time() - start) * 1000, 1)
+    }
+
+async def agenerate_title(text: str) -> str:
+    """Async variant of generate_title that does not block the event loop."""
+    response = None
+
+    try:
+        response = await _ainvoke_chain("title_generation", {"text": text})
+        title_data = json.loads(_strip_json_response(response.content))
+        return title_data["title"]
+    except Exception as e:
+        print(f"Error generating title: {str(e)}")
+        print(f"Raw response content: {getattr(response, 'content', None)}")
+        return ""
+
+async def aupdate_chat_summary(db_session: AsyncSession, chat_id: int) -> bool:
+    """
+    Fold messages that no longer fit the history window into the chat's rolling summary.
+    Runs after a response has been sent, so it never delays the next answer.
+    """
+    if not HISTORY_TOKEN_BUDGET:
+        return False
+
+    history = _get_session_history(chat_id, db_session)
+    overflow = await history.aunsummarized_messages()
+    if not overflow:
+        return False
+
+    # Fold at most a few windows' worth per run so a long backlog never overflows the prompt
+    batch, tokens = [], 0
+    for message in overflow:
+        tokens += estimate_tokens(message_text(message))
+        if batch and tokens > HISTORY_TOKEN_BUDGET * 4:
+            break
+        batch.append(message)
+    overflow = batch
+
+    chat = await db_session.get(Chat, chat_id)
+    transcript = "\n".join(
+        f"{'Tutor' if message.is_bot else 'Student'}: {message_text(message)}"
+        for message in overflow
+    )
+
+    try:
+        response = await _ainvoke_chain("history_summary", {
+            "summary": chat.summary or "None",
+            "messages": transcript
+        })
+        summary = response.content.strip()
+        if not summary:
+            return False
+        await history.asave_summary(summary, overflow[-1].id)
+        return True
+    except Exception as e:
+        print(f"Error updating chat summary: {str(e)}")
+        await db_session.rollback()
+        return False
+
 class KnowledgeLevel(Enum):
     NOVICE = 1
     INTERMEDIATE = 2
@@ -226,16 +852,20 @@ def clean_llm_response(response_text: str) -> str:
     # Rejoin with newlines
     return '\n'.join(cleaned_lines)
 
-async def generate_chat_response(
+async def generate_chat_events(
     chat_id: int,
-    db_session: Session,
+    db_session: AsyncSession,
     question: str,
     relevant_subjects: List[str],
     relevant_topics: Dict[str, List[str]],
     subject_knowledge: Dict[str, KnowledgeLevel],
     topic_knowledge: Dict[str, KnowledgeLevel]
-) -> AsyncGenerator[str, None]:
-    """Generate a streaming response using RunnableWithMessageHistory with knowledge level context."""
+) -> AsyncGenerator[Tuple[str, Dict[str, Any]], None]:
+    """
+    Generate a streaming response as typed events:
+    ("classification", ...) first, then ("delta", {"text": ...}) pieces,
+    ("message", {"id": ...}) once the reply is persisted, or ("error", ...) on failure.
+    """
     try:
         # Get knowledge levels for relevant subjects
         relevant_knowledge_levels = {
@@ -243,8 +873,14 @@ async def generate_chat_response(
             for subject in relevant_subjects
         }
 
-        # Create LLM instance
-        llm = create_llm()
+        yield "classification", {
+            "subjects": relevant_subjects,
+            "topics": relevant_topics,
+            "knowledge_levels": {
+                subject: level.name.lower()
+                for subject, level in relevant_knowledge_levels.items()
+            }
+        }
 
         # Create knowledge context string
         knowledge_context = "\n".join([
@@ -272,75 +908,76 @@ async def generate_chat_response(
             KnowledgeLevel.EXPERT: "advanced technical"
         }
 
-        # Create prompt template
-        prompt = PromptTemplate.from_template(CHAT_JSON_RESPONSE_PROMPT)
-        chain = prompt | llm
+        # Prebuilt chain with message history
+        chain_with_history = get_llm_registry().chat_chain
+        saved_reply_ids: List[int] = []
 
-        # Create message history getter
-        def get_session_history(session_id: str):
-            return PostgresChatMessageHistory(chat_id=int(session_id), db_session=db_session)
+        # The history window bounds the prompt; live chats get the highest scheduler priority
+        prompt_tokens = estimate_tokens(question) + (HISTORY_TOKEN_BUDGET or 4 * EXPECTED_OUTPUT_TOKENS["chat"])
+        chunks: asyncio.Queue = asyncio.Queue()
 
-        # Wrap with message history
-        chain_with_history = RunnableWithMessageHistory(
-            chain,
-            get_session_history=get_session_history,
-            input_messages_key="input",
-            history_messages_key="history"
-        )
-
-        # Generate streaming response
-        stream = chain_with_history.astream(
-            {
-                "knowledge_context": knowledge_context,
-                "detail_level": detail_map[min_knowledge],
-                "terminology_level": terminology_map[min_knowledge],
-                "input": question
-            },
-            config={"configurable": {"session_id": str(chat_id)}}
-        )
+        async def read_provider():
+            # The slot covers the provider call only: a slow client reads from the queue
+            # after it is released, instead of holding the interactive cap while it drains
+            async with llm_scheduler.aslot("interactive", prompt_tokens + EXPECTED_OUTPUT_TOKENS["chat"]) as ticket:
+                stream = chain_with_history.astream(
+                    {
+                        "knowledge_context": knowledge_context,
+                        "detail_level": detail_map[min_knowledge],
+                        "terminology_level": terminology_map[min_knowledge],
+                        "input": question
+                    },
+                    config={"configurable": {"chat_id": chat_id, "db_session": db_session, "saved_reply_ids": saved_reply_ids}}
+                )
+                output_chars = 0
+                async for chunk in stream:
+                    text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                    output_chars += len(text)
+                    chunks.put_nowait(text)
+                ticket.used_tokens = prompt_tokens + output_chars // 4
 
-        # Modified streaming response handling with proper spacing and newlines
-        last_chunk_ended_with_space = False
-        buffer = ""
-        async for chunk in stream:
-            if hasattr(chunk, 'content'):
-                text = chunk.content
-            else:
-                text = str(chunk)
-            
-            buffer += text
-            
-            # Process complete lines if we have any newlines
-            if '\n' in buffer:
-                lines = buffer.split('\n')
-                # Keep the last partial line in the buffer
-                buffer = lines[-1]
-                
-                # Process all complete lines
-                for line in lines[:-1]:
-                    cleaned = clean_llm_response(line)
-                    if cleaned:
-                        yield cleaned + '\n'
-                        last_chunk_ended_with_space = False
-            
-            # Process any remaining text in buffer if it's complete
-            elif buffer.endswith(('.', '!', '?', ':', ';')):
-                cleaned = clean_llm_response(buffer)
+        reader = asyncio.create_task(read_provider())
+        reader.add_done_callback(lambda _: chunks.put_nowait(None))
+        try:
+            # Normalize incrementally: each character is processed once, math blocks stay whole
+            normalizer = StreamNormalizer()
+            while (text := await chunks.get()) is not None:
+                cleaned = normalizer.feed(text)
                 if cleaned:
-                    if not last_chunk_ended_with_space and not cleaned.startswith(' '):
-                        yield ' '
-                    yield cleaned + ' '
-                    last_chunk_ended_with_space = True
-                buffer = ""
-        
-        # Process any remaining buffer at the end
-        if buffer:
-            cleaned = clean_llm_response(buffer)
-            if cleaned:
-                if not last_chunk_ended_with_space and not cleaned.startswith(' '):
-                    yield ' '
-                yield cleaned
+                    yield "delta", {"text": cleaned}
+            reader.result()  # Raises if the provider call failed
+        finally:
+            if not reader.done():
+                reader.cancel()  # The client went away: stop the provider call as well
+                await asyncio.wait([reader])
+
+        remaining = normalizer.flush()
+        if remaining:
+            yield "delta", {"text": remaining}
+
+        # The history wrapper has saved the reply by the time the stream ends and recorded the
+        # row it inserted for this call, so concurrent streams in one chat get their own ids
+        yield "message", {"id": saved_reply_ids[-1] if saved_reply_ids else None}
 
     except Exception as e:
         print(f"Error generating chat response: {str(e)}")
-        yield "I apologize, but I encountered an error processing your question. Please try again."
+        yield "error", {"message": "I apologize, but I encountered an error processing your question. Please try again."}
+
+async def generate_chat_response(
+    chat_id: int,
+    db_session: AsyncSession,
+    question: str,
+    relevant_subjects: List[str],
+    relevant_topics: Dict[str, List[str]],
+    subject_knowledge: Dict[str, KnowledgeLevel],
+    topic_knowledge: Dict[str, KnowledgeLevel]
+) -> AsyncGenerator[str, None]:
+    """Generate a streaming response using RunnableWithMessageHistory with knowledge level context."""
+    async for event, data in generate_chat_events(
+        chat_id, db_session, question, relevant_subjects,
+        relevant_topics, subject_knowledge, topic_knowledge
+    ):
+        if event == "delta":
+            yield data["text"]
+        elif event == "error":
+            yield data["message"]
@@ -0,0 +1,448 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from models.database import GenerationJob, Subject, SUBJECT_GENERATION_CHANNEL
+from knowledge import agenerate_subject, get_empty_subjects
+from config import (
+    GENERATION_JOB_CONCURRENCY,
+    GENERATION_JOB_MAX_ATTEMPTS,
+    GENERATION_JOB_BACKOFF,
+    GENERATION_JOB_MAX_BACKOFF,
+    GENERATION_JOB_POLL_INTERVAL
+)
+
+JOB_STATES = ("queued", "running", "failed", "done")
+
+# Advisory lock keys, as (class, object) pairs: the leader lock, and one lock per running job
+LEADER_LOCK = (7301, 0)
+JOB_LOCK_CLASS = 7302
+
+class AdvisoryLocks:
+    """
+    Session-level Postgres advisory locks held on one dedicated connection.
+
+    The locks live as long as the connection, so if this process dies they are released
+    and other workers can take over its leadership and its jobs. The same happens when the
+    connection breaks: it is discarded, and `on_lost` is called with the keys that were held
+    on it, from the thread whose call failed.
+    """
+
+    def __init__(self, engine, on_lost: Optional[Callable[[Set[tuple]], None]] = None):
+        self.engine = engine
+        self.on_lost = on_lost
+        self.held: Set[tuple] = set()  # Keys locked on the current connection
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            connection = self.engine.raw_connection()
+            self._conn = connection.driver_connection
+            connection.detach()  # Held for as long as the worker runs, so keep it out of the pool
+            self._conn.autocommit = True
+        return self._conn
+
+    def _call(self, function: str, key: tuple = ()) -> Any:
+        with self._lock:
+            try:
+                with self._connection().cursor() as cursor:
+                    cursor.execute(f"SELECT {function}({', '.join(['%s'] * len(key))})", key)
+                    result = cursor.fetchone()[0]
+            except Exception as e:
+                error, lost = e, self._discard()  # Locks held on a broken connection are gone too
+            else:
+                # Updated under the lock, so a failing call reports exactly what was held
+                if function == "pg_try_advisory_lock" and result:
+                    self.held.add(key)
+                elif function == "pg_advisory_unlock":
+                    self.held.discard(key)
+                return result
+        if lost and self.on_lost is not None:
+            self.on_lost(lost)
+        raise error
+
+    def try_lock(self, key: tuple) -> bool:
+        return self._call("pg_try_advisory_lock", key)
+
+    def unlock(self, key: tuple) -> bool:
+        return self._call("pg_advisory_unlock", key)
+
+    def ping(self) -> int:
+        """Check the lock connection still works and return its backend pid."""
+        return self._call("pg_backend_pid")
+
+    def _discard(self) -> Set[tuple]:
+        lost, self.held = self.held, set()
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+        return lost
+
+    def close(self):
+        with self._lock:
+            self._discard()
+
+class GenerationWorker:
+    """
+    Generates topics for subjects from the generation_jobs table.
+
+    - Up to `concurrency` subjects run at once, as tasks that only await LLM calls;
+      every database access runs in a worker thread, so the event loop never blocks.
+    - A failed attempt is retried after `backoff * 2 ** (attempts - 1)` seconds (capped at
+      `max_backoff`), resuming from the stored chapter list, until `max_attempts` is reached.
+    - Job state lives in the database: jobs left "running" by a stopped process are queued
+      again by the next poll of any worker.
+    - New subjects get their job from a database trigger, which also NOTIFYs
+      SUBJECT_GENERATION_CHANNEL; the worker LISTENs on it and starts the job right away.
+    - Several processes can run a worker against the same database. Jobs are claimed with
+      SELECT ... FOR UPDATE SKIP LOCKED, and a running job holds an advisory lock on the
+      claiming process's connection, so a "running" job whose lock is free was orphaned by a
+      process that died. One process at a time is leader (LEADER_LOCK) and runs the sweep.
+    - If the lock connection breaks, its locks are released, so this process stops being
+      leader and stops the jobs it was running. Their rows stay "running" with a free lock,
+      which recover() in any process requeues, and nothing is written for them from here.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        concurrency: int = GENERATION_JOB_CONCURRENCY,
+        max_attempts: int = GENERATION_JOB_MAX_ATTEMPTS,
+        backoff: float = GENERATION_JOB_BACKOFF,
+        max_backoff: float = GENERATION_JOB_MAX_BACKOFF,
+        poll_interval: float = GENERATION_JOB_POLL_INTERVAL
+    ):
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._active: Set[asyncio.Task] = set()
+        self._tasks: Dict[int, asyncio.Task] = {}  # Running job id -> its task
+        self._running_ids: Set[int] = set()  # Jobs this process holds locks for
+        self._abandoned: Set[int] = set()  # Running jobs whose lock went with the lock connection
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._listen_conn = None
+        self.notifications = 0
+        self.locks_lost = 0
+        self.locks = AdvisoryLocks(session_factory.kw["bind"], on_lost=self._locks_lost)
+        self.is_leader = False
+
+    def enqueue_empty_subjects(self) -> int:
+        """Queue a job for every subject without topics that has no job yet. Returns the number queued."""
+        with self.session_factory() as db:
+            subject_ids = [subject.id for subject in get_empty_subjects(db)]
+            if not subject_ids:
+                return 0
+            queued = db.execute(
+                insert(GenerationJob)
+                .values([{"subject_id": subject_id, "state": "queued", "attempts": 0} for subject_id in subject_ids])
+                .on_conflict_do_nothing(index_elements=["subject_id"])
+                .returning(GenerationJob.id)
+            ).all()
+            db.commit()
+            return len(queued)
+
+    def try_lead(self) -> bool:
+        """Become leader if no other process is. Leadership lasts while the lock connection does."""
+        try:
+            if self.is_leader:
+                self.locks.ping()  # If the connection dropped, _locks_lost has given up leadership
+            if not self.is_leader:
+                self.is_leader = self.locks.try_lock(LEADER_LOCK)
+        except Exception as e:
+            print(f"Leader election failed: {str(e)}")
+        return self.is_leader
+
+    def _locks_lost(self, lost: Set[tuple]):
+        """AdvisoryLocks callback: the lock connection broke and Postgres released `lost`."""
+        self.locks_lost += 1
+        if LEADER_LOCK in lost:
+            self.is_leader = False
+        job_ids = [key[1] for key in lost if key[0] == JOB_LOCK_CLASS]
+        if not job_ids:
+            return
+        print(f"Lost the locks of generation jobs {sorted(job_ids)}; stopping them so they are not run twice")
+        self._abandoned.update(job_ids)
+        if self._event_loop is not None:
+            self._event_loop.call_soon_threadsafe(self._cancel_jobs, job_ids)
+
+    def _cancel_jobs(self, job_ids: List[int]):
+        for job_id in job_ids:
+            task = self._tasks.get(job_id)
+            if task is not None:
+                task.cancel()
+
+    def _owns(self, job_id: int) -> bool:
+        """Whether this process still holds the job's lock, and so may write its row."""
+        return (JOB_LOCK_CLASS, job_id) in self.locks.held
+
+    def recover(self) -> int:
+        """Queue again the running jobs whose process is gone, i.e. whose job lock is free."""
+        if self.locks.held:
+            self.locks.ping()  # Notice a dropped lock connection before others requeue our jobs
+        with self.session_factory() as db:
+            jobs = db.query(GenerationJob).filter(GenerationJob.state == "running").with_for_update(skip_locked=True).all()
+            orphaned = []
+            for job in jobs:
+                if job.id in self._running_ids:
+                    continue  # Advisory locks are re-entrant, so our own would look free
+                key = (JOB_LOCK_CLASS, job.id)
+                if self.locks.try_lock(key):
+                    self.locks.unlock(key)
+                    orphaned.append(job.id)
+            if orphaned:
+                db.query(GenerationJob).filter(GenerationJob.id.in_(orphaned)).update(
+                    {"state": "queued", "next_run_at": datetime.utcnow()}, synchronize_session=False
+                )
+            db.commit()
+            return len(orphaned)
+
+    def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        """Mark up to `limit` due jobs as running and return what is needed to run them."""
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            # SKIP LOCKED: rows another worker is claiming right now are left to it
+            jobs = db.query(GenerationJob, Subject.name).join(Subject, GenerationJob.subject_id == Subject.id).filter(
+                GenerationJob.state.in_(("queued", "failed")),
+                GenerationJob.next_run_at <= now,
+                GenerationJob.attempts < self.max_attempts
+            ).order_by(GenerationJob.next_run_at, GenerationJob.id).limit(limit).with_for_update(
+                skip_locked=True, of=GenerationJob
+            ).all()
+            claimed = []
+            for job, subject_name in jobs:
+                if job.id in self._running_ids or not self.locks.try_lock((JOB_LOCK_CLASS, job.id)):
+                    continue  # Its previous run has not let go yet
+                self._running_ids.add(job.id)
+                job.state = "running"
+                job.attempts += 1
+                job.started_at = now
+                job.finished_at = None
+                claimed.append({
+                    "id": job.id,
+                    "subject": subject_name,
+                    "chapters": job.chapters,
+                    "attempts": job.attempts
+                })
+            try:
+                db.commit()
+            except Exception:
+                for job in claimed:
+                    self._release(job["id"])
+                raise
+            return claimed
+
+    def _finish(self, job_id: int, result: Optional[Dict[str, Any]], error: Optional[str], elapsed: float):
+        if not self._owns(job_id):
+            # Another process may have recovered and claimed it; its row is no longer ours
+            self._release(job_id)
+            return
+        with self.session_factory() as db:
+            job = db.get(GenerationJob, job_id)
+            job.finished_at = datetime.utcnow()
+            job.elapsed_s = round(elapsed, 2)
+            if result is not None and result.get("chapter_list"):
+                job.chapters = result["chapter_list"]
+            if error is None:
+                job.state = "done"
+                job.last_error = None
+                job.next_run_at = None
+            else:
+                job.state = "failed"
+                job.last_error = error
+                if job.attempts < self.max_attempts:
+                    delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+                    job.next_run_at = job.finished_at + timedelta(seconds=delay)
+                else:
+                    job.next_run_at = None
+            db.commit()
+        self._release(job_id)
+
+    def _release(self, job_id: int):
+        self._running_ids.discard(job_id)
+        self._abandoned.discard(job_id)
+        if not self._owns(job_id):
+            return
+        try:
+            self.locks.unlock((JOB_LOCK_CLASS, job_id))
+        except Exception as e:
+            print(f"Could not release lock of generation job {job_id}: {str(e)}")
+
+    def _requeue(self, job_id: int):
+        """Give back a job interrupted by shutdown without counting the attempt."""
+        if not self._owns(job_id):
+            self._release(job_id)  # Left "running" with a free lock, for recover()
+            return
+        with self.session_factory() as db:
+            db.query(GenerationJob).filter(GenerationJob.id == job_id).update(
+                {"state": "queued", "attempts": GenerationJob.attempts - 1, "next_run_at": datetime.utcnow()},
+                synchronize_session=False
+            )
+            db.commit()
+        self._release(job_id)
+
+    async def _run_job(self, job: Dict[str, Any]):
+        start = asyncio.get_running_loop().time()
+        result, error = None, None
+        try:
+            with self.session_factory() as db:
+                result = await agenerate_subject(db, job["subject"], chapters=job["chapters"])
+            if not result["success"]:
+                error = f"Failed chapters: {', '.join(result['failed_chapters'])}"
+        except asyncio.CancelledError:
+            await asyncio.shield(asyncio.to_thread(self._requeue, job["id"]))
+            raise
+        except Exception as e:
+            error = str(e)
+        elapsed = asyncio.get_running_loop().time() - start
+        if error is not None:
+            print(f"Generation job for {job['subject']} failed (attempt {job['attempts']}): {error}")
+        await asyncio.to_thread(self._finish, job["id"], result, error, elapsed)
+
+    async def _loop(self):
+        while True:
+            self._wake.clear()
+            free = self.concurrency - len(self._active)
+            if free > 0:
+                try:
+                    for job in await asyncio.to_thread(self._claim, free):
+                        self._start_job(job)
+                except Exception as e:
+                    print(f"Error claiming generation jobs: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                await self._recover()
+
+    async def _recover(self):
+        try:
+            recovered = await asyncio.to_thread(self.recover)
+        except Exception as e:
+            print(f"Error recovering generation jobs: {str(e)}")
+            return
+        if recovered:
+            print(f"Requeued {recovered} interrupted generation jobs")
+
+    def _start_job(self, job: Dict[str, Any]) -> asyncio.Task:
+        self._event_loop = asyncio.get_running_loop()
+        task = asyncio.create_task(self._run_job(job))
+        self._active.add(task)
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda task: self._on_done(job["id"], task))
+        return task
+
+    def _on_done(self, job_id: int, task: asyncio.Task):
+        self._active.discard(task)
+        if self._tasks.get(job_id) is task:
+            del self._tasks[job_id]
+        self.wake()
+
+    def _connect_listener(self):
+        connection = self.session_factory.kw["bind"].raw_connection()
+        driver_connection = connection.driver_connection
+        connection.detach()  # Held for as long as the worker runs, so keep it out of the pool
+        driver_connection.autocommit = True
+        with driver_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {SUBJECT_GENERATION_CHANNEL}")
+        return driver_connection
+
+    async def ensure_listening(self):
+        """LISTEN for new subjects, unless already listening. Failures leave new subjects to the sweep."""
+        if self._listen_conn is not None:
+            return
+        try:
+            self._listen_conn = await asyncio.to_thread(self._connect_listener)
+        except Exception as e:
+            print(f"Could not listen for new subjects: {str(e)}")
+            return
+        asyncio.get_running_loop().add_reader(self._listen_conn.fileno(), self._on_notify)
+
+    def _on_notify(self):
+        try:
+            self._listen_conn.poll()  # Non-blocking: only reads what the socket already has
+        except Exception as e:
+            print(f"Lost subject notification connection: {str(e)}")
+            self._unlisten()
+            return
+        if self._listen_conn.notifies:
+            self.notifications += len(self._listen_conn.notifies)
+            self._listen_conn.notifies.clear()
+            self.wake()
+
+    def _unlisten(self):
+        if self._listen_conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._listen_conn.fileno())
+        except Exception:
+            pass  # Socket already closed
+        try:
+            self._listen_conn.close()
+        except Exception:
+            pass
+        self._listen_conn = None
+
+    def wake(self):
+        """Look for due jobs now instead of at the next poll."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        await asyncio.to_thread(self.try_lead)
+        await self._recover()
+        await self.ensure_listening()
+        self._loop_task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        self._unlisten()
+        tasks = [self._loop_task, *self._active] if self._loop_task else list(self._active)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+        await asyncio.to_thread(self.locks.close)
+        self.is_leader = False
+
+    def status(self, state: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+        with self.session_factory() as db:
+            counts = dict(db.query(GenerationJob.state, func.count(GenerationJob.id)).group_by(GenerationJob.state).all())
+            query = db.query(GenerationJob, Subject.name).join(Subject, GenerationJob.subject_id == Subject.id)
+            if state is not None:
+                query = query.filter(GenerationJob.state == state)
+            jobs = query.order_by(GenerationJob.updated_at.desc(), GenerationJob.id.desc()).limit(limit).all()
+        return {
+            "concurrency": self.concurrency,
+            "leader": self.is_leader,
+            "running_here": len(self._active),
+            "locks_lost": self.locks_lost,
+            "listening": self._listen_conn is not None,
+            "notifications": self.notifications,
+            "counts": {state: counts.get(state, 0) for state in JOB_STATES},
+            "jobs": [
+                {
+                    "id": job.id,
+                    "subject_id": job.subject_id,
+                    "subject": subject_name,
+                    "state": job.state,
+                    "attempts": job.attempts,
+                    "next_run_at": job.next_run_at,
+                    "started_at": job.started_at,
+                    "finished_at": job.finished_at,
+                    "elapsed_s": job.elapsed_s,
+                    "last_error": job.last_error,
+                }
+                for job, subject_name in jobs
+            ]
+        }
@@ -1,7 +1,15 @@
+import asyncio
+import time
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, insert
 from models.database import Subject, Topic, Subtopic
-from generator import generate_subject_content
+from generator import agenerate_chapter_list, agenerate_chapter
+from cache import classification_cache
+from autocomplete import tag_index
+from taxonomy import taxonomy_cache
+from config import TEXTBOOK_CHAPTER_CONCURRENCY, TEXTBOOK_MAX_RETRIES
+
+RETRY_BACKOFF = 1.0  # Seconds before the first retry of a failed generation step; doubles per attempt
 
 def get_empty_subjects(db: Session) -> list:
     """
@@ -17,9 +25,14 @@ def get_empty_subjects(db: Session) -> list:
     
     return empty_subjects
 
-def add_topics_and_subtopics(db: Session, subject_name: str, content: dict):
+def add_topics_and_subtopics(db: Session, subject_name: str, content: dict, start_position: int = 0):
     """
     Add generated topics and subtopics to the database.
+    Topics are numbered from start_position in the order they appear in the content.
+
+    Rows go in as two multi-row INSERTs (topics, then subtopics, both RETURNING their ids)
+    in one transaction, rather than a flush round-trip per topic. The new rows are then
+    added to this process's tag autocomplete index.
     """
     try:
         # Get the subject from the database
@@ -27,56 +40,123 @@ def add_topics_and_subtopics(db: Session, subject_name: str, content: dict):
         if not subject:
             return False
 
-        # Process each topic in the content
+        subject_id = subject.id
         subject_data = content[subject_name]
-        for topic_name, topic_data in subject_data.items():
-            # Create new topic
-            new_topic = Topic(
-                subject_id=subject.id,
-                name=topic_name
-            )
-            db.add(new_topic)
-            db.flush()  # Get the topic ID
-
-            # Add subtopics
-            for subtopic_data in topic_data['subtopics']:
-                new_subtopic = Subtopic(
-                    topic_id=new_topic.id,
-                    name=subtopic_data['subtopic']
-                )
-                db.add(new_subtopic)
+        topic_rows = [
+            {
+                "subject_id": subject_id,
+                "name": topic_name,
+                "position": position,
+                "difficulty": topic_data.get("difficulty")
+            }
+            for position, (topic_name, topic_data) in enumerate(subject_data.items(), start_position)
+        ]
+        if topic_rows:
+            # sort_by_parameter_order: ids come back in the order of topic_rows
+            topic_ids = db.scalars(
+                insert(Topic).returning(Topic.id, sort_by_parameter_order=True),
+                topic_rows
+            ).all()
+            subtopic_rows = [
+                {
+                    "topic_id": topic_id,
+                    "name": subtopic_data['subtopic'],
+                    "difficulty": subtopic_data.get('difficulty')
+                }
+                for topic_id, topic_data in zip(topic_ids, subject_data.values())
+                for subtopic_data in topic_data['subtopics']
+            ]
+            subtopic_ids = db.scalars(
+                insert(Subtopic).returning(Subtopic.id, sort_by_parameter_order=True),
+                subtopic_rows
+            ).all() if subtopic_rows else []
 
         db.commit()
+        classification_cache.invalidate()  # Cached classifications were made against the old taxonomy
+        taxonomy_cache.invalidate()
+        if topic_rows:
+            tag_index.add(
+                [("subject", subject_id, subject_name)]
+                + [("topic", topic_id, row["name"]) for topic_id, row in zip(topic_ids, topic_rows)]
+                + [("subtopic", subtopic_id, row["name"]) for subtopic_id, row in zip(subtopic_ids, subtopic_rows)]
+            )
         return True
     except Exception as e:
         print(f"Error adding topics for {subject_name}: {str(e)}")
         db.rollback()
         return False
 
-def process_empty_subjects(db: Session):
-    """
-    Process all subjects without topics by generating content and adding it to the database.
-    """
-    empty_subjects = get_empty_subjects(db)
-    results = []
-    
-    for subject in empty_subjects:
+async def _with_retries(step, description: str, max_retries: int):
+    """Await step() until it succeeds, up to max_retries extra attempts with exponential backoff."""
+    for attempt in range(max_retries + 1):
         try:
-            # Generate content for the subject
-            content = generate_subject_content(subject.name)
-            if content:
-                # Add the generated content to the database
-                success = add_topics_and_subtopics(db, subject.name, content)
-                results.append({
-                    "subject": subject.name,
-                    "success": success
-                })
+            return await step()
         except Exception as e:
-            print(f"Error processing subject {subject.name}: {str(e)}")
-            results.append({
-                "subject": subject.name,
-                "success": False,
-                "error": str(e)
-            })
-    
-    return results
+            if attempt == max_retries:
+                raise
+            print(f"Retrying {description} after error: {str(e)}")
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+def _commit_chapter(db: Session, subject_name: str, chapter_name: str, chapter: dict, position: int) -> bool:
+    # Own session per chapter: chapters finish concurrently, each in its own transaction
+    with Session(bind=db.get_bind()) as session:
+        return add_topics_and_subtopics(session, subject_name, {subject_name: {chapter_name: chapter}}, position)
+
+def _stored_chapters(db: Session, subject_name: str) -> set:
+    with Session(bind=db.get_bind()) as session:
+        rows = session.query(Topic.name).join(Subject, Topic.subject_id == Subject.id).filter(Subject.name == subject_name)
+        return {name for (name,) in rows}
+
+async def agenerate_subject(
+    db: Session,
+    subject_name: str,
+    chapters: list = None,
+    max_concurrency: int = TEXTBOOK_CHAPTER_CONCURRENCY,
+    max_retries: int = TEXTBOOK_MAX_RETRIES
+) -> dict:
+    """
+    Generate a subject's textbook in two phases and store it chapter by chapter.
+
+    The chapter list is generated first. Then each chapter's subtopics are generated in
+    parallel, at most max_concurrency at a time, and every chapter is committed as soon as
+    it passes validation, so one bad chapter only costs a retry of that chapter.
+
+    Pass the chapter list of an earlier attempt to resume it: chapters that are already
+    stored are skipped.
+    """
+    start = time.perf_counter()
+    if chapters is None:
+        chapters = await _with_retries(
+            lambda: agenerate_chapter_list(subject_name), f"chapter list for {subject_name}", max_retries
+        )
+    stored = await asyncio.to_thread(_stored_chapters, db, subject_name)
+    pending = [(position, chapter) for position, chapter in enumerate(chapters) if chapter["chapter"] not in stored]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate(position: int, chapter: dict):
+        async with semaphore:
+            content = await _with_retries(
+                lambda: agenerate_chapter(subject_name, chapter, chapters),
+                f"chapter {chapter['chapter']} of {subject_name}",
+                max_retries
+            )
+        if not await asyncio.to_thread(_commit_chapter, db, subject_name, chapter["chapter"], content, position):
+            raise RuntimeError(f"Could not store chapter {chapter['chapter']}")
+
+    outcomes = await asyncio.gather(
+        *(generate(position, chapter) for position, chapter in pending),
+        return_exceptions=True
+    )
+    failed = []
+    for (_, chapter), outcome in zip(pending, outcomes):
+        if isinstance(outcome, Exception):
+            print(f"Error generating chapter {chapter['chapter']} of {subject_name}: {str(outcome)}")
+            failed.append(chapter["chapter"])
+    return {
+        "subject": subject_name,
+        "success": not failed,
+        "chapters": len(chapters) - len(failed),
+        "failed_chapters": failed,
+        "chapter_list": chapters,
+        "elapsed_s": round(time.perf_counter() - start, 2)
+    }
@@ -0,0 +1,261 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Deque, Dict, Optional
+from metrics import LatencyRecorder
+from config import (
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_CONCURRENCY_INTERACTIVE,
+    LLM_CONCURRENCY_CLASSIFICATION,
+    LLM_CONCURRENCY_TITLE,
+    LLM_CONCURRENCY_BACKGROUND,
+    LLM_QUEUE_TIMEOUT
+)
+
+# Highest priority first
+PRIORITIES = ("interactive", "classification", "title", "background")
+
+class LLMQueueTimeout(Exception):
+    """Raised when a call waited longer than its queue timeout for an LLM slot."""
+
+class TokenBucket:
+    """Refills continuously at `per_minute / 60` units per second up to `per_minute`. 0 means unlimited."""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.per_minute <= 0
+
+    def _refill(self, now: float):
+        self.level = min(self.per_minute, self.level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available (0 if it is now)."""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.per_minute)  # A call larger than the bucket waits for a full bucket
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.level -= min(amount, self.per_minute)
+
+    def adjust(self, amount: float):
+        """Give back (positive) or charge (negative) the difference between estimated and actual use."""
+        if not self.unlimited:
+            self.level = min(self.per_minute, self.level + amount)
+
+class Ticket:
+    """A granted or waiting request for one LLM call."""
+
+    def __init__(self, priority: str, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.tokens = tokens
+        self.used_tokens: Optional[int] = None  # Set by the caller once the real usage is known
+        self.hedges = 0  # Extra requests sent under this ticket
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def _wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+class LLMScheduler:
+    """
+    Central dispatch for LLM calls from both threads and coroutines.
+
+    Each call waits in the queue of its priority class. A call starts when its class is below
+    its concurrency cap and the request/token buckets can cover it. Classes are served strictly
+    in PRIORITIES order, and a higher class waiting on the buckets holds back the lower ones, so
+    background generation can never spend the quota live users are waiting for.
+    """
+
+    def __init__(
+        self,
+        concurrency: Optional[Dict[str, int]] = None,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+        queue_timeout: Optional[float] = LLM_QUEUE_TIMEOUT
+    ):
+        self.concurrency = concurrency or {
+            "interactive": LLM_CONCURRENCY_INTERACTIVE,
+            "classification": LLM_CONCURRENCY_CLASSIFICATION,
+            "title": LLM_CONCURRENCY_TITLE,
+            "background": LLM_CONCURRENCY_BACKGROUND,
+        }
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[Ticket]] = {priority: deque() for priority in PRIORITIES}
+        self._running = {priority: 0 for priority in PRIORITIES}
+        self._timer: Optional[threading.Timer] = None
+        self.wait_times = {priority: LatencyRecorder() for priority in PRIORITIES}
+        self.max_queued = {priority: 0 for priority in PRIORITIES}
+        self.completed = {priority: 0 for priority in PRIORITIES}
+        self.timeouts = {priority: 0 for priority in PRIORITIES}
+        self.hedges = {priority: 0 for priority in PRIORITIES}
+
+    def _timeout_for(self, priority: str) -> Optional[float]:
+        # Background generation has nobody waiting on it, so it queues for as long as it takes
+        return None if priority == "background" else self.queue_timeout
+
+    def _enqueue(self, ticket: Ticket):
+        if ticket.priority not in self._queues:
+            raise ValueError(f"Unknown LLM priority: {ticket.priority}")
+        with self._lock:
+            queue = self._queues[ticket.priority]
+            queue.append(ticket)
+            self.max_queued[ticket.priority] = max(self.max_queued[ticket.priority], len(queue))
+            self._dispatch()
+
+    def _dispatch(self):
+        """Grant queued tickets while caps and buckets allow. Caller holds the lock."""
+        now = time.monotonic()
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self._running[priority] < self.concurrency[priority]:
+                ticket = queue[0]
+                delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(ticket.tokens, now))
+                if delay > 0:
+                    self._retry_in(delay)
+                    return
+                queue.popleft()
+                self.requests.take(1)
+                self.tokens.take(ticket.tokens)
+                self._running[priority] += 1
+                ticket.granted = True
+                self.wait_times[priority].record(now - ticket.enqueued)
+                ticket._wake()
+
+    def _retry_in(self, delay: float):
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _withdraw(self, ticket: Ticket) -> bool:
+        """Remove a ticket that is still waiting. Returns False if it was granted meanwhile."""
+        with self._lock:
+            if ticket.granted:
+                return False
+            self._queues[ticket.priority].remove(ticket)
+            return True
+
+    def acquire(self, priority: str, tokens: int) -> Ticket:
+        """Block the calling thread until a slot is granted."""
+        ticket = Ticket(priority, tokens)
+        self._enqueue(ticket)
+        if not ticket.event.wait(self._timeout_for(priority)) and self._withdraw(ticket):
+            with self._lock:
+                self.timeouts[priority] += 1
+            raise LLMQueueTimeout(f"No {priority} LLM slot within {self._timeout_for(priority)}s")
+        return ticket
+
+    async def aacquire(self, priority: str, tokens: int) -> Ticket:
+        """Wait on the event loop until a slot is granted."""
+        ticket = Ticket(priority, tokens, asyncio.get_running_loop())
+        self._enqueue(ticket)
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self._timeout_for(priority))
+        except asyncio.TimeoutError:
+            if self._withdraw(ticket):
+                with self._lock:
+                    self.timeouts[priority] += 1
+                raise LLMQueueTimeout(f"No {priority} LLM slot within {self._timeout_for(priority)}s")
+        except asyncio.CancelledError:
+            if not self._withdraw(ticket):
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """Free the slot and settle the token estimate against actual use."""
+        with self._lock:
+            self._running[ticket.priority] -= 1
+            self.completed[ticket.priority] += 1
+            if ticket.used_tokens is not None:
+                self.tokens.adjust(ticket.tokens - ticket.used_tokens)
+            self._dispatch()
+
+    def charge_hedge(self, ticket: Ticket, tokens: int):
+        """
+        Charge a hedged request of `tokens` sent under an already granted ticket. It is not
+        gated, since it goes out immediately, but it spends the buckets like any other call and
+        is settled in `release` together with the ticket's own request.
+        """
+        with self._lock:
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            ticket.tokens += tokens
+            ticket.hedges += 1
+            self.hedges[ticket.priority] += 1
+
+    @contextmanager
+    def slot(self, priority: str, tokens: int):
+        ticket = self.acquire(priority, tokens)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def aslot(self, priority: str, tokens: int):
+        ticket = await self.aacquire(priority, tokens)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self.requests.wait_time(0, now)
+            self.tokens.wait_time(0, now)
+            classes = {
+                priority: {
+                    "queued": len(self._queues[priority]),
+                    "running": self._running[priority],
+                    "concurrency": self.concurrency[priority],
+                    "max_queued": self.max_queued[priority],
+                    "completed": self.completed[priority],
+                    "timeouts": self.timeouts[priority],
+                    "hedges": self.hedges[priority],
+                }
+                for priority in PRIORITIES
+            }
+            buckets = {
+                "requests_per_minute": self.requests.per_minute,
+                "requests_available": None if self.requests.unlimited else round(self.requests.level, 1),
+                "tokens_per_minute": self.tokens.per_minute,
+                "tokens_available": None if self.tokens.unlimited else round(self.tokens.level),
+            }
+        for priority in PRIORITIES:
+            classes[priority]["wait"] = self.wait_times[priority].summary()
+        return {"classes": classes, "buckets": buckets}
+
+llm_scheduler = LLMScheduler()
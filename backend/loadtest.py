@@ -0,0 +1,196 @@
+"""
+Open-loop load test for the chat API.
+
+Start the API against the fake LLM backend, then drive it at a fixed request rate:
+
+    LLM_BACKEND=fake FAKE_LLM_LATENCY=0.3 uvicorn main:app --port 8000
+    python loadtest.py --rps 20 --duration 30 --mix generate-response=1,chats=2,classify=2
+
+Requests are started on schedule whether or not earlier ones have finished, so a slow
+server shows up as growing latency instead of a lower request rate.
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from benchmark import percentile
+
+QUESTIONS = [
+    "What is the derivative of x^2?",
+    "How do eigenvalues relate to determinants?",
+    "What is the time complexity of bubble sort?",
+    "Why does quantum tunnelling happen?",
+    "How does natural selection work?",
+]
+
+class StreamError(Exception):
+    """An error event in an otherwise successful (HTTP 200) response stream."""
+
+class ScenarioStats:
+    """Latencies, time to first token and failures for one scenario."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.first_token: List[float] = []
+        self.errors = 0
+        self.error_kinds: Dict[str, int] = {}
+
+    def fail(self, kind: str):
+        self.errors += 1
+        self.error_kinds[kind] = self.error_kinds.get(kind, 0) + 1
+
+    def row(self, name: str, elapsed: float) -> str:
+        total = len(self.latencies) + self.errors
+        ms = lambda samples, pct: percentile(samples, pct) * 1000
+        line = (
+            f"{name:<20} n={total:<6} rps={total / elapsed:6.1f}  "
+            f"p50={ms(self.latencies, 50):8.1f}ms  p95={ms(self.latencies, 95):8.1f}ms  p99={ms(self.latencies, 99):8.1f}ms  "
+            f"errors={self.errors / total if total else 0:6.1%}"
+        )
+        if self.first_token:
+            line += f"  ttft p50={ms(self.first_token, 50):.1f}ms p95={ms(self.first_token, 95):.1f}ms"
+        if self.error_kinds:
+            line += f"  {self.error_kinds}"
+        return line
+
+class LoadTest:
+    def __init__(self, base_url: str, token: Optional[str] = None, timeout: float = 60.0):
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+        )
+        self.token = token
+        self.chat_id: Optional[int] = None
+        self.subjects: List[str] = []
+        self.stats: Dict[str, ScenarioStats] = {}
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    async def setup(self):
+        """Get a guest token, a chat to talk in and the subject list."""
+        if not self.token:
+            response = await self.client.post("/guest-token")
+            response.raise_for_status()
+            self.token = response.json()["access_token"]
+        response = await self.client.post("/chats/", json={"title": "Load test", "tags": []}, headers=self.headers)
+        response.raise_for_status()
+        self.chat_id = response.json()["id"]
+        response = await self.client.get("/subjects/")
+        response.raise_for_status()
+        self.subjects = [subject["name"] for subject in response.json()][:3] or ["Mathematics"]
+
+    async def _timed(self, name: str, request: Callable[[ScenarioStats, float], Awaitable[None]]):
+        stats = self.stats.setdefault(name, ScenarioStats())
+        start = time.perf_counter()
+        try:
+            await request(stats, start)
+        except httpx.HTTPStatusError as e:
+            stats.fail(str(e.response.status_code))
+        except StreamError as e:
+            stats.fail(str(e))
+        except Exception as e:
+            stats.fail(type(e).__name__)
+        else:
+            stats.latencies.append(time.perf_counter() - start)
+
+    async def generate_response(self, stats: ScenarioStats, start: float):
+        """
+        Streams Server-Sent Events rather than plain text, where provider errors are written
+        inline with a 200 status: time to first token is timed on the first delta event, and
+        an error event, or a stream that ends without done, counts as a failure.
+        """
+        body = {"chat_id": self.chat_id, "question": random.choice(QUESTIONS), "subjects": self.subjects}
+        async with self.client.stream(
+            "POST", "/generate-response/", params={"stream": "sse"}, json=body, headers=self.headers
+        ) as response:
+            response.raise_for_status()
+            events = []
+            async for line in response.aiter_lines():
+                if not line.startswith("event: "):
+                    continue
+                event = line[len("event: "):]
+                if event == "delta" and "delta" not in events:
+                    stats.first_token.append(time.perf_counter() - start)
+                events.append(event)
+        if "error" in events:
+            raise StreamError("stream error")
+        if not events or events[-1] != "done":
+            raise StreamError("stream incomplete")
+
+    async def chats(self, stats: ScenarioStats, start: float):
+        response = await self.client.get("/chats/", headers=self.headers)
+        response.raise_for_status()
+
+    async def classify(self, stats: ScenarioStats, start: float):
+        response = await self.client.post("/classify/", json={"question": random.choice(QUESTIONS)})
+        response.raise_for_status()
+
+    async def classify_subject(self, stats: ScenarioStats, start: float):
+        response = await self.client.post("/classify-subject/", json={"question": random.choice(QUESTIONS)})
+        response.raise_for_status()
+
+    SCENARIOS = {
+        "generate-response": generate_response,
+        "chats": chats,
+        "classify": classify,
+        "classify-subject": classify_subject,
+    }
+
+    async def run(self, rps: float, duration: float, mix: Dict[str, float]) -> float:
+        """Start requests at `rps` for `duration` seconds, drawing scenarios by weight from `mix`."""
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        tasks = []
+        start = time.perf_counter()
+        for i in range(int(rps * duration)):
+            delay = start + i / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = random.choices(names, weights)[0]
+            scenario = self.SCENARIOS[name].__get__(self)
+            tasks.append(asyncio.create_task(self._timed(name, scenario)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+    async def aclose(self):
+        await self.client.aclose()
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in LoadTest.SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+async def main(args):
+    random.seed(args.seed)
+    load_test = LoadTest(args.base_url, args.token)
+    try:
+        await load_test.setup()
+        elapsed = await load_test.run(args.rps, args.duration, args.mix)
+    finally:
+        await load_test.aclose()
+
+    print(f"{args.rps} rps target for {args.duration}s against {args.base_url} (took {elapsed:.1f}s)")
+    for name, stats in sorted(load_test.stats.items()):
+        print(stats.row(name, elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chat API at a fixed request rate")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("generate-response=1,chats=2,classify=2"),
+                        help="Scenario weights, e.g. generate-response=1,chats=2,classify=2,classify-subject=1")
+    parser.add_argument("--token", help="Bearer token; a guest token is created when omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,27 +1,38 @@
 from fastapi import FastAPI, HTTPException, Depends, status, Cookie, Response, Request, BackgroundTasks, Query  # Added Query
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, func, literal, select, true, union_all
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import os
+import asyncio
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from typing import List, Optional, AsyncGenerator  # Added Optional and AsyncGenerator here
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from knowledge import process_empty_subjects
-from generator import classify_question_subjects, classify_question_topics, generate_title, generate_chat_response, KnowledgeLevel, classify_question_subtopics  # Add this import
+from jobs import GenerationWorker, JOB_STATES
+from config import GENERATION_SWEEP_MINUTES, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, TAG_COUNT_LIMIT, TAG_INDEX_REFRESH_MINUTES
+from cache import classification_cache
+from autocomplete import tag_index
+from taxonomy import TaxonomySnapshot, taxonomy_cache
+from precompressed import etag_matches, negotiate_encoding
+from singleflight import llm_singleflight
+from pagination import Direction, keyset_query, keyset_page, set_cursor_headers
+from llm_scheduler import llm_scheduler
+from streaming import StreamTimings, sse_event, stream_metrics
+from generator import aclassify_question_subjects, aclassify_question_topics, agenerate_title, generate_chat_events, aupdate_chat_summary, KnowledgeLevel, aclassify_question_subtopics, aclassify_question_hierarchy, aclassify_questions_batch, init_llm_registry, get_llm_registry  # Add this import
 from pydantic import BaseModel  # Add this if not already imported
 from contextlib import asynccontextmanager
-from models.database import Base, User, Chat, Message, KnowledgeModel, Subject, Topic, Subtopic  # Added Subtopic
+from models.database import upgrade_schema, Base, User, Chat, Message, KnowledgeModel, Subject, Topic, Subtopic  # Added Subtopic
 from schemas.pydantic_models import (
      UserCreate, UserResponse, ChatBase, 
     ChatResponse, MessageCreate, MessageResponse, Token, TokenData
 )
 
 # Add this import near the top with other imports
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # Add these class definitions after other BaseModel classes
 class ChatResponseRequest(BaseModel):
@@ -65,11 +76,18 @@ load_dotenv()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup tasks
-    scheduler.add_job(process_subjects_task, 'interval', minutes=15, id='process_subjects')
+    init_llm_registry()  # Pooled LLM clients and prebuilt chains shared by all requests
+    await generation_worker.start()
+    # New subjects are picked up through the database trigger; this sweep only catches what that missed
+    scheduler.add_job(process_subjects_task, 'interval', minutes=GENERATION_SWEEP_MINUTES, id='process_subjects', next_run_time=datetime.now())
+    scheduler.add_job(refresh_tag_index, 'interval', minutes=TAG_INDEX_REFRESH_MINUTES, id='refresh_tag_index', next_run_time=datetime.now())
     scheduler.start()
     yield
     # Shutdown tasks
     scheduler.shutdown()
+    await generation_worker.stop()
+    await get_llm_registry().aclose()
+    await async_engine.dispose()
 
 app = FastAPI(title="AI Chat API", lifespan=lifespan)
 
@@ -92,8 +110,20 @@ POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "aichat")
 
 POSTGRES_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = create_engine(POSTGRES_URL)
+engine = create_engine(POSTGRES_URL)  # Sync engine: schema setup and the generation worker's threads
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+generation_worker = GenerationWorker(SessionLocal)
+
+# Async engine for the endpoints, so a query never blocks the event loop
+async_engine = create_async_engine(
+    POSTGRES_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=True
+)
+# expire_on_commit=False: objects stay readable after commit without an implicit (sync) reload
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 EXAMPLE_CHATS = [
     {
@@ -245,9 +275,9 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Change here: make auto_error=False
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
-def init_example_data(db: Session, user_id: int):
+async def init_example_data(db: AsyncSession, user_id: int):
     # Check if user already has any chats
-    if db.query(Chat).filter(Chat.user_id == user_id).first() is None:
+    if await db.scalar(select(Chat.id).where(Chat.user_id == user_id).limit(1)) is None:
         for chat_data in EXAMPLE_CHATS:
             # Create chat with user_id
             chat = Chat(
@@ -257,8 +287,7 @@ def init_example_data(db: Session, user_id: int):
                 user_id=user_id  # Add user_id
             )
             db.add(chat)
-            db.commit()
-            db.refresh(chat)
+            await db.flush()  # Get the chat ID
  
             # Add messages
             for msg_data in chat_data["messages"]:
@@ -269,18 +298,20 @@ def init_example_data(db: Session, user_id: int):
                 )
                 db.add(message)
             
-            db.commit()
+            await db.commit()
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 # Dependencies
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+async def get_taxonomy() -> TaxonomySnapshot:
+    """The current taxonomy snapshot; see taxonomy.TaxonomyCache."""
+    return await taxonomy_cache.current(AsyncSessionLocal)
 
 # Utility functions for authentication
 def verify_password(plain_password, hashed_password):
@@ -299,23 +330,23 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_user(db, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user(db: AsyncSession, username: str):
+    return await db.scalar(select(User).where(User.username == username).limit(1))
 
-def authenticate_user(db, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
     if not user:
         return False
     if not verify_password(password, user.hashed_password):
         return False
     return user
 
-async def get_or_create_guest_user(request: Request, db: Session) -> User:
+async def get_or_create_guest_user(request: Request, db: AsyncSession) -> User:
     client_ip = request.client.host
-    guest_user = db.query(User).filter(
+    guest_user = await db.scalar(select(User).where(
         User.guest_id == client_ip,
         User.is_guest == True
-    ).first()
+    ).limit(1))
 
     if not guest_user:
         guest_username = f"guest_{client_ip.replace('.', '_')}"
@@ -327,15 +358,14 @@ async def get_or_create_guest_user(request: Request, db: Session) -> User:
             disabled=False
         )
         db.add(guest_user)
-        db.commit()
-        db.refresh(guest_user)
+        await db.commit()
         
         # Initialize example chats for new guest user
-        init_example_data(db, guest_user.id)
+        await init_example_data(db, guest_user.id)
 
     return guest_user
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -349,7 +379,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user(db, username=token_data.username)
+    user = await get_user(db, username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -359,13 +389,13 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
-async def transfer_guest_data(db: Session, guest_user: User, new_user: User):
+async def transfer_guest_data(db: AsyncSession, guest_user: User, new_user: User):
     """Transfer all data from guest user to new user"""
     try:
         # Transfer knowledge models
-        knowledge_models = db.query(KnowledgeModel).filter(
+        knowledge_models = (await db.scalars(select(KnowledgeModel).where(
             KnowledgeModel.user_id == guest_user.id
-        ).all()
+        ))).all()
         
         for model in knowledge_models:
             model.user_id = new_user.id
@@ -374,11 +404,11 @@ async def transfer_guest_data(db: Session, guest_user: User, new_user: User):
         # Transfer any other user-related data here
         
         # Delete guest user
-        db.delete(guest_user)
-        db.commit()
+        await db.delete(guest_user)
+        await db.commit()
         return True
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error transferring guest data: {str(e)}")
         return False
 
@@ -386,14 +416,14 @@ async def transfer_guest_data(db: Session, guest_user: User, new_user: User):
 async def get_current_user_or_guest(
     request: Request,
     token: str = Depends(oauth2_scheme),  # Now optional
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if token:
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             username = payload.get("sub")
             if username:
-                user = db.query(User).filter(User.username == username).first()
+                user = await get_user(db, username)
                 if user:
                     return user
         except JWTError:
@@ -403,38 +433,67 @@ async def get_current_user_or_guest(
     return await get_or_create_guest_user(request, db)
 
 # Routes
+def reject_offset_paging(skip: Optional[int]):
+    """Offset paging was replaced by cursors; fail loudly instead of returning the first page again."""
+    if skip is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="skip is no longer supported; pass the X-Older-Cursor or X-Newer-Cursor header value as cursor"
+        )
+
 @app.get("/chats/", response_model=List[ChatResponse])
 async def get_chats(
     request: Request,
-    skip: int = 0,
-    limit: int = 10,
-    db: Session = Depends(get_db),
+    response: Response,
+    limit: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = None,
+    direction: Direction = "older",
+    skip: Optional[int] = Query(None, deprecated=True, description="Removed; page with cursor instead"),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_or_guest)
 ):
-    # Get chats belonging to the current user, ordered by creation time descending
-    chats = db.query(Chat).filter(
-        Chat.user_id == current_user.id
-    ).order_by(Chat.created_at.desc()).offset(skip).limit(limit).all()
+    """
+    Newest chats first. Pass X-Older-Cursor from the previous page with direction=older to
+    scroll back, or X-Newer-Cursor with direction=newer for chats created since.
+    """
+    reject_offset_paging(skip)
+    # Each chat's last message comes from a LATERAL subquery (one index probe per chat
+    # on ix_messages_chat_created), so the whole page is a single query
+    last_message = (
+        select(Message.content)
+        .where(Message.chat_id == Chat.id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(1)
+        .lateral("last_message")
+    )
+    try:
+        query = keyset_query(
+            select(Chat, last_message.c.content)
+            .outerjoin(last_message, true())
+            .where(Chat.user_id == current_user.id),
+            Chat.created_at, Chat.id, direction, cursor, limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rows, has_more = keyset_page((await db.execute(query)).all(), direction, limit, newest_first=True)
     
-    # Add last message to each chat
-    for chat in chats:
-        last_message = db.query(Message).filter(
-            Message.chat_id == chat.id
-        ).order_by(Message.created_at.desc()).first()
-        
-        if last_message:
-            text_content = next((item['value'] for item in last_message.content if item['type'] == 'text'), None)
+    chats = []
+    for chat, content in rows:
+        if content is not None:
+            text_content = next((item['value'] for item in content if item['type'] == 'text'), None)
             setattr(chat, 'lastMessage', text_content or "No text content")
         else:
             setattr(chat, 'lastMessage', "No messages yet")
+        chats.append(chat)
     
+    set_cursor_headers(response, chats, has_more, newest_first=True)
     return chats
 
 @app.post("/chats/", response_model=ChatResponse)
 async def create_chat(
     chat: ChatBase,  # Changed from ChatCreate to ChatBase
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_or_guest)
 ):
     try:
@@ -444,11 +503,10 @@ async def create_chat(
             user_id=current_user.id
         )
         db.add(db_chat)
-        db.commit()
-        db.refresh(db_chat)
+        await db.commit()
         return db_chat
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error creating chat: {str(e)}")
         raise HTTPException(
             status_code=500,
@@ -460,26 +518,40 @@ async def create_chat(
 async def get_chat_messages(
     chat_id: int,
     request: Request,
-    skip: int = 0,
-    limit: int = 50,
-    db: Session = Depends(get_db),
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    direction: Direction = "newer",
+    skip: Optional[int] = Query(None, deprecated=True, description="Removed; page with cursor instead"),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_or_guest)  # Added this line
 ):
+    """
+    Messages in conversation order. The default walks forward from the first message;
+    direction=older without a cursor returns the latest page, and X-Older-Cursor then
+    loads earlier messages as the user scrolls up.
+    """
+    reject_offset_paging(skip)
     # Verify chat belongs to user
-    chat = db.query(Chat).filter(
+    chat = await db.scalar(select(Chat).where(
         Chat.id == chat_id,
         Chat.user_id == current_user.id
-    ).first()
+    ).limit(1))
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    messages = db.query(Message).filter(Message.chat_id == chat_id).offset(skip).limit(limit).all()
+    try:
+        query = keyset_query(select(Message).where(Message.chat_id == chat_id), Message.created_at, Message.id, direction, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    messages, has_more = keyset_page((await db.scalars(query)).all(), direction, limit, newest_first=False)
+    set_cursor_headers(response, messages, has_more, newest_first=False)
     return messages
 
 @app.post("/messages/", response_model=MessageResponse)
-async def create_message(message: MessageCreate, db: Session = Depends(get_db)):
+async def create_message(message: MessageCreate, db: AsyncSession = Depends(get_db)):
     # Verify chat exists
-    chat = db.query(Chat).filter(Chat.id == message.chat_id).first()
+    chat = await db.get(Chat, message.chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
@@ -491,61 +563,98 @@ async def create_message(message: MessageCreate, db: Session = Depends(get_db)):
     )
     
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
     return db_message
 
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards so a search matches the text literally."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def tag_queries(skip: int, limit: int, search: Optional[str] = None):
+    """The /tags/ page query and its match count (capped at TAG_COUNT_LIMIT + 1), over one UNION ALL."""
+    branches = []
+    for rank, (tag_type, model) in enumerate((("subject", Subject), ("topic", Topic), ("subtopic", Subtopic))):
+        branch = select(model.id, model.name, literal(tag_type).label("type"), literal(rank).label("rank"))
+        if search:
+            branch = branch.where(model.name.ilike(f"%{escape_like(search)}%", escape="\\"))
+        branches.append(branch)
+    tags = union_all(*branches).subquery("tags")
+    # Byte order, as the name indexes are built, so the order does not depend on the database locale
+    page_query = (
+        select(tags.c.id, tags.c.name, tags.c.type)
+        .order_by(tags.c.name.collate("C"), tags.c.rank, tags.c.id)
+        .offset(skip)
+        .limit(limit)
+    )
+    count_query = select(func.count()).select_from(select(tags.c.id).limit(TAG_COUNT_LIMIT + 1).subquery())
+    return page_query, count_query
+
 @app.get("/tags/")
 async def get_tags(
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 10,
+    db: AsyncSession = Depends(get_db),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(10, ge=1, le=100),
     search: Optional[str] = Query(None)
 ):
-    # Query subjects, topics, and subtopics; filter by search if provided
-    subjects_q = db.query(Subject)
-    topics_q = db.query(Topic)
-    subtopics_q = db.query(Subtopic)
-    if search:
-        subjects_q = subjects_q.filter(Subject.name.ilike(f"%{search}%"))
-        topics_q = topics_q.filter(Topic.name.ilike(f"%{search}%"))
-        subtopics_q = subtopics_q.filter(Subtopic.name.ilike(f"%{search}%"))
-    
-    subjects = subjects_q.all()
-    topics = topics_q.all()
-    subtopics = subtopics_q.all()
-    
-    # Combine all results with type identifiers
-    tags = []
-    for subject in subjects:
-        tags.append({"id": subject.id, "name": subject.name, "type": "subject"})
-    for topic in topics:
-        tags.append({"id": topic.id, "name": topic.name, "type": "topic"})
-    for subtopic in subtopics:
-        tags.append({"id": subtopic.id, "name": subtopic.name, "type": "subtopic"})
-    
-    # Sort alphabetically and paginate
-    tags.sort(key=lambda tag: tag["name"])
-    paginated_tags = tags[skip: skip + limit]
-    total = len(tags)
-    
-    return {"total": total, "items": paginated_tags}
+    """
+    Subjects, topics and subtopics as one name-ordered list. The page and the count are each
+    a single UNION ALL query, so Postgres merges the three name indexes (or uses the trigram
+    indexes when searching) instead of every row being loaded here. Counting stops at
+    TAG_COUNT_LIMIT and is skipped when the page is not full.
+    """
+    page_query, count_query = tag_queries(skip, limit, search)
+    page = (await db.execute(page_query)).all()
+    # A short page already tells how many rows matched, unless it is empty because skip ran past them
+    if len(page) < limit and (page or skip == 0):
+        total = skip + len(page)
+    else:
+        total = await db.scalar(count_query)
+
+    return {
+        "total": min(total, TAG_COUNT_LIMIT),
+        "total_capped": total > TAG_COUNT_LIMIT,
+        "items": [{"id": tag.id, "name": tag.name, "type": tag.type} for tag in page]
+    }
+
+_tag_index_build = asyncio.Lock()
+
+def rebuild_tag_index():
+    with SessionLocal() as db:
+        tag_index.rebuild(db)
+
+async def refresh_tag_index():
+    """Rebuild the autocomplete index from the database, off the event loop."""
+    async with _tag_index_build:
+        await asyncio.to_thread(rebuild_tag_index)
+
+@app.get("/tags/suggest")
+async def suggest_tags(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+    fuzzy: bool = True
+):
+    """Autocomplete for tag search, served from the in-memory index with no database query."""
+    if not tag_index.ready:
+        async with _tag_index_build:
+            if not tag_index.ready:
+                await asyncio.to_thread(rebuild_tag_index)
+    return {"items": tag_index.suggest(q, limit, fuzzy)}
 
 @app.get("/chats/{chat_id}/notes")
-async def get_chat_notes(chat_id: int, db: Session = Depends(get_db)):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+async def get_chat_notes(chat_id: int, db: AsyncSession = Depends(get_db)):
+    chat = await db.get(Chat, chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     return {"notes": chat.notes}
 
 @app.put("/chats/{chat_id}/notes")
-async def update_chat_notes(chat_id: int, notes: str, db: Session = Depends(get_db)):
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+async def update_chat_notes(chat_id: int, notes: str, db: AsyncSession = Depends(get_db)):
+    chat = await db.get(Chat, chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
     chat.notes = notes
-    db.commit()
+    await db.commit()
     return {"status": "success"}
 
 @app.put("/chats/{chat_id}/title", response_model=ChatResponse)
@@ -553,13 +662,13 @@ async def update_chat_title(
     chat_id: int,
     request: Request,
     title: dict,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_or_guest)
 ):
-    chat = db.query(Chat).filter(
+    chat = await db.scalar(select(Chat).where(
         Chat.id == chat_id,
         Chat.user_id == current_user.id
-    ).first()
+    ).limit(1))
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
@@ -567,22 +676,21 @@ async def update_chat_title(
     try:
         chat.title = title.get('title')
         chat.updated_at = datetime.utcnow()  # Update timestamp
-        db.commit()
-        db.refresh(chat)
+        await db.commit()
         return chat
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(
+    user = await db.scalar(select(User).where(
         User.username == form_data.username,
         User.is_guest == False
-    ).first()
+    ).limit(1))
     
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
@@ -600,7 +708,7 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/users/", response_model=UserResponse)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     hashed_password = get_password_hash(user.password)
     db_user = User(
         username=user.username,
@@ -609,11 +717,10 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         hashed_password=hashed_password,
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     
     # Initialize example chats for new user
-    init_example_data(db, db_user.id)
+    await init_example_data(db, db_user.id)
     
     return db_user
 
@@ -621,14 +728,14 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
 async def register_user(
     user: UserCreate,
     guest_id: str = Cookie(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if username already exists
-    if db.query(User).filter(User.username == user.username).first():
+    if await get_user(db, user.username):
         raise HTTPException(status_code=400, detail="Username already registered")
     
     # Check if email already exists (if provided)
-    if user.email and db.query(User).filter(User.email == user.email).first():
+    if user.email and await db.scalar(select(User.id).where(User.email == user.email).limit(1)):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create new user
@@ -641,15 +748,14 @@ async def register_user(
         is_guest=False
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
 
     # If guest_id provided, try to transfer data
     if guest_id:
-        guest_user = db.query(User).filter(
+        guest_user = await db.scalar(select(User).where(
             User.guest_id == guest_id,
             User.is_guest == True
-        ).first()
+        ).limit(1))
         
         if guest_user:
             transfer_success = await transfer_guest_data(db, guest_user, new_user)
@@ -663,13 +769,13 @@ async def register_user(
 async def read_users_me(
     request: Request,
     token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         # First try to get user from token
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
-        user = db.query(User).filter(User.username == username).first()
+        user = await get_user(db, username)
         if user:
             return user
 
@@ -683,7 +789,7 @@ async def read_users_me(
 async def create_guest_token(
     request: Request,
     response: Response,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         guest_user = await get_or_create_guest_user(request, db)
@@ -702,15 +808,15 @@ async def create_guest_token(
 async def claim_guest_account(
     user: UserCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_guest:
         raise HTTPException(status_code=400, detail="Only guest accounts can be claimed")
     
     # Check if username/email already exists
-    if db.query(User).filter(User.username == user.username).first():
+    if await get_user(db, user.username):
         raise HTTPException(status_code=400, detail="Username already registered")
-    if db.query(User).filter(User.email == user.email).first():
+    if await db.scalar(select(User.id).where(User.email == user.email).limit(1)):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Update guest user with real user info
@@ -720,8 +826,7 @@ async def claim_guest_account(
     current_user.hashed_password = get_password_hash(user.password)
     current_user.is_guest = False
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
     
     return current_user
 
@@ -729,15 +834,15 @@ async def claim_guest_account(
 scheduler = AsyncIOScheduler()
 
 async def process_subjects_task():
-    """Background task to process empty subjects"""
-    db = SessionLocal()
-    """Background task to process empty subjects"""
-    db = SessionLocal()
-    try:
-        results = process_empty_subjects(db)
-        print(f"Subject processing results: {results}")
-    finally:
-        db.close()
+    """Reconciliation sweep: queue generation jobs for empty subjects the trigger did not cover"""
+    await generation_worker.ensure_listening()
+    # Every process schedules the sweep, but only the leader runs it
+    if not await asyncio.to_thread(generation_worker.try_lead):
+        return
+    queued = await asyncio.to_thread(generation_worker.enqueue_empty_subjects)
+    if queued:
+        print(f"Queued {queued} subject generation jobs")
+    generation_worker.wake()
 
 class QuestionClassificationRequest(BaseModel):
     question: str
@@ -749,14 +854,22 @@ class TopicClassificationRequest(BaseModel):
 class TitleGenerationRequest(BaseModel):
     text: str
 
+class BatchClassificationRequest(BaseModel):
+    questions: list[str]
+    batch_size: Optional[int] = Field(None, ge=1, le=100)  # Questions per LLM call; defaults to BATCH_CLASSIFICATION_SIZE
+
+class HierarchicalClassificationRequest(BaseModel):
+    question: str
+    time_budget: Optional[float] = Field(None, gt=0, le=60)  # Seconds; defaults to CLASSIFICATION_TIME_BUDGET
+
 @app.post("/generate-title/")
 async def generate_chat_title(
     request: TitleGenerationRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Generate a concise title for a question or chat content."""
     try:
-        title = generate_title(request.text)
+        title = await agenerate_title(request.text)
         
         if not title:
             raise HTTPException(
@@ -778,11 +891,11 @@ async def generate_chat_title(
 @app.post("/classify-subject/")
 async def classify_subject(
     request: QuestionClassificationRequest,
-    db: Session = Depends(get_db)
+    taxonomy: TaxonomySnapshot = Depends(get_taxonomy)
 ):
     """Classify a question to determine relevant subjects."""
     try:
-        available_subjects = [subject.name for subject in db.query(Subject).all()]
+        available_subjects = list(taxonomy.subject_names)
         
         if not available_subjects:
             raise HTTPException(
@@ -790,7 +903,7 @@ async def classify_subject(
                 detail="No subjects available in the database"
             )
         
-        relevant_subjects = classify_question_subjects(
+        relevant_subjects = await aclassify_question_subjects(
             question=request.question,
             available_subjects=available_subjects
         )
@@ -805,15 +918,58 @@ async def classify_subject(
             detail=f"Error classifying question: {str(e)}"
         )
 
+@app.post("/classify-subject/batch/")
+async def classify_subject_batch(
+    request: BatchClassificationRequest,
+    taxonomy: TaxonomySnapshot = Depends(get_taxonomy)
+):
+    """Classify many questions into relevant subjects, several questions per LLM call."""
+    try:
+        if not request.questions:
+            raise HTTPException(
+                status_code=400,
+                detail="Questions list is required"
+            )
+
+        available_subjects = list(taxonomy.subject_names)
+        if not available_subjects:
+            raise HTTPException(
+                status_code=404,
+                detail="No subjects available in the database"
+            )
+
+        options = {}
+        if request.batch_size is not None:
+            options["batch_size"] = request.batch_size
+        batch = await aclassify_questions_batch(request.questions, available_subjects, **options)
+
+        return {
+            "items": [
+                {
+                    "question": question,
+                    "relevant_subjects": subjects or [],
+                    "classified": subjects is not None
+                }
+                for question, subjects in zip(request.questions, batch["results"])
+            ],
+            "stats": batch["stats"]
+        }
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error classifying questions: {str(e)}"
+        )
+
 @app.post("/classify-topic/")
 async def classify_topic(
     request: TopicClassificationRequest,
-    db: Session = Depends(get_db)
+    taxonomy: TaxonomySnapshot = Depends(get_taxonomy)
 ):
     """Classify a question to determine relevant topics within a subject."""
     try:
-        # Get the subject from the database
-        subject = db.query(Subject).filter(Subject.name == request.subject).first()
+        subject = taxonomy.subjects_by_name.get(request.subject)
         if not subject:
             raise HTTPException(
                 status_code=404,
@@ -821,8 +977,7 @@ async def classify_topic(
             )
         
         # Get all topics for the subject
-        topics = db.query(Topic).filter(Topic.subject_id == subject.id).all()
-        available_topics = [topic.name for topic in topics]
+        available_topics = [topic.name for topic in subject.topics]
         
         if not available_topics:
             raise HTTPException(
@@ -831,7 +986,7 @@ async def classify_topic(
             )
         
         # Classify the question
-        relevant_topics = classify_question_topics(
+        relevant_topics = await aclassify_question_topics(
             question=request.question,
             subject=request.subject,
             available_topics=available_topics
@@ -853,7 +1008,7 @@ async def classify_topic(
 @app.post("/classify-subtopic/")
 async def classify_subtopic(
     request: SubtopicClassificationRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Classify a question to determine relevant subtopics within a subject."""
     try:
@@ -863,7 +1018,7 @@ async def classify_subtopic(
                 detail="Subtopics list is required"
             )
         
-        relevant_subtopics = classify_question_subtopics(
+        relevant_subtopics = await aclassify_question_subtopics(
             question=request.question,
             subject=request.subject,
             available_subtopics=request.subtopics
@@ -880,54 +1035,228 @@ async def classify_subtopic(
             detail=f"Error classifying subtopics: {str(e)}"
         )
 
+@app.post("/classify/")
+async def classify_hierarchy(
+    request: HierarchicalClassificationRequest,
+    taxonomy: TaxonomySnapshot = Depends(get_taxonomy)
+):
+    """Classify a question into relevant subjects, topics and subtopics in a single call."""
+    try:
+        if not taxonomy.subjects:
+            raise HTTPException(
+                status_code=404,
+                detail="No subjects available in the database"
+            )
+
+        options = {}
+        if request.time_budget is not None:
+            options["time_budget"] = request.time_budget
+        result = await aclassify_question_hierarchy(request.question, taxonomy.hierarchy, **options)
+
+        return {"question": request.question, **result}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error classifying question: {str(e)}"
+        )
+
+@app.get("/metrics/streaming")
+async def get_streaming_metrics():
+    """Time to first token, inter-token gap and total duration percentiles for recent streams."""
+    return {name: recorder.summary() for name, recorder in stream_metrics.items()}
+
+@app.get("/metrics/tag-index")
+async def get_tag_index_metrics():
+    """Size and age of the autocomplete index and lookup latency percentiles."""
+    return tag_index.stats()
+
+@app.get("/metrics/llm-singleflight")
+async def get_llm_singleflight_metrics():
+    """How many identical concurrent LLM calls were collapsed into a shared request."""
+    return llm_singleflight.stats()
+
+@app.get("/jobs/generation")
+async def get_generation_jobs(
+    state: Optional[str] = Query(None, description="One of: " + ", ".join(JOB_STATES)),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Subject generation jobs: counts per state and the most recently updated jobs."""
+    if state is not None and state not in JOB_STATES:
+        raise HTTPException(status_code=400, detail=f"Unknown job state: {state}")
+    return await asyncio.to_thread(generation_worker.status, state, limit)
+
+@app.get("/metrics/llm-scheduler")
+async def get_llm_scheduler_metrics():
+    """Queue depth, running calls, wait-time percentiles per priority class and remaining rate-limit budget."""
+    return llm_scheduler.stats()
+
+@app.get("/metrics/llm-providers")
+async def get_llm_provider_metrics():
+    """Per-provider latency and error history, the current primary order, and hedge/failover counts."""
+    router = get_llm_registry().router
+    if router is None:
+        return {"order": get_llm_registry().providers, "hedges": 0, "failovers": 0, "providers": {}}
+    return router.summary()
+
+@app.get("/metrics/taxonomy")
+async def get_taxonomy_metrics():
+    """Version and size of this worker's taxonomy snapshot and how often it was checked and reloaded."""
+    return taxonomy_cache.stats()
+
+@app.get("/classification-cache/stats")
+async def get_classification_cache_stats():
+    """Hit/miss/eviction counters for sizing the classification cache."""
+    return await classification_cache.astats()
+
+@app.get("/taxonomy/")
+async def get_taxonomy_tree(
+    request: Request,
+    depth: int = Query(3, ge=1, le=3),
+    subject_id: Optional[int] = None,
+    taxonomy: TaxonomySnapshot = Depends(get_taxonomy)
+):
+    """
+    The whole subject -> topic -> subtopic tree in one response, cut at `depth`
+    (1 subjects, 2 topics, 3 subtopics) and optionally limited to one subject.
+
+    The body is serialized and compressed once per taxonomy version and served with a strong
+    ETag, so a client revalidating with If-None-Match gets 304 until the taxonomy changes.
+    """
+    if subject_id is not None and subject_id not in taxonomy.subjects_by_id:
+        raise HTTPException(status_code=404, detail="Subject not found")
+    body = taxonomy.cached_tree_body(depth, subject_id)
+    if body is None:
+        # Serializing a large tree is CPU work; it happens once per taxonomy version
+        body = await asyncio.to_thread(taxonomy.tree_body, depth, subject_id)
+    encoding = body.coding_for(negotiate_encoding(request.headers.get("accept-encoding")))
+    headers = {
+        "ETag": body.etag(encoding),
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",  # Cache, but revalidate; a revalidation is a 304 with no body
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    content = body.cached(encoding)
+    if content is None:
+        # First request for this encoding since the taxonomy changed
+        content = await asyncio.to_thread(body.encode, encoding)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=content, media_type="application/json", headers=headers)
+
 @app.get("/subjects/")
-async def get_subjects(db: Session = Depends(get_db)):
+async def get_subjects(taxonomy: TaxonomySnapshot = Depends(get_taxonomy)):
     """Get all subjects."""
-    subjects = db.query(Subject).all()
-    return [{"id": subject.id, "name": subject.name} for subject in subjects]
+    return [{"id": subject.id, "name": subject.name} for subject in taxonomy.subjects]
 
 @app.get("/subjects/{subject_id}/topics/")
-async def get_topics(subject_id: int, db: Session = Depends(get_db)):
+async def get_topics(subject_id: int, taxonomy: TaxonomySnapshot = Depends(get_taxonomy)):
     """Get topics for a specific subject."""
-    topics = db.query(Topic).filter(Topic.subject_id == subject_id).all()
+    subject = taxonomy.subjects_by_id.get(subject_id)
+    topics = subject.topics if subject else ()
     if not topics:
         raise HTTPException(status_code=404, detail="No topics found for this subject")
-    return [{"id": topic.id, "name": topic.name} for topic in topics]
+    return [{"id": topic.id, "name": topic.name, "difficulty": topic.difficulty} for topic in topics]
 
 @app.get("/topics/{topic_id}/subtopics/")
-async def get_subtopics(topic_id: int, db: Session = Depends(get_db)):
+async def get_subtopics(topic_id: int, taxonomy: TaxonomySnapshot = Depends(get_taxonomy)):
     """Get subtopics for a specific topic."""
-    subtopics = db.query(Subtopic).filter(Subtopic.topic_id == topic_id).all()
+    topic = taxonomy.topics_by_id.get(topic_id)
+    subtopics = topic.subtopics if topic else ()
+    if not subtopics:
+        raise HTTPException(status_code=404, detail="No subtopics found for this topic")
+    return [{"id": subtopic.id, "name": subtopic.name, "difficulty": subtopic.difficulty} for subtopic in subtopics]
+
+@app.get("/topics/{topic_id}/subtopics/by-difficulty")
+async def get_subtopics_by_difficulty(
+    topic_id: int,
+    min_difficulty: float = Query(0.0, ge=0, le=1),
+    max_difficulty: float = Query(1.0, ge=0, le=1),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get a topic's subtopics from easiest to hardest, read in order from ix_subtopics_topic_difficulty."""
+    subtopics = (await db.scalars(select(Subtopic).where(
+        Subtopic.topic_id == topic_id,
+        Subtopic.difficulty.between(min_difficulty, max_difficulty)
+    ).order_by(Subtopic.difficulty, Subtopic.id).limit(limit))).all()
     if not subtopics:
         raise HTTPException(status_code=404, detail="No subtopics found for this topic")
-    return [{"id": subtopic.id, "name": subtopic.name} for subtopic in subtopics]
+    return [{"id": subtopic.id, "name": subtopic.name, "difficulty": subtopic.difficulty} for subtopic in subtopics]
 
 from fastapi.responses import StreamingResponse
 
 async def stream_response(
-    response_generator: AsyncGenerator[str, None]
+    events: AsyncGenerator,
+    timings: StreamTimings
 ) -> AsyncGenerator[bytes, None]:
-    """Convert the response generator to a bytes generator for streaming."""
+    """Plain-text stream: only content is written, errors inline."""
     try:
-        async for chunk in response_generator:
-            yield chunk.encode('utf-8')
+        async for event, data in events:
+            if event == "delta":
+                timings.mark_token()
+                yield data["text"].encode('utf-8')
+            elif event == "error":
+                yield data["message"].encode('utf-8')
     except Exception as e:
         print(f"Error in stream_response: {str(e)}")
         yield b"Error generating response"
+    finally:
+        timings.finish()
+
+async def stream_sse_response(
+    events: AsyncGenerator,
+    timings: StreamTimings
+) -> AsyncGenerator[bytes, None]:
+    """Server-Sent Events stream: classification, delta, message, error and a final done event."""
+    summary = None
+    try:
+        try:
+            async for event, data in events:
+                if event == "delta":
+                    timings.mark_token()
+                yield sse_event(event, data)
+        except Exception as e:
+            print(f"Error in stream_sse_response: {str(e)}")
+            yield sse_event("error", {"message": "Error generating response"})
+        summary = timings.finish()
+    finally:
+        if summary is None:
+            timings.finish()  # The client went away (GeneratorExit); aborted streams are recorded too
+    yield sse_event("done", {"timings": summary})
+
+async def update_chat_summary(chat_id: int):
+    """Background task run after a response is streamed; uses its own session."""
+    async with AsyncSessionLocal() as db:
+        try:
+            await aupdate_chat_summary(db, chat_id)
+        except Exception as e:
+            print(f"Error in update_chat_summary: {str(e)}")
 
 @app.post("/generate-response/")
 async def generate_response(
     request: ChatResponseRequest,
-    db: Session = Depends(get_db),
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    stream: str = Query("text", pattern="^(text|sse)$"),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_or_guest)
 ):
-    """Generate a streaming chat response for a specific chat."""
+    """
+    Generate a streaming chat response for a specific chat.
+
+    Streams plain text by default; `?stream=sse` (or `Accept: text/event-stream`)
+    streams typed Server-Sent Events instead.
+    """
+    timings = StreamTimings()
     try:
         # Verify chat belongs to user
-        chat = db.query(Chat).filter(
+        chat = await db.scalar(select(Chat).where(
             Chat.id == request.chat_id,
             Chat.user_id == current_user.id
-        ).first()
+        ).limit(1))
         
         if not chat:
             raise HTTPException(
@@ -948,7 +1277,7 @@ async def generate_response(
         }
         
         # Generate streaming response
-        response_stream = generate_chat_response(
+        events = generate_chat_events(
             chat_id=request.chat_id,
             db_session=db,
             question=request.question,
@@ -958,8 +1287,18 @@ async def generate_response(
             topic_knowledge={}
         )
 
+        # Older turns that fell out of the history window are summarized once the stream ends
+        background_tasks.add_task(update_chat_summary, request.chat_id)
+
+        if stream == "sse" or "text/event-stream" in http_request.headers.get("accept", ""):
+            return StreamingResponse(
+                stream_sse_response(events, timings),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
         return StreamingResponse(
-            stream_response(response_stream),
+            stream_response(events, timings),
             media_type="text/plain",
         )
     
@@ -0,0 +1,37 @@
+import math
+import threading
+from collections import deque
+from typing import Any, Dict
+
+class LatencyRecorder:
+    """Rolling window of latency samples (seconds) with percentile summaries."""
+
+    def __init__(self, window: int = 1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self._samples)
+            count = self.count
+
+        def pct(p: float) -> float:
+            if not ordered:
+                return 0.0
+            index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+            return round(ordered[index] * 1000, 2)
+
+        return {
+            "count": count,
+            "window": len(ordered),
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "p99_ms": pct(99),
+            "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+        }
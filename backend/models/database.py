@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ARRAY, JSON, DateTime, ForeignKey, Boolean, Enum, Float
+from sqlalchemy import Column, Integer, BigInteger, String, ARRAY, JSON, DateTime, ForeignKey, Boolean, Enum, Float, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -6,16 +6,24 @@ Base = declarative_base()
 
 class Chat(Base):
     __tablename__ = "chats"
+    __table_args__ = (
+        Index("ix_chats_user_created", "user_id", "created_at", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # Add this line
     title = Column(String, nullable=False)
     tags = Column(ARRAY(String))
     notes = Column(String, nullable=True)
+    summary = Column(String, nullable=True)  # Rolling summary of messages older than the history window
+    summary_message_id = Column(Integer, nullable=True)  # Last message folded into the summary
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_chat_created", "chat_id", "created_at", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id"))
     content = Column(JSON, nullable=False)
@@ -24,20 +32,58 @@ class Message(Base):
 
 class Subject(Base):
     __tablename__ = "subjects"
+    __table_args__ = (
+        Index("ix_subjects_name_c", text('name COLLATE "C"')),
+    )
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, nullable=False)
 
 class Topic(Base):
     __tablename__ = "topics"
+    __table_args__ = (
+        Index("ix_topics_name", text('name COLLATE "C"')),
+    )
     id = Column(Integer, primary_key=True, index=True)
     subject_id = Column(Integer, ForeignKey("subjects.id"))
     name = Column(String, nullable=False)
+    position = Column(Integer)  # Chapter order within the subject; chapters are committed out of order
+    difficulty = Column(Float, nullable=True)  # 0-1, as estimated at generation time
 
 class Subtopic(Base):
     __tablename__ = "subtopics"
+    __table_args__ = (
+        Index("ix_subtopics_topic_difficulty", "topic_id", "difficulty", "id"),
+        Index("ix_subtopics_name", text('name COLLATE "C"')),
+    )
     id = Column(Integer, primary_key=True, index=True)
     topic_id = Column(Integer, ForeignKey("topics.id"))
     name = Column(String, nullable=False)
+    difficulty = Column(Float, nullable=True)  # 0-1, as estimated at generation time
+
+class GenerationJob(Base):
+    """Background generation of one subject's topics; see jobs.py."""
+    __tablename__ = "generation_jobs"
+    __table_args__ = (
+        Index("ix_generation_jobs_state_next_run", "state", "next_run_at"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    subject_id = Column(Integer, ForeignKey("subjects.id"), unique=True, nullable=False)
+    state = Column(String, nullable=False, default="queued")  # queued | running | failed | done
+    attempts = Column(Integer, nullable=False, default=0)
+    next_run_at = Column(DateTime, nullable=True, default=datetime.utcnow)  # Null once failed for good
+    last_error = Column(String, nullable=True)
+    chapters = Column(JSON, nullable=True)  # Chapter list of the first attempt, reused by retries
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    elapsed_s = Column(Float, nullable=True)  # Wall-clock time of the last attempt
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class TaxonomyVersion(Base):
+    """Single row (id 1) whose version is bumped by every change to subjects, topics or subtopics; see taxonomy.py."""
+    __tablename__ = "taxonomy_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
 
 class Prerequisites(Base):
     __tablename__ = "prerequisites"
@@ -68,3 +114,72 @@ class KnowledgeModel(Base):
     p_known = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+SUBJECT_GENERATION_CHANNEL = "subject_generation"  # NOTIFY channel for newly inserted subjects
+
+# Columns and indexes added after the initial schema. create_all() only creates
+# missing tables, so existing databases are brought up to date here.
+SCHEMA_UPGRADES = [
+    "ALTER TABLE chats ADD COLUMN IF NOT EXISTS summary VARCHAR",
+    "ALTER TABLE chats ADD COLUMN IF NOT EXISTS summary_message_id INTEGER",
+    "CREATE INDEX IF NOT EXISTS ix_messages_chat_created ON messages (chat_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_chats_user_created ON chats (user_id, created_at, id)",
+    "ALTER TABLE topics ADD COLUMN IF NOT EXISTS position INTEGER",
+    "ALTER TABLE topics ADD COLUMN IF NOT EXISTS difficulty FLOAT",
+    "ALTER TABLE subtopics ADD COLUMN IF NOT EXISTS difficulty FLOAT",
+    "CREATE INDEX IF NOT EXISTS ix_subtopics_topic_difficulty ON subtopics (topic_id, difficulty, id)",
+    # /tags/ orders by name in byte order across all three tables and searches names by substring
+    'CREATE INDEX IF NOT EXISTS ix_topics_name ON topics (name COLLATE "C")',
+    'CREATE INDEX IF NOT EXISTS ix_subtopics_name ON subtopics (name COLLATE "C")',
+    'CREATE INDEX IF NOT EXISTS ix_subjects_name_c ON subjects (name COLLATE "C")',
+    """
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_subjects_name_trgm ON subjects USING gin (name gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS ix_topics_name_trgm ON topics USING gin (name gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS ix_subtopics_name_trgm ON subtopics USING gin (name gin_trgm_ops);
+    EXCEPTION WHEN insufficient_privilege OR feature_not_supported OR undefined_file THEN
+        RAISE NOTICE 'pg_trgm is not available, tag search will scan the name columns';
+    END
+    $$
+    """,
+    # New subjects queue their own generation job and wake the workers (see jobs.py)
+    f"""
+    CREATE OR REPLACE FUNCTION enqueue_subject_generation() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO generation_jobs (subject_id, state, attempts, next_run_at, created_at, updated_at)
+        VALUES (NEW.id, 'queued', 0, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc')
+        ON CONFLICT (subject_id) DO NOTHING;
+        PERFORM pg_notify('{SUBJECT_GENERATION_CHANNEL}', NEW.id::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS subjects_enqueue_generation ON subjects",
+    "CREATE TRIGGER subjects_enqueue_generation AFTER INSERT ON subjects FOR EACH ROW EXECUTE FUNCTION enqueue_subject_generation()",
+    # Any statement changing the taxonomy bumps its version in the same transaction
+    "INSERT INTO taxonomy_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING",
+    """
+    CREATE OR REPLACE FUNCTION bump_taxonomy_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE taxonomy_version SET version = version + 1 WHERE id = 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+] + [
+    statement
+    for table in ("subjects", "topics", "subtopics")
+    for statement in (
+        f"DROP TRIGGER IF EXISTS {table}_bump_taxonomy_version ON {table}",
+        f"CREATE TRIGGER {table}_bump_taxonomy_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+        "FOR EACH STATEMENT EXECUTE FUNCTION bump_taxonomy_version()",
+    )
+]
+
+def upgrade_schema(engine):
+    """Apply SCHEMA_UPGRADES; every statement is idempotent."""
+    with engine.begin() as conn:
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(text(statement))
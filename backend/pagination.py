@@ -0,0 +1,61 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Literal, Optional, Sequence, Tuple
+from sqlalchemy import Select, tuple_
+
+Direction = Literal["older", "newer"]
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Opaque cursor for a row's position in (created_at, id) order."""
+    raw = json.dumps([created_at.isoformat(), row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of encode_cursor. Raises ValueError for anything it did not produce."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+def keyset_query(query: Select, created_at, id_column, direction: Direction, cursor: Optional[str], limit: int) -> Select:
+    """
+    Restrict `query` to one page in (created_at, id) order, walking in `direction`.
+
+    Without a cursor "older" starts from the newest row and "newer" from the oldest one.
+    One row more than `limit` is fetched so keyset_page can tell whether another page follows.
+    """
+    key = tuple_(created_at, id_column)
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        query = query.where(key < position if direction == "older" else key > position)
+    if direction == "older":
+        query = query.order_by(created_at.desc(), id_column.desc())
+    else:
+        query = query.order_by(created_at.asc(), id_column.asc())
+    return query.limit(limit + 1)
+
+def keyset_page(rows: Sequence[Any], direction: Direction, limit: int, newest_first: bool) -> Tuple[List[Any], bool]:
+    """
+    Trim the extra row fetched by keyset_query and put the page in display order.
+
+    Returns the rows and whether more follow in `direction`.
+    """
+    has_more = len(rows) > limit
+    page = list(rows[:limit])
+    if (direction == "older") != newest_first:
+        page.reverse()
+    return page, has_more
+
+def set_cursor_headers(response, page: Sequence[Any], has_more: bool, newest_first: bool):
+    """
+    X-Older-Cursor / X-Newer-Cursor point past the oldest / newest row of the page and
+    X-Has-More says whether the requested direction has further rows.
+    """
+    response.headers["X-Has-More"] = "true" if has_more else "false"
+    if page:
+        oldest, newest = (page[-1], page[0]) if newest_first else (page[0], page[-1])
+        response.headers["X-Older-Cursor"] = encode_cursor(oldest.created_at, oldest.id)
+        response.headers["X-Newer-Cursor"] = encode_cursor(newest.created_at, newest.id)
@@ -0,0 +1,100 @@
+import gzip
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+from config import COMPRESSION_MIN_BYTES
+
+try:
+    import brotli  # Optional dependency; without it clients get gzip
+except ImportError:
+    brotli = None
+
+def available_encodings() -> Tuple[str, ...]:
+    """Content codings this process can produce, most compact first."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+def _accepted_codings(accept_encoding: str) -> Dict[str, float]:
+    codings: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> str:
+    """Pick "br", "gzip" or "identity" for an Accept-Encoding header, preferring the higher q and then the smaller body."""
+    codings = _accepted_codings(accept_encoding or "")
+    default = codings.get("*", 0.0)
+    best, best_quality = "identity", 0.0
+    for coding in available_encodings():
+        quality = codings.get(coding, default)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether If-None-Match names `etag`. Uses the weak comparison RFC 9110 prescribes for this header."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+class PrecompressedBody:
+    """
+    One response body kept in every encoding it has been asked for.
+
+    The strong ETag is a digest of the uncompressed bytes, suffixed with the coding, so the
+    same content gets the same tag across reloads and each encoding has its own tag as
+    RFC 9110 requires for different representations. Each encoding is compressed at most
+    once, at the highest level, since the result is served until the content changes.
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.digest = hashlib.sha256(raw).hexdigest()[:32]
+        self._lock = threading.Lock()
+        self._encoded: Dict[str, bytes] = {"identity": raw}
+
+    def coding_for(self, encoding: str) -> str:
+        """Bodies under COMPRESSION_MIN_BYTES are sent as they are."""
+        return "identity" if len(self.raw) < COMPRESSION_MIN_BYTES else encoding
+
+    def etag(self, encoding: str) -> str:
+        coding = self.coding_for(encoding)
+        return f'"{self.digest}"' if coding == "identity" else f'"{self.digest}-{coding}"'
+
+    def cached(self, encoding: str) -> Optional[bytes]:
+        return self._encoded.get(self.coding_for(encoding))
+
+    def encode(self, encoding: str) -> bytes:
+        """The body in `encoding`, compressing it on first use. Safe to call from any thread."""
+        coding = self.coding_for(encoding)
+        with self._lock:
+            body = self._encoded.get(coding)
+            if body is None:
+                if coding == "br":
+                    body = brotli.compress(self.raw, quality=11)
+                elif coding == "gzip":
+                    # mtime=0 keeps the bytes identical between processes
+                    body = gzip.compress(self.raw, compresslevel=9, mtime=0)
+                else:
+                    raise ValueError(f"Unsupported encoding: {coding}")
+                self._encoded[coding] = body
+            return body
+
+    def sizes(self) -> Dict[str, int]:
+        return {coding: len(body) for coding, body in list(self._encoded.items())}
@@ -0,0 +1,149 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from cache import hash_candidates
+from config import (
+    PREFILTER_ENABLED,
+    PREFILTER_TOP_K,
+    PREFILTER_ANSWER_THRESHOLD,
+    PREFILTER_ANSWER_MARGIN
+)
+
+N_FEATURES = 1 << 12
+NGRAM_SIZES = (3, 4)
+
+def _normalize(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+def _feature_ids(text: str) -> np.ndarray:
+    """Hashed character n-grams and whole words of a text."""
+    normalized = _normalize(text)
+    padded = f" {normalized} "
+    features = [padded[i:i + n] for n in NGRAM_SIZES for i in range(len(padded) - n + 1)]
+    features.extend(f"w:{word}" for word in normalized.split())
+    return np.fromiter(
+        (zlib.crc32(feature.encode("utf-8")) & (N_FEATURES - 1) for feature in features),
+        dtype=np.int64,
+        count=len(features)
+    )
+
+class TaxonomyIndex:
+    """
+    TF-IDF over hashed character n-grams for a list of subject/topic/subtopic names.
+
+    Ranking uses cosine similarity. `coverage` is the share of a name's features that
+    also occur in the question, which is close to 1.0 when the name is spelled out in it.
+    """
+
+    def __init__(self, names: List[str]):
+        self.names = list(names)
+        counts = np.zeros((len(self.names), N_FEATURES), dtype=np.float32)
+        rows = []
+        cols = []
+        for row, name in enumerate(self.names):
+            ids = _feature_ids(name)
+            rows.append(np.full(len(ids), row, dtype=np.int64))
+            cols.append(ids)
+        if rows:
+            np.add.at(counts, (np.concatenate(rows), np.concatenate(cols)), 1.0)
+
+        self.binary = (counts > 0).astype(np.float32)
+        self.feature_counts = np.maximum(self.binary.sum(axis=1), 1.0)
+        document_frequency = self.binary.sum(axis=0)
+        self.idf = (np.log((1.0 + len(self.names)) / (1.0 + document_frequency)) + 1.0).astype(np.float32)
+
+        weights = np.where(counts > 0, 1.0 + np.log(np.maximum(counts, 1.0)), 0.0) * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        self.vectors = (weights / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def _query(self, question: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts = np.bincount(_feature_ids(question), minlength=N_FEATURES).astype(np.float32)
+        present = (counts > 0).astype(np.float32)
+        weights = np.where(counts > 0, 1.0 + np.log(np.maximum(counts, 1.0)), 0.0) * self.idf
+        weights /= max(float(np.linalg.norm(weights)), 1e-12)
+        return weights, present
+
+    def search(self, question: str, k: int) -> List[Tuple[str, float, float]]:
+        """Top-k names as (name, cosine score, coverage), best first."""
+        if not self.names:
+            return []
+        weights, present = self._query(question)
+        scores = self.vectors @ weights
+        coverage = (self.binary @ present) / self.feature_counts
+        k = min(k, len(self.names))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.names[i], float(scores[i]), float(coverage[i])) for i in top]
+
+    def confident_match(self, question: str, threshold: float, margin: float) -> Optional[str]:
+        """The single name spelled out in the question, if it clearly beats every other name."""
+        if not self.names:
+            return None
+        _, present = self._query(question)
+        coverage = (self.binary @ present) / self.feature_counts
+        order = np.argsort(-coverage, kind="stable")
+        best = float(coverage[order[0]])
+        runner_up = float(coverage[order[1]]) if len(order) > 1 else 0.0
+        if best >= threshold and best - runner_up >= margin:
+            return self.names[order[0]]
+        return None
+
+class CandidatePrefilter:
+    """Builds and caches a TaxonomyIndex per distinct candidate list."""
+
+    def __init__(
+        self,
+        top_k: int = PREFILTER_TOP_K,
+        answer_threshold: float = PREFILTER_ANSWER_THRESHOLD,
+        answer_margin: float = PREFILTER_ANSWER_MARGIN,
+        enabled: bool = PREFILTER_ENABLED,
+        max_indexes: int = 256
+    ):
+        self.top_k = top_k
+        self.answer_threshold = answer_threshold
+        self.answer_margin = answer_margin
+        self.enabled = enabled
+        self.max_indexes = max_indexes
+        self._indexes: "OrderedDict[str, TaxonomyIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index_for(self, candidates: List[str]) -> TaxonomyIndex:
+        key = hash_candidates(candidates)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = TaxonomyIndex(sorted(set(candidates)))
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def narrow(self, question: str, candidates: List[str]) -> Tuple[List[str], Optional[List[str]]]:
+        """
+        Return (candidates for the prompt, answer). Lists of up to `top_k` names are left
+        alone: they already fit in the prompt, and the classifiers are multi-label, so a
+        single local match would drop a question's other subjects. For longer lists
+        `answer` is set when the index is confident enough that the LLM call can be
+        skipped, and otherwise the list is narrowed to the `top_k` closest names.
+        """
+        if not self.enabled or len(candidates) <= self.top_k:
+            return candidates, None
+        index = self.index_for(candidates)
+        match = index.confident_match(question, self.answer_threshold, self.answer_margin)
+        if match is not None:
+            return candidates, [match]
+        return [name for name, _, _ in index.search(question, self.top_k)], None
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+candidate_prefilter = CandidatePrefilter()
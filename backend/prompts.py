@@ -29,6 +29,37 @@ NO nonspecific chapters or subtopics like "Advanced Topics in {subject}", or "Ex
 Extensively and exhaustively outline all concepts, include detailed chapters on both advanced and fundamental concepts in {subject}. Order topics in a logical sequence, ensuring that each topic is a prerequisite for the next.
 """
 
+CHAPTER_LIST_PROMPT = """
+Generate the chapter list of a detailed, comprehensive, and accurate Text Book on {subject}. Avoid any indirectly related subjects or applications. Each chapter should cover a concise, specific concept. Start with a short introduction chapter only touching on motivations, formalism, and historical context. Do not include chapter numbers.
+
+Assign a difficulty score to each chapter on a standardized scale from 0 to 1, normalized across all subjects to ensure comparability (e.g., Algebra I chapters might range lower on the scale, whereas Quantum Field Theory chapters would be higher). Estimate these scores based on average assumed difficulty without overthinking it.
+
+NO LaTeX code in any chapter name.
+
+NO nonspecific chapters like "Advanced Topics in {subject}", or "Examples of ...", "Applications of ...", "Advanced ..." or "Conclusion".
+
+Extensively and exhaustively cover all concepts, both fundamental and advanced. Order chapters in a logical sequence, ensuring that each chapter is a prerequisite for the next.
+
+Ensure your response follows this **EXACT** JSON structure:
+
+{{"chapters": [{{"chapter": "Introduction to {subject}", "difficulty": 0.1}}, {{"chapter": "Chapter Name", "difficulty": 0.2}}]}}
+"""
+
+CHAPTER_SUBTOPICS_PROMPT = """
+You are writing the table of contents of a Text Book on {subject}. The book has these chapters, in order:
+{chapters_list}
+
+List the subtopics of the chapter "{chapter}" only. Each subtopic should be a concise, specific concept that belongs in this chapter and not in another one. Order subtopics in a logical sequence, ensuring that each is a prerequisite for the next.
+
+Assign a difficulty score to each subtopic on a standardized scale from 0 to 1, normalized across all subjects to ensure comparability. Estimate these scores based on average assumed difficulty without overthinking it.
+
+NO LaTeX code in any subtopic name. NO nonspecific subtopics like "Examples of ...", "Applications of ..." or "Summary".
+
+Ensure your response follows this **EXACT** JSON structure:
+
+{{"subtopics": [{{"subtopic": "topic1", "difficulty": 0.1}}, {{"subtopic": "topic2", "difficulty": 0.2}}]}}
+"""
+
 SUBJECT_CLASSIFICATION_PROMPT = """Given the following question and list of subjects, determine which subjects are most relevant to answering the question.
 Return your response as a JSON array of subject names. Choose only from the provided subjects.
 
@@ -55,6 +86,17 @@ Question: {question}
 Available Subtopics: {subtopics_list}"""
 
 
+BATCH_SUBJECT_CLASSIFICATION_PROMPT = """Given the following numbered questions and list of subjects, determine which subjects are most relevant to answering each question.
+Return your response as a JSON object that maps every question number to a JSON array of subject names. Choose only from the provided subjects.
+
+Response format example: {{"1": ["Mathematics", "Physics"], "2": ["Chemistry"]}}
+
+Questions:
+{questions_list}
+
+Available Subjects: {subjects_list}"""
+
+
 TITLE_GENERATION_PROMPT = """Generate a concise title (maximum 4 words) for the following question or conversation.
 The title should be descriptive but brief, focusing on the main concept or topic.
 
@@ -63,6 +105,16 @@ Response format example: {{"title": "Matrix Vector Multiplication"}}
 
 Question or Content: {text}"""
 
+HISTORY_SUMMARY_PROMPT = """Update the running summary of a tutoring conversation with the new messages below.
+Keep the concepts covered, the student's misunderstandings and level, and any open questions. Be concise (at most 200 words).
+Return only the updated summary text.
+
+Current summary: {summary}
+
+New messages:
+{messages}"""
+
+
 CHAT_JSON_RESPONSE_PROMPT = """
 You are a tutor who adapts responses according to the user's knowledge context.
 
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from metrics import LatencyRecorder
+from config import LLM_HEDGE_DELAY
+
+EWMA_ALPHA = 0.2
+ERROR_PENALTY = 5.0  # A provider failing every call scores as 6x slower than its latency
+
+class ProviderStats:
+    """Latency and error history of one provider, used to pick the primary."""
+
+    def __init__(self):
+        self.latency = LatencyRecorder()
+        self.ewma_latency: Optional[float] = None
+        self.ewma_errors = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.primary = 0  # Calls where this provider went first
+        self.wins = 0  # Hedged races this provider won
+
+    def observe(self, seconds: float, failed: bool):
+        self.ewma_errors = (1 - EWMA_ALPHA) * self.ewma_errors + EWMA_ALPHA * (1.0 if failed else 0.0)
+        if not failed:
+            self.successes += 1
+            self.latency.record(seconds)
+        else:
+            self.errors += 1
+        self._update_latency(seconds)
+
+    def observe_cancelled(self, seconds: float):
+        """A request cancelled after `seconds` took at least that long; only counts if that is slower than usual."""
+        if self.ewma_latency is None or seconds > self.ewma_latency:
+            self._update_latency(seconds)
+
+    def _update_latency(self, seconds: float):
+        if self.ewma_latency is None:
+            self.ewma_latency = seconds
+        else:
+            self.ewma_latency = (1 - EWMA_ALPHA) * self.ewma_latency + EWMA_ALPHA * seconds
+
+    def score(self) -> float:
+        # Unmeasured providers score 0 so each gets tried early
+        return (self.ewma_latency or 0.0) * (1 + ERROR_PENALTY * self.ewma_errors)
+
+class ProviderRouter:
+    """
+    Runs a chain on one of several providers that each have the same set of chains.
+
+    - Providers are tried in order of their score (EWMA latency, penalized by recent errors),
+      so the currently fastest healthy provider is the primary.
+    - An error, or a result rejected by `validate`, fails over to the next provider.
+    - With `hedge=True`, if the primary has not answered within `hedge_delay` seconds the same
+      call is also sent to the next provider, and the first valid result wins. The loser is
+      cancelled; its elapsed time counts against it if that is slower than its average.
+      `on_hedge` is called before the second request goes out, so the caller can charge it
+      against its rate limits.
+    """
+
+    def __init__(self, chains: Dict[str, Dict[str, Any]], hedge_delay: float = LLM_HEDGE_DELAY):
+        self.chains = chains  # provider -> chain name -> runnable
+        self.hedge_delay = hedge_delay
+        self.stats = {provider: ProviderStats() for provider in chains}
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.failovers = 0
+
+    @property
+    def providers(self) -> List[str]:
+        return list(self.chains)
+
+    def ranked(self) -> List[str]:
+        with self._lock:
+            return sorted(self.chains, key=lambda provider: self.stats[provider].score())
+
+    def _observe(self, provider: str, seconds: float, failed: bool):
+        with self._lock:
+            self.stats[provider].observe(seconds, failed)
+
+    def invoke(self, chain_name: str, inputs: Dict[str, Any], validate: Optional[Callable[[Any], Any]] = None):
+        """Blocking call with failover in provider order (no hedging)."""
+        order = self.ranked()
+        with self._lock:
+            self.stats[order[0]].primary += 1
+        error: Optional[BaseException] = None
+        for attempt, provider in enumerate(order):
+            if attempt:
+                with self._lock:
+                    self.failovers += 1
+            start = time.perf_counter()
+            try:
+                result = self.chains[provider][chain_name].invoke(inputs)
+                if validate is not None:
+                    validate(result)
+            except Exception as e:
+                self._observe(provider, time.perf_counter() - start, True)
+                print(f"LLM provider {provider} failed for {chain_name}: {str(e)}")
+                error = e
+                continue
+            self._observe(provider, time.perf_counter() - start, False)
+            return result
+        raise error
+
+    async def ainvoke(
+        self,
+        chain_name: str,
+        inputs: Dict[str, Any],
+        validate: Optional[Callable[[Any], Any]] = None,
+        hedge: bool = False,
+        on_hedge: Optional[Callable[[], None]] = None
+    ):
+        """Async call with failover and, optionally, a hedged second request."""
+        order = self.ranked()
+        with self._lock:
+            self.stats[order[0]].primary += 1
+        running: Dict[asyncio.Task, tuple] = {}
+        error: Optional[BaseException] = None
+        next_index = 0
+        hedged = False
+
+        def launch():
+            nonlocal next_index
+            provider = order[next_index]
+            next_index += 1
+            task = asyncio.ensure_future(self.chains[provider][chain_name].ainvoke(inputs))
+            running[task] = (provider, time.perf_counter())
+
+        launch()
+        try:
+            while running:
+                can_hedge = hedge and not hedged and next_index < len(order)
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    with self._lock:
+                        self.hedges += 1
+                    hedged = True
+                    if on_hedge is not None:
+                        on_hedge()
+                    launch()
+                    continue
+
+                for task in done:
+                    provider, start = running.pop(task)
+                    elapsed = time.perf_counter() - start
+                    try:
+                        result = task.result()
+                        if validate is not None:
+                            validate(result)
+                    except Exception as e:
+                        self._observe(provider, elapsed, True)
+                        print(f"LLM provider {provider} failed for {chain_name}: {str(e)}")
+                        error = e
+                        continue
+                    self._observe(provider, elapsed, False)
+                    if hedged:
+                        with self._lock:
+                            self.stats[provider].wins += 1
+                    return result
+
+                if not running and next_index < len(order):
+                    with self._lock:
+                        self.failovers += 1
+                    launch()
+            raise error
+        finally:
+            for task, (provider, start) in running.items():
+                task.cancel()
+                with self._lock:
+                    self.stats[provider].observe_cancelled(time.perf_counter() - start)
+            if running:
+                # Let the losers unwind so their connections go back to the pool
+                await asyncio.gather(*running, return_exceptions=True)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            providers = {
+                provider: {
+                    "score": round(stats.score(), 4),
+                    "ewma_latency_ms": round(stats.ewma_latency * 1000, 2) if stats.ewma_latency is not None else None,
+                    "ewma_error_rate": round(stats.ewma_errors, 3),
+                    "successes": stats.successes,
+                    "errors": stats.errors,
+                    "primary": stats.primary,
+                    "hedge_wins": stats.wins,
+                }
+                for provider, stats in self.stats.items()
+            }
+            hedges, failovers = self.hedges, self.failovers
+        for provider, stats in self.stats.items():
+            providers[provider]["latency"] = stats.latency.summary()
+        return {
+            "order": self.ranked(),
+            "hedge_delay_s": self.hedge_delay,
+            "hedges": hedges,
+            "failovers": failovers,
+            "providers": providers,
+        }
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from config import SINGLE_FLIGHT_ENABLED
+
+class _Call:
+    """One in-flight sync call shared by every thread asking for the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+class _AsyncCall:
+    """One in-flight task shared by every coroutine asking for the same key."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first caller for a key runs the work,
+    callers arriving while it is in flight wait for and share its result.
+
+    - An exception is raised to every caller of that flight; nothing is cached, so the
+      next call after it finishes starts a fresh one.
+    - Async callers share a task. A caller that is cancelled only stops waiting; the
+      task itself is cancelled once no caller is left waiting for it.
+    """
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._sync: Dict[str, _Call] = {}
+        self._async: Dict[Tuple[asyncio.AbstractEventLoop, str], _AsyncCall] = {}
+        self.calls = 0
+        self.executed = 0
+        self.collapsed = 0
+        self.errors = 0
+        self.abandoned = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run fn once for all threads calling with the same key at the same time."""
+        if not self.enabled:
+            return fn()
+
+        with self._lock:
+            self.calls += 1
+            call = self._sync.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._sync[key] = call
+                self.executed += 1
+            else:
+                self.collapsed += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    del self._sync[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await fn() once for all coroutines on this event loop calling with the same key."""
+        if not self.enabled:
+            return await fn()
+
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        with self._lock:
+            self.calls += 1
+            call = self._async.get(flight_key)
+            if call is None:
+                call = _AsyncCall(loop.create_task(fn()))
+                self._async[flight_key] = call
+                call.task.add_done_callback(lambda task: self._finish(flight_key, call))
+                self.executed += 1
+            else:
+                self.collapsed += 1
+            call.waiters += 1
+
+        try:
+            # shield: cancelling one caller must not cancel the work the others wait for
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                with self._lock:
+                    self.abandoned += 1
+
+    def _finish(self, flight_key: Tuple[asyncio.AbstractEventLoop, str], call: _AsyncCall):
+        with self._lock:
+            if self._async.get(flight_key) is call:
+                del self._async[flight_key]
+            if not call.task.cancelled() and call.task.exception() is not None:
+                self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "calls": self.calls,
+                "executed": self.executed,
+                "collapsed": self.collapsed,
+                "errors": self.errors,
+                "abandoned": self.abandoned,
+                "in_flight": len(self._sync) + len(self._async),
+            }
+
+llm_singleflight = SingleFlight()
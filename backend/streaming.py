@@ -0,0 +1,220 @@
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional
+from metrics import LatencyRecorder
+
+SENTENCE_ENDINGS = ".!?:;"
+FENCE_LANGUAGE = "json"
+SPECIAL_CHARACTER = re.compile(r"[\n`$]")
+SENTENCE_ENDING = re.compile(r"[.!?:;]")
+
+class StreamNormalizer:
+    """
+    Incremental cleanup of streamed LLM text, equivalent to running
+    `clean_llm_response` on every line but touching each character once.
+
+    - drops ``` and ```json code-fence markers
+    - collapses whitespace runs to one space and trims each line
+    - drops lines left empty
+    - holds `$...$` / `$$...$$` math until it closes, so a client never renders half a block
+      (up to `max_math_hold` characters, then it is released anyway)
+
+    `feed` returns whatever is safe to send once a line or sentence ends or at least
+    `min_emit` characters are ready, which bounds how long text waits in the buffer.
+    """
+
+    def __init__(self, min_emit: int = 32, max_math_hold: int = 4096):
+        self.min_emit = min_emit
+        self.max_math_hold = max_math_hold
+        self._buf: List[str] = []
+        self._safe = 0  # Items of _buf that are outside any open math block
+        self._buf_chars = 0
+        self._safe_chars = 0
+        self._boundary = False
+        self._line_has_content = False
+        self._pending_space = False
+        self._backticks = 0
+        self._fence_tail = None  # Characters seen right after a fence, while they still match "json"
+        self._pending_dollar = False
+        self._math = None  # None, "inline" or "display"
+
+    def _mark_safe(self):
+        self._safe = len(self._buf)
+        self._safe_chars = self._buf_chars
+
+    def _append(self, text: str):
+        self._buf.append(text)
+        self._buf_chars += len(text)
+        if self._math is None or self._buf_chars - self._safe_chars > self.max_math_hold:
+            self._mark_safe()
+
+    def _content(self, text: str):
+        if self._pending_space:
+            self._append(" ")
+            self._pending_space = False
+        self._append(text)
+        self._line_has_content = True
+
+    def _toggle_math(self, kind: str):
+        if self._math is None:
+            self._math = kind  # Set first so the opening delimiter is held with the block
+            self._content("$$" if kind == "display" else "$")
+        elif self._math == kind:
+            self._content("$$" if kind == "display" else "$")
+            self._math = None
+            self._mark_safe()
+            self._boundary = True
+        else:
+            # "$$" inside inline math or "$" inside display math is plain content
+            self._content("$$" if kind == "display" else "$")
+
+    def _release_pending(self):
+        """Resolve lookahead state when the next character can't extend it."""
+        if self._backticks:
+            count, self._backticks = self._backticks, 0
+            self._content("`" * count)
+        if self._pending_dollar:
+            self._pending_dollar = False
+            self._toggle_math("inline")
+
+    def _char(self, c: str):
+        if self._fence_tail is not None:
+            tail = self._fence_tail + c
+            if FENCE_LANGUAGE.startswith(tail):
+                self._fence_tail = None if tail == FENCE_LANGUAGE else tail
+                return
+            self._fence_tail = None
+            for ch in tail:
+                self._char(ch)
+            return
+
+        if c == "`":
+            if self._pending_dollar:
+                self._release_pending()
+            self._backticks += 1
+            if self._backticks == 3:
+                self._backticks = 0
+                self._fence_tail = ""
+            return
+
+        if c == "$":
+            if self._backticks:
+                self._release_pending()
+            if self._pending_dollar:
+                self._pending_dollar = False
+                self._toggle_math("display")
+            else:
+                self._pending_dollar = True
+            return
+
+        self._release_pending()
+
+        if c == "\n":
+            self._pending_space = False
+            if self._math == "inline":
+                # Unclosed inline math never spans lines
+                self._math = None
+                self._mark_safe()
+            if self._line_has_content:
+                self._append("\n")
+                self._line_has_content = False
+            self._boundary = True
+        elif c.isspace():
+            if self._line_has_content:
+                self._pending_space = True
+        else:
+            self._content(c)
+            if c in SENTENCE_ENDINGS and self._math is None:
+                self._boundary = True
+
+    def _plain(self, text: str):
+        """Fast path for a chunk with no newlines, backticks or dollars: split on whitespace."""
+        self._release_pending()
+        if text[:1].isspace() and self._line_has_content:
+            self._pending_space = True
+        words = text.split()
+        for i, word in enumerate(words):
+            if i:
+                self._pending_space = True
+            self._content(word)
+        if words and text[-1:].isspace():
+            self._pending_space = True
+        if self._math is None and SENTENCE_ENDING.search(text):
+            self._boundary = True
+
+    def _emit(self) -> str:
+        out = "".join(self._buf[:self._safe])
+        del self._buf[:self._safe]
+        self._buf_chars -= self._safe_chars
+        self._safe = 0
+        self._safe_chars = 0
+        self._boundary = False
+        return out
+
+    def feed(self, text: str) -> str:
+        """Consume a chunk and return the text that is ready to send (possibly empty)."""
+        if self._fence_tail is None and not SPECIAL_CHARACTER.search(text):
+            self._plain(text)
+        else:
+            for c in text:
+                self._char(c)
+        if self._safe and (self._boundary or self._safe_chars >= self.min_emit):
+            return self._emit()
+        return ""
+
+    def flush(self) -> str:
+        """Return everything still buffered at the end of the stream."""
+        if self._fence_tail:
+            tail, self._fence_tail = self._fence_tail, None
+            for ch in tail:
+                self._char(ch)
+        self._fence_tail = None
+        self._release_pending()
+        self._mark_safe()
+        return self._emit()
+
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+stream_metrics = {
+    "time_to_first_token": LatencyRecorder(),
+    "inter_token_gap": LatencyRecorder(window=10000),
+    "total_duration": LatencyRecorder(),
+}
+
+class StreamTimings:
+    """Server-side timings for one streamed response, measured from when the request was accepted."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.max_gap = 0.0
+        self.tokens = 0
+
+    def mark_token(self):
+        """Call whenever a piece of content is written to the client."""
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+            stream_metrics["time_to_first_token"].record(now - self.start)
+        else:
+            gap = now - self.last_token
+            self.max_gap = max(self.max_gap, gap)
+            stream_metrics["inter_token_gap"].record(gap)
+        self.last_token = now
+        self.tokens += 1
+
+    def finish(self) -> Dict[str, Any]:
+        """Record the total duration and return this stream's timings in milliseconds."""
+        total = time.perf_counter() - self.start
+        stream_metrics["total_duration"].record(total)
+        return {
+            "time_to_first_token_ms": round((self.first_token - self.start) * 1000, 2) if self.first_token else None,
+            "max_inter_token_gap_ms": round(self.max_gap * 1000, 2),
+            "total_ms": round(total * 1000, 2),
+            "deltas": self.tokens,
+        }
@@ -0,0 +1,201 @@
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI-compatible /chat/completions and Anthropic-compatible /messages handler
+    returning a canned reply after a simulated delay.
+    """
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, so pooled clients can reuse connections
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.stats_lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.stats_lock:
+            self.server.requests += 1
+            draw = self.server.rng.random()
+            failed = self.server.rng.random() < self.server.error_rate
+
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in payload.get("messages", []))
+        delay = self.server.latency + self.server.latency_per_token * prompt_chars / 4
+        if draw < self.server.tail_rate:
+            delay += self.server.tail_latency
+        if delay:
+            time.sleep(delay)
+
+        if failed:
+            body = {"type": "error", "error": {"type": "api_error", "message": "Injected stub failure"}}
+            encoded = json.dumps(body).encode("utf-8")
+            self.send_response(500)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+            return
+
+        if self.path.rstrip("/").endswith("/messages"):
+            self._anthropic(payload)
+            return
+
+        reply = self.server.reply
+        model = payload.get("model", "stub")
+        created = int(time.time())
+
+        if payload.get("stream"):
+            events = []
+            for i in range(0, len(reply), self.server.chunk_size):
+                chunk = {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": reply[i:i + self.server.chunk_size]}, "finish_reason": None}],
+                }
+                events.append(f"data: {json.dumps(chunk)}\n\n")
+            done = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            events.append(f"data: {json.dumps(done)}\n\n")
+            events.append("data: [DONE]\n\n")
+            self._send("".join(events).encode("utf-8"), "text/event-stream")
+        else:
+            body = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+            self._send(json.dumps(body).encode("utf-8"), "application/json")
+
+    def _anthropic(self, payload: dict):
+        """Anthropic Messages API response, streamed as typed SSE events when asked to."""
+        reply = self.server.reply
+        message = {
+            "id": "msg_stub",
+            "type": "message",
+            "role": "assistant",
+            "model": payload.get("model", "stub"),
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": 0, "output_tokens": 0},
+        }
+
+        if payload.get("stream"):
+            events = [
+                ("message_start", {"type": "message_start", "message": message}),
+                ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+            ]
+            for i in range(0, len(reply), self.server.chunk_size):
+                events.append(("content_block_delta", {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": reply[i:i + self.server.chunk_size]},
+                }))
+            events.extend([
+                ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": 0}}),
+                ("message_stop", {"type": "message_stop"}),
+            ])
+            body = "".join(f"event: {event}\ndata: {json.dumps(data)}\n\n" for event, data in events)
+            self._send(body.encode("utf-8"), "text/event-stream")
+        else:
+            message.update({"content": [{"type": "text", "text": reply}], "stop_reason": "end_turn"})
+            self._send(json.dumps(message).encode("utf-8"), "application/json")
+
+class StubLLMServer(ThreadingHTTPServer):
+    """Local LLM stand-in for benchmarks. Counts accepted connections and requests."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        reply: str = '["Mathematics"]',
+        latency: float = 0.0,
+        chunk_size: int = 16,
+        latency_per_token: float = 0.0,
+        tail_rate: float = 0.0,
+        tail_latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0
+    ):
+        super().__init__((host, port), StubLLMHandler)
+        self.reply = reply
+        self.latency = latency
+        self.latency_per_token = latency_per_token  # Simulated prefill cost per prompt token (~4 chars)
+        self.chunk_size = chunk_size
+        self.tail_rate = tail_rate  # Share of requests that take an extra tail_latency seconds
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate  # Share of requests answered with HTTP 500
+        self.rng = random.Random(seed)
+        self.connections = 0
+        self.requests = 0
+        self.stats_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        """Base URL for OpenAI clients."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def anthropic_base_url(self) -> str:
+        """Base URL for Anthropic clients, which add /v1 themselves."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubLLMServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Hedged or cancelled requests hang up before the reply is written
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.connections = 0
+            self.requests = 0
+
+if __name__ == "__main__":
+    server = StubLLMServer(port=8001)
+    print(f"Stub LLM server listening on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+from sqlalchemy import select
+from models.database import Subject, Topic, Subtopic, TaxonomyVersion
+from config import TAXONOMY_VERSION_CHECK_SECONDS
+from precompressed import PrecompressedBody
+from cache import classification_cache
+
+TREE_DEPTHS = {1: "subjects", 2: "topics", 3: "subtopics"}
+
+class SubtopicNode(NamedTuple):
+    id: int
+    topic_id: int
+    name: str
+    difficulty: Optional[float]
+
+class TopicNode(NamedTuple):
+    id: int
+    subject_id: int
+    name: str
+    position: Optional[int]
+    difficulty: Optional[float]
+    subtopics: Tuple[SubtopicNode, ...]
+
+class SubjectNode(NamedTuple):
+    id: int
+    name: str
+    topics: Tuple[TopicNode, ...]
+
+class TaxonomySnapshot:
+    """
+    Immutable subject -> topic -> subtopic tree as of one taxonomy version, with lookups by
+    id and by name. Nodes are tuples and indexes are read-only mappings, so a snapshot can
+    be shared by every request without copying; a newer version is a new snapshot.
+    """
+
+    def __init__(self, version: int, subjects: Tuple[SubjectNode, ...]):
+        self.version = version
+        self.subjects = subjects
+        self.subjects_by_id: Mapping[int, SubjectNode] = MappingProxyType({subject.id: subject for subject in subjects})
+        self.subjects_by_name: Mapping[str, SubjectNode] = MappingProxyType({subject.name: subject for subject in subjects})
+        topics = [topic for subject in subjects for topic in subject.topics]
+        self.topics_by_id: Mapping[int, TopicNode] = MappingProxyType({topic.id: topic for topic in topics})
+        self.subtopics_by_id: Mapping[int, SubtopicNode] = MappingProxyType({
+            subtopic.id: subtopic for topic in topics for subtopic in topic.subtopics
+        })
+        self.subject_names: Tuple[str, ...] = tuple(subject.name for subject in subjects)
+        # subject name -> topic name -> subtopic names, the shape the hierarchical classifier takes
+        self.hierarchy: Dict[str, Dict[str, List[str]]] = {
+            subject.name: {topic.name: [subtopic.name for subtopic in topic.subtopics] for topic in subject.topics}
+            for subject in subjects
+        }
+        self.loaded_at = time.time()
+        self._tree_lock = threading.Lock()
+        self._tree_bodies: Dict[Tuple[int, Optional[int]], PrecompressedBody] = {}
+
+    @classmethod
+    def build(cls, version: int, subject_rows, topic_rows, subtopic_rows) -> "TaxonomySnapshot":
+        """Assemble the tree from (id, name), (id, subject_id, name, position, difficulty) and (id, topic_id, name, difficulty) rows."""
+        subtopics: Dict[int, List[SubtopicNode]] = {}
+        for row in subtopic_rows:
+            subtopics.setdefault(row[1], []).append(SubtopicNode(*row))
+        topics: Dict[int, List[TopicNode]] = {}
+        for row in topic_rows:
+            topics.setdefault(row[1], []).append(TopicNode(*row, tuple(subtopics.get(row[0], ()))))
+        return cls(version, tuple(
+            SubjectNode(subject_id, name, tuple(topics.get(subject_id, ()))) for subject_id, name in subject_rows
+        ))
+
+    def tree(self, depth: int = 3, subject_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        The nested tree as plain JSON data, down to subjects (1), topics (2) or subtopics (3),
+        for every subject or only `subject_id`. Raises KeyError for an unknown subject.
+        """
+        if depth not in TREE_DEPTHS:
+            raise ValueError(f"depth must be one of {sorted(TREE_DEPTHS)}")
+        subjects = self.subjects if subject_id is None else (self.subjects_by_id[subject_id],)
+
+        def topic_data(topic: TopicNode) -> Dict[str, Any]:
+            data = {"id": topic.id, "name": topic.name, "difficulty": topic.difficulty}
+            if depth >= 3:
+                data["subtopics"] = [
+                    {"id": subtopic.id, "name": subtopic.name, "difficulty": subtopic.difficulty}
+                    for subtopic in topic.subtopics
+                ]
+            return data
+
+        def subject_data(subject: SubjectNode) -> Dict[str, Any]:
+            data = {"id": subject.id, "name": subject.name}
+            if depth >= 2:
+                data["topics"] = [topic_data(topic) for topic in subject.topics]
+            return data
+
+        return {"version": self.version, "depth": depth, "subjects": [subject_data(subject) for subject in subjects]}
+
+    def cached_tree_body(self, depth: int = 3, subject_id: Optional[int] = None) -> Optional[PrecompressedBody]:
+        return self._tree_bodies.get((depth, subject_id))
+
+    def tree_body(self, depth: int = 3, subject_id: Optional[int] = None) -> PrecompressedBody:
+        """tree() serialized once per snapshot; the body then keeps its compressed forms too."""
+        key = (depth, subject_id)
+        body = self._tree_bodies.get(key)
+        if body is None:
+            with self._tree_lock:
+                body = self._tree_bodies.get(key)
+                if body is None:
+                    raw = json.dumps(self.tree(depth, subject_id), separators=(",", ":"), ensure_ascii=False).encode()
+                    body = self._tree_bodies[key] = PrecompressedBody(raw)
+        return body
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "subjects": len(self.subjects_by_id),
+            "topics": len(self.topics_by_id),
+            "subtopics": len(self.subtopics_by_id),
+            "tree_bodies": {
+                f"depth={depth},subject={subject_id}": body.sizes()
+                for (depth, subject_id), body in list(self._tree_bodies.items())
+            },
+        }
+
+class TaxonomyCache:
+    """
+    Holds the current TaxonomySnapshot for this process.
+
+    Triggers on the taxonomy tables bump taxonomy_version.version in the same transaction
+    as the change, so comparing it with the snapshot's version tells every worker whether
+    its copy is current. current() checks at most every `check_interval` seconds, and a
+    reload reads the version and the three tables in one REPEATABLE READ transaction, so a
+    snapshot is never ahead of or behind its version number. The new snapshot replaces the
+    old one with a single assignment; requests already holding the old one keep a consistent
+    tree. invalidate() forces the next call to check, for changes committed in this process.
+    """
+
+    def __init__(self, check_interval: float = TAXONOMY_VERSION_CHECK_SECONDS):
+        self.check_interval = check_interval
+        self._snapshot: Optional[TaxonomySnapshot] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self.checks = 0
+        self.reloads = 0
+
+    def invalidate(self):
+        """Check the version on the next call. Safe to call from any thread."""
+        self._checked_at = 0.0
+
+    async def current(self, session_factory) -> TaxonomySnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return snapshot
+        async with self._lock:
+            # Another request may have checked while this one waited
+            if self._snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._snapshot
+            checked_at = time.monotonic()
+            async with session_factory() as db:
+                version = await db.scalar(select(TaxonomyVersion.version).where(TaxonomyVersion.id == 1))
+                self.checks += 1
+                if self._snapshot is None or version != self._snapshot.version:
+                    await db.rollback()
+                    self._snapshot = await self._load(db)
+                    self.reloads += 1
+                    # Other workers' cached classifications are left behind by version, not cleared
+                    classification_cache.observe_taxonomy_version(self._snapshot.version)
+            self._checked_at = checked_at
+            return self._snapshot
+
+    async def _load(self, db) -> TaxonomySnapshot:
+        await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        version = await db.scalar(select(TaxonomyVersion.version).where(TaxonomyVersion.id == 1))
+        subject_rows = (await db.execute(select(Subject.id, Subject.name).order_by(Subject.id))).all()
+        topic_rows = (await db.execute(
+            select(Topic.id, Topic.subject_id, Topic.name, Topic.position, Topic.difficulty)
+            .order_by(Topic.subject_id, Topic.position, Topic.id)
+        )).all()
+        subtopic_rows = (await db.execute(
+            select(Subtopic.id, Subtopic.topic_id, Subtopic.name, Subtopic.difficulty).order_by(Subtopic.topic_id, Subtopic.id)
+        )).all()
+        await db.rollback()
+        # Building the tree is plain CPU work; keep it off the event loop for large taxonomies
+        return await asyncio.to_thread(TaxonomySnapshot.build, version or 0, subject_rows, topic_rows, subtopic_rows)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "check_interval_s": self.check_interval,
+            "checks": self.checks,
+            "reloads": self.reloads,
+            "snapshot": self._snapshot.stats() if self._snapshot is not None else None,
+        }
+
+taxonomy_cache = TaxonomyCache()
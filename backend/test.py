@@ -1,10 +1,24 @@
 from prompts import TOPIC_GENERATION_PROMPT
-from generator import generate_subject_content, classify_question_subjects, classify_question_subtopics
+from generator import classify_question_subjects, classify_question_subtopics
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from generator import generate_chat_response, KnowledgeLevel
+import generator
+from generator import aclassify_question_subjects, agenerate_title, clean_llm_response
+from singleflight import llm_singleflight
+from fake_llm import FakeChatModel, FakeLLMError
+from llm_scheduler import LLMScheduler
+from stub_llm_server import StubLLMServer
+from streaming import StreamNormalizer
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
 import asyncio
 import aiohttp
+import json
+import os
+import pytest
+import time
+import warnings
 from typing import AsyncGenerator
 
 def test_prompt(subject: str):
@@ -32,11 +46,11 @@ def find_hardest_subtopic(data):
     
     return (hardest_topic[0], hardest_subtopic['subtopic'], hardest_subtopic['difficulty'])
 
-POSTGRES_USER = "postgres"
-POSTGRES_PASSWORD = "Igloo!23"
-POSTGRES_HOST = "localhost"
-POSTGRES_PORT = "5432"
-POSTGRES_DB = "aichat"
+POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "Igloo!23")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
+POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+POSTGRES_DB = os.getenv("POSTGRES_DB", "aichat")
 POSTGRES_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 engine = create_engine(POSTGRES_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -103,16 +117,1134 @@ def test_classify_subtopic():
     result = classify_question_subtopics(question, subject, subtopics)
     print("Relevant subtopics:", result)
 
+@pytest.fixture
+def use_llm():
+    """
+    Install fake LLMs for one test: use_llm(model) swaps in a registry around `model`.
+    Afterwards the original registry is put back as it was (building a default one needs a
+    real OpenAI key) and the fake registries are closed.
+    """
+    with generator._registry_lock:
+        original = generator._registry
+    installed = []
+
+    def install(llm):
+        registry = generator.LLMRegistry(llm=llm)
+        with generator._registry_lock:
+            generator._registry = registry
+        installed.append(registry)
+        return registry
+
+    yield install
+    with generator._registry_lock:
+        generator._registry = original
+    for registry in installed:
+        asyncio.run(registry.aclose())
+
+def make_slow_fake_llm(latency: float, reply: str, calls: list = None):
+    """Fake LLM runnable that answers with a fixed reply after `latency` seconds, recording prompts in `calls`."""
+    calls = [] if calls is None else calls
+
+    def invoke(prompt):
+        calls.append(prompt)
+        time.sleep(latency)
+        return AIMessage(content=reply)
+
+    async def ainvoke(prompt):
+        calls.append(prompt)
+        await asyncio.sleep(latency)
+        return AIMessage(content=reply)
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+def test_async_classification_concurrency(use_llm):
+    """
+    N parallel classifications against a slow fake LLM should finish in about
+    one LLM latency, since ainvoke never blocks the event loop.
+    """
+    from llm_scheduler import llm_scheduler
+
+    latency = 0.5
+    parallel = min(20, llm_scheduler.concurrency["classification"])  # One wave through the scheduler
+    calls = []
+    use_llm(make_slow_fake_llm(latency, '["Computer Science"]', calls))
+    subjects = ["Quantum Mechanics", "Linear Algebra", "Computer Science"]
+    # Distinct questions, so neither single-flight nor the classification cache can share a call
+    questions = [f"What is the time complexity of sorting {n} numbers? ({time.time_ns()})" for n in range(parallel)]
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            aclassify_question_subjects(question, subjects)
+            for question in questions
+        ])
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(run())
+
+    print(f"{parallel} parallel classifications took {elapsed:.2f}s (LLM latency {latency}s)")
+    assert all(result == ["Computer Science"] for result in results)
+    assert len(calls) == parallel
+    assert elapsed < latency * 2
+
+def test_batch_classification_retries_only_failed_items(use_llm):
+    """Questions are packed batch_size per prompt; items a reply drops or garbles are re-sent, the rest are kept."""
+    import re
+    from generator import aclassify_questions_batch
+
+    subjects = ["Physics", "Chemistry", "Biology"]
+    stamp = time.time_ns()
+    questions = [f"Question {n} about {subject.lower()} ({stamp})" for n, subject in enumerate(subjects + subjects[:2])]
+    expected = [[subject] for subject in subjects + subjects[:2]]
+    sent = []  # Questions in each prompt, in the order the prompts were sent
+
+    async def ainvoke(prompt):
+        numbered = re.findall(r"^(\d+)\. (.+)$", prompt.to_string(), re.MULTILINE)
+        sent.append([question for _, question in numbered])
+        first_try = len(sent) <= 3  # The retry round starts after all three first-round batches
+        reply = {}
+        for number, question in numbered:
+            index = questions.index(question)
+            if first_try and index == 1:
+                reply[number] = "Chemistry"  # Not a list
+            elif first_try and index == 2:
+                continue  # Missing
+            else:
+                reply[number] = expected[index] + ["Astrology"]  # Unknown names are dropped
+        return AIMessage(content=json.dumps(reply))
+
+    use_llm(RunnableLambda(lambda prompt: None, afunc=ainvoke))
+    outcome = asyncio.run(aclassify_questions_batch(questions, subjects, batch_size=2, max_retries=2))
+
+    assert outcome["results"] == expected
+    assert sorted(map(len, sent[:3])) == [1, 2, 2]
+    assert sent[3:] == [[questions[1], questions[2]]]
+    assert outcome["stats"]["llm_calls"] == 4
+    assert outcome["stats"]["retried"] == 2
+    assert outcome["stats"]["failed"] == 0
+
+def test_classification_limits_are_validated():
+    """Batch sizes below one and non-positive time budgets are rejected instead of silently classifying nothing."""
+    import httpx
+    from main import app, async_engine
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            batches = [
+                (await client.post("/classify-subject/batch/", json={"questions": ["What is a vector?"], "batch_size": size})).status_code
+                for size in (-1, 0, 1000)
+            ]
+            budgets = [
+                (await client.post("/classify/", json={"question": "What is a vector?", "time_budget": budget})).status_code
+                for budget in (-1, 0)
+            ]
+        await async_engine.dispose()
+        return batches, budgets
+
+    assert asyncio.run(run()) == ([422, 422, 422], [422, 422])
+    try:
+        asyncio.run(generator.aclassify_questions_batch(["What is a vector?"], ["Physics"], batch_size=0))
+        assert False, "expected a ValueError"
+    except ValueError:
+        pass
+
+def test_hierarchy_classification_bounds_calls_and_returns_partial_tree(use_llm):
+    """Topic and subtopic calls run at most max_concurrency at once; the budget cuts the walk short with partial set."""
+    from generator import aclassify_question_hierarchy
+
+    latency = 0.2
+    taxonomy = {
+        subject: {f"{subject} {topic}": [f"{subject} {topic} {n}" for n in range(2)] for topic in ("A", "B", "C")}
+        for subject in ("Physics", "Chemistry")
+    }
+    names = list(taxonomy) + [name for topics in taxonomy.values() for topic, subtopics in topics.items() for name in [topic, *subtopics]]
+    in_flight = {"now": 0, "peak": 0}
+
+    async def ainvoke(prompt):
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        try:
+            await asyncio.sleep(latency)
+            return AIMessage(content=json.dumps(names))  # Every name; each level keeps its own
+        finally:
+            in_flight["now"] -= 1
+
+    async def run(time_budget):
+        question = f"How do forces and reactions relate? ({time.time_ns()})"
+        return await aclassify_question_hierarchy(question, taxonomy, max_concurrency=2, time_budget=time_budget)
+
+    use_llm(RunnableLambda(lambda prompt: None, afunc=ainvoke))
+    # One subject call, two topic calls, then six subtopic calls in three waves of two
+    complete = asyncio.run(run(10))
+    complete_peak, in_flight["peak"] = in_flight["peak"], 0
+    # Out of time after the first subtopic wave
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        partial = asyncio.run(run(latency * 3.5))
+
+    assert complete_peak == 2 and in_flight["peak"] == 2
+    assert not complete["partial"]
+    assert {subject["name"]: {topic["name"]: topic["subtopics"] for topic in subject["topics"]} for subject in complete["subjects"]} == taxonomy
+    assert latency * 5 <= complete["elapsed_ms"] / 1000 < latency * 6
+
+    assert partial["partial"]
+    assert partial["elapsed_ms"] / 1000 < latency * 4
+    topics = [topic for subject in partial["subjects"] for topic in subject["topics"]]
+    assert len(topics) == 6
+    assert sum(1 for topic in topics if topic["subtopics"]) == 2
+    assert in_flight["now"] == 0  # Calls still running at the deadline were cancelled
+    assert not [warning for warning in caught if "never awaited" in str(warning.message)]  # Nor left unstarted
+
+def test_classification_cache_keys_eviction_and_expiry():
+    """Question normalization, order-insensitive candidates, LRU eviction, TTL expiry, invalidate() and counters."""
+    from cache import ClassificationCache, LRUCacheBackend
+
+    cache = ClassificationCache(LRUCacheBackend(maxsize=2, ttl=60))
+    subjects = ["Physics", "Chemistry", "Biology"]
+
+    cache.set("subject", "What is an ionic bond?", subjects, ["Chemistry"])
+    # Case, spacing and trailing punctuation are normalized away, and candidate order does not matter
+    assert cache.get("subject", "  what is an IONIC   bond ", list(reversed(subjects))) == ["Chemistry"]
+    # Other candidates, another kind or another context are other keys
+    assert cache.get("subject", "What is an ionic bond?", subjects[:2]) is None
+    assert cache.get("topic", "What is an ionic bond?", subjects) is None
+    assert cache.get("subject", "What is an ionic bond?", subjects, "Chemistry") is None
+
+    cache.set("subject", "What is a cell?", subjects, ["Biology"])
+    cache.get("subject", "What is an ionic bond?", subjects)  # Now the most recently used
+    cache.set("subject", "What is a force?", subjects, ["Physics"])  # Evicts the cell question
+    assert cache.get("subject", "What is a cell?", subjects) is None
+    assert cache.get("subject", "What is an ionic bond?", subjects) == ["Chemistry"]
+
+    cache.invalidate()
+    assert cache.get("subject", "What is a force?", subjects) is None
+
+    async def run():
+        await cache.aset("subject", "What is a cell?", subjects, ["Biology"])
+        return await cache.aget_many("subject", ["what is a cell", "What is DNA?"], subjects)
+
+    assert asyncio.run(run()) == [["Biology"], None]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["size"]) == (4, 6, 1, 1)
+
+    # Once this worker sees a newer taxonomy version, entries cached against the old one miss
+    cache.observe_taxonomy_version(cache.taxonomy_version + 1)
+    assert cache.get("subject", "What is a cell?", subjects) is None
+    assert asyncio.run(cache.astats())["taxonomy_version"] == cache.taxonomy_version
+
+    short_lived = LRUCacheBackend(maxsize=10, ttl=0.05)
+    short_lived.set("key", ["Physics"])
+    assert short_lived.get("key") == ["Physics"]
+    time.sleep(0.1)
+    assert short_lived.get("key") is None
+    assert short_lived.stats()["expirations"] == 1
+
+def test_prefilter_narrows_and_answers_only_long_lists():
+    """Lists longer than top_k are narrowed, or answered when one name clearly matches; shorter lists go to the LLM untouched."""
+    from prefilter import CandidatePrefilter
+
+    names = ["Quantum Mechanics", "Linear Algebra", "Organic Chemistry", "Bubble Sort", "Thermodynamics", "Calculus", "Cell Biology"]
+    prefilter = CandidatePrefilter(top_k=3, answer_threshold=0.85, answer_margin=0.2)
+
+    assert prefilter.narrow("What is the time complexity of bubble sort?", names) == (names, ["Bubble Sort"])
+    # Two names spelled out: no single answer, both kept in the shortlist
+    shortlist, answer = prefilter.narrow("Is bubble sort or quantum mechanics harder?", names)
+    assert answer is None and len(shortlist) == 3 and {"Bubble Sort", "Quantum Mechanics"} <= set(shortlist)
+    shortlist, answer = prefilter.narrow("How do eigenvalues relate to the determinant in linear transformations?", names)
+    assert answer is None and len(shortlist) == 3 and shortlist[0] == "Linear Algebra"
+    # A list that fits in the prompt is left to the multi-label classifier, however clear the match
+    assert prefilter.narrow("What is the time complexity of bubble sort?", names[2:5]) == (names[2:5], None)
+    # Below the answer threshold the list is only narrowed
+    strict = CandidatePrefilter(top_k=3, answer_threshold=1.01, answer_margin=0.2)
+    shortlist, answer = strict.narrow("What is the time complexity of bubble sort?", names)
+    assert answer is None and shortlist[0] == "Bubble Sort"
+    assert CandidatePrefilter(top_k=3, enabled=False).narrow("bubble sort", names) == (names, None)
+
+def test_stream_normalizer_matches_line_cleanup():
+    """Chunked normalization should equal clean_llm_response applied line by line, and keep $$ blocks whole."""
+    text = (
+        "```json\n# Kinematics\n\nThe   **velocity** is $v = \\frac{dx}{dt}$.  Then\n"
+        "$$\n a =   \\frac{d^2 x}{dt^2}\n$$\nDone!   ```"
+    )
+    expected = "\n".join(
+        cleaned for cleaned in (clean_llm_response(line) for line in text.split("\n")) if cleaned
+    )
+
+    for size in range(1, 6):
+        normalizer = StreamNormalizer(min_emit=1)
+        writes = [normalizer.feed(text[i:i + size]) for i in range(0, len(text), size)]
+        writes.append(normalizer.flush())
+        assert "".join(writes).rstrip("\n") == expected
+        for write in writes:
+            assert write.count("$$") % 2 == 0
+
+def test_identical_concurrent_titles_share_one_llm_call(use_llm):
+    """Concurrent identical title requests should collapse into a single LLM call."""
+    calls = []
+
+    async def ainvoke(prompt):
+        calls.append(prompt)
+        await asyncio.sleep(0.2)
+        return AIMessage(content='{"title": "Bubble Sort Complexity"}')
+
+    use_llm(RunnableLambda(lambda prompt: None, afunc=ainvoke))
+    collapsed_before = llm_singleflight.stats()["collapsed"]
+
+    async def run():
+        return await asyncio.gather(*[
+            agenerate_title("What is the time complexity of bubble sort?") for _ in range(10)
+        ])
+
+    titles = asyncio.run(run())
+
+    assert titles == ["Bubble Sort Complexity"] * 10
+    assert len(calls) == 1
+    assert llm_singleflight.stats()["collapsed"] - collapsed_before == 9
+
+def test_fake_llm_backend(use_llm):
+    """The fake backend answers classification prompts from the candidates and streams in bounded chunks."""
+    fake = FakeChatModel(latency=0, tokens_per_second=0)
+    use_llm(fake)
+    # Names both spelled out in the question, so the prefilter cannot pick one and the model is asked
+    subjects = asyncio.run(aclassify_question_subjects(
+        f"How does bubble sort compare with other sorting methods? ({time.time_ns()})",
+        ["Quantum Mechanics", "Bubble Sort", "Sorting", "Calculus"]
+    ))
+    assert fake.calls == 1
+    assert subjects == ["Bubble Sort", "Sorting"]
+
+    llm = FakeChatModel(latency=0, tokens_per_second=0, chunk_sizes=(2, 3), reply="one two three four five six seven")
+    chunks = [chunk.content for chunk in llm.stream("hello")]
+    assert "".join(chunks) == "one two three four five six seven"
+    assert all(2 <= len(chunk.split()) <= 3 for chunk in chunks[:-1])
+
+    try:
+        FakeChatModel(latency=0, error_rate=1.0).invoke("hello")
+        assert False, "expected an injected failure"
+    except FakeLLMError:
+        pass
+
+def test_llm_scheduler_serves_interactive_before_background():
+    """With one slot per class, queued interactive calls start before queued background calls."""
+    scheduler = LLMScheduler(
+        concurrency={"interactive": 1, "classification": 1, "title": 1, "background": 1},
+        requests_per_minute=60,  # One request per second after the first 60
+        tokens_per_minute=0
+    )
+    scheduler.requests.level = 1  # Only one request left in the bucket
+    order = []
+
+    async def call(priority: str):
+        async with scheduler.aslot(priority, 100):
+            order.append(priority)
+
+    async def run():
+        await asyncio.gather(call("background"), call("background"), call("interactive"))
+
+    asyncio.run(run())
+    assert order == ["background", "interactive", "background"]
+    stats = scheduler.stats()["classes"]
+    assert stats["background"]["completed"] == 2
+    assert stats["interactive"]["wait"]["count"] == 1
+
+def test_provider_hedging_and_failover(monkeypatch):
+    """A slow primary is hedged to the other provider, and a failing one fails over."""
+    monkeypatch.setattr(generator, "OPENAI_API_KEY", "stub")
+    monkeypatch.setattr(generator, "ANTHROPIC_API_KEY", "stub")
+    openai_stub = StubLLMServer(reply='["Physics"]', tail_rate=1.0, tail_latency=2.0).start()
+    anthropic_stub = StubLLMServer(reply='["Chemistry"]', latency=0.05).start()
+    registry = generator.LLMRegistry(providers={
+        "openai": openai_stub.base_url,
+        "anthropic": anthropic_stub.anthropic_base_url
+    })
+    registry.router.hedge_delay = 0.2
+    inputs = {"question": "What is an ionic bond?", "subjects_list": "Physics, Chemistry"}
+
+    charged = []
+
+    async def run():
+        start = time.perf_counter()
+        hedged = await registry.ainvoke("subject_classification", inputs, hedge=True, on_hedge=lambda: charged.append(1))
+        elapsed = time.perf_counter() - start
+        # The cancelled loser has finished unwinding by the time the winner is returned
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+        # Anthropic answered fastest so it is now primary; make it fail
+        anthropic_stub.error_rate = 1.0
+        openai_stub.tail_rate = 0.0
+        failed_over = await registry.ainvoke("subject_classification", inputs)
+        return hedged, elapsed, failed_over
+
+    try:
+        hedged, elapsed, failed_over = asyncio.run(run())
+    finally:
+        openai_stub.stop()
+        anthropic_stub.stop()
+
+    assert hedged.content == '["Chemistry"]'
+    assert elapsed < 1.0
+    assert failed_over.content == '["Physics"]'
+    assert registry.router.hedges == 1
+    assert charged == [1]
+    assert registry.router.failovers == 1
+
+def test_llm_scheduler_charges_hedged_requests():
+    """A hedge spends a request and its tokens from the buckets, settled with the ticket on release."""
+    scheduler = LLMScheduler(requests_per_minute=600, tokens_per_minute=6000)
+
+    async def run():
+        async with scheduler.aslot("classification", 100) as ticket:
+            scheduler.charge_hedge(ticket, 100)
+            ticket.used_tokens = 150
+
+    asyncio.run(run())
+    stats = scheduler.stats()
+    assert stats["classes"]["classification"]["hedges"] == 1
+    assert stats["buckets"]["requests_available"] <= 598.5
+    assert 5840 <= stats["buckets"]["tokens_available"] <= 5860
+
+def make_generation_job(name: str):
+    """Insert a subject, whose trigger queues its generation job, and make the job due before any other."""
+    from datetime import datetime
+    from sqlalchemy import update
+    from sqlalchemy.orm import Session
+    from main import engine
+    from models.database import GenerationJob, Subject
+
+    with Session(engine) as db:
+        subject = Subject(name=f"{name} {time.time_ns()}")
+        db.add(subject)
+        db.commit()
+        db.execute(update(GenerationJob).where(GenerationJob.subject_id == subject.id).values(next_run_at=datetime(2000, 1, 1)))
+        db.commit()
+        return subject.id, db.query(GenerationJob.id).filter(GenerationJob.subject_id == subject.id).scalar()
+
+def delete_generation_job(subject_id: int):
+    from sqlalchemy import delete, select
+    from sqlalchemy.orm import Session
+    from main import engine
+    from models.database import GenerationJob, Subject, Subtopic, Topic
+
+    with Session(engine) as db:
+        topic_ids = select(Topic.id).where(Topic.subject_id == subject_id)
+        db.execute(delete(Subtopic).where(Subtopic.topic_id.in_(topic_ids)))
+        db.execute(delete(Topic).where(Topic.subject_id == subject_id))
+        db.execute(delete(GenerationJob).where(GenerationJob.subject_id == subject_id))
+        db.execute(delete(Subject).where(Subject.id == subject_id))
+        db.commit()
+
+def test_subject_insert_queues_and_announces_its_job():
+    """The insert trigger creates a queued job for a new subject and NOTIFYs listening workers."""
+    import jobs
+    from sqlalchemy.orm import Session
+    from main import SessionLocal, engine
+    from models.database import GenerationJob
+
+    worker = jobs.GenerationWorker(SessionLocal)
+    created = []
+
+    async def run():
+        await worker.ensure_listening()  # Before the insert, so its NOTIFY is heard
+        created.append(await asyncio.to_thread(make_generation_job, "Trigger test"))
+        for _ in range(100):
+            if worker.notifications:
+                break
+            await asyncio.sleep(0.02)
+        worker._unlisten()
+
+    try:
+        asyncio.run(run())
+        _, job_id = created[0]
+        with Session(engine) as db:
+            job = db.get(GenerationJob, job_id)
+            row = job.state, job.attempts, job.last_error
+    finally:
+        for subject_id, _ in created:
+            delete_generation_job(subject_id)
+
+    assert row == ("queued", 0, None)
+    assert worker.notifications >= 1
+
+def test_generation_jobs_back_off_and_are_recovered(monkeypatch):
+    """
+    Failed attempts are retried after the backoff, resuming from the stored chapter list,
+    until max_attempts; a running job whose process is gone is requeued by recover().
+    """
+    import jobs
+    from datetime import datetime, timedelta
+    from sqlalchemy.orm import Session
+    from main import SessionLocal, engine
+    from models.database import GenerationJob
+
+    outcomes = [
+        {"success": False, "failed_chapters": ["Middle"], "chapter_list": [{"chapter": "Middle", "difficulty": 0.5}]},
+        RuntimeError("provider down"),
+    ]
+    seen_chapters = []
+
+    async def failing_generation(db, subject, chapters=None):
+        seen_chapters.append(chapters)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(jobs, "agenerate_subject", failing_generation)
+    worker = jobs.GenerationWorker(SessionLocal, max_attempts=2, backoff=30, max_backoff=600)
+    other = jobs.GenerationWorker(SessionLocal)
+
+    def job_row(job_id):
+        with Session(engine) as db:
+            job = db.get(GenerationJob, job_id)
+            return job.state, job.attempts, job.last_error, job.next_run_at, job.finished_at
+
+    def make_due(job_id, **values):
+        with Session(engine) as db:
+            db.query(GenerationJob).filter(GenerationJob.id == job_id).update({"next_run_at": datetime(2000, 1, 1), **values})
+            db.commit()
+
+    async def run():
+        rows = []
+        for _ in range(2):
+            claimed = await asyncio.to_thread(worker._claim, 1)
+            await worker._start_job(claimed[0])
+            rows.append(await asyncio.to_thread(job_row, job_id))
+            await asyncio.to_thread(make_due, job_id)
+
+        # A process that died mid-run leaves the row "running" with its lock free
+        await asyncio.to_thread(make_due, job_id, state="running", attempts=1)
+        requeued = await asyncio.to_thread(other.recover)
+        return rows, requeued, await asyncio.to_thread(job_row, job_id)
+
+    subject_id, job_id = make_generation_job("Job retry test")
+    try:
+        rows, requeued, recovered = asyncio.run(run())
+    finally:
+        worker.locks.close()
+        other.locks.close()
+        delete_generation_job(subject_id)
+
+    (state, attempts, error, next_run_at, finished_at), last = rows
+    assert (state, attempts, error) == ("failed", 1, "Failed chapters: Middle")
+    assert next_run_at - finished_at == timedelta(seconds=30)
+    assert seen_chapters == [None, [{"chapter": "Middle", "difficulty": 0.5}]]  # The retry resumes from the stored list
+    assert last[:4] == ("failed", 2, "provider down", None)  # Out of attempts: no next run, never claimed again
+
+    assert requeued >= 1 and recovered[:2] == ("queued", 1)
+
+def test_generation_worker_stops_jobs_when_its_lock_connection_drops(monkeypatch):
+    """
+    A worker whose advisory-lock connection breaks stops being leader, cancels its running
+    job and writes nothing more for it; another worker's recover() requeues it and claims it.
+    """
+    import jobs
+    from sqlalchemy import text
+    from sqlalchemy.orm import Session
+    from main import SessionLocal, engine
+    from models.database import GenerationJob
+
+    async def slow_generation(db, subject, chapters=None):
+        await asyncio.sleep(30)
+
+    monkeypatch.setattr(jobs, "agenerate_subject", slow_generation)
+    subject_id, job_id = make_generation_job("Lock loss test")
+    first, second = jobs.GenerationWorker(SessionLocal), jobs.GenerationWorker(SessionLocal)
+
+    def drop_connection(pid: int):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": pid})
+
+    async def run():
+        led = await asyncio.to_thread(first.try_lead)
+        claimed = await asyncio.to_thread(first._claim, 1)
+        task = first._start_job(claimed[0])
+        await asyncio.sleep(0.05)
+        requeued_while_held = await asyncio.to_thread(second.recover)
+        await asyncio.to_thread(drop_connection, await asyncio.to_thread(first.locks.ping))
+        led_after_drop = await asyncio.to_thread(first.try_lead)  # Finds the connection gone
+        await asyncio.wait([task], timeout=5)
+        return led, claimed, task, requeued_while_held, led_after_drop
+
+    try:
+        led, claimed, task, requeued_while_held, led_after_drop = asyncio.run(run())
+        requeued = second.recover()
+        reclaimed = second._claim(1)
+        first._finish(job_id, None, "stale result", 1.0)  # Must not touch the row second now owns
+        with Session(engine) as db:
+            job = db.get(GenerationJob, job_id)
+            state, attempts, last_error = job.state, job.attempts, job.last_error
+        leaders = [first.try_lead(), second.try_lead()]
+        second._finish(job_id, None, None, 1.0)
+    finally:
+        first.locks.close()
+        second.locks.close()
+        delete_generation_job(subject_id)
+
+    assert led and [job["id"] for job in claimed] == [job_id]
+    assert requeued_while_held == 0
+    assert not led_after_drop and first.locks_lost == 1
+    assert task.cancelled() and not first._running_ids
+    assert requeued == 1 and [job["id"] for job in reclaimed] == [job_id]
+    assert (state, attempts, last_error) == ("running", 2, None)  # Second claim, and no stale write from first
+    assert sorted(leaders) == [False, True]  # The leader lock was free again, and only one worker got it
+
+def make_textbook_llm(broken: set, calls: list):
+    """Fake LLM for textbook generation: three chapters, two subtopics each, garbled output for chapters in `broken`."""
+    import re
+
+    def invoke(prompt):
+        text = prompt.to_string()
+        chapter = re.search(r'subtopics of the chapter "(.+)" only', text)
+        if chapter is None:
+            calls.append("chapter list")
+            chapters = [{"chapter": name, "difficulty": difficulty} for name, difficulty in (("Basics", 0.1), ("Middle", 0.5), ("Advanced", 0.9))]
+            return AIMessage(content=json.dumps({"chapters": chapters}))
+        name = chapter.group(1)
+        calls.append(name)
+        if name in broken:
+            return AIMessage(content='{"subtopics": "not a list"}')
+        subtopics = [{"subtopic": f"{name} {n}", "difficulty": round(0.9 - 0.4 * n, 1)} for n in range(2)]
+        return AIMessage(content=json.dumps({"subtopics": subtopics}))
+
+    async def ainvoke(prompt):
+        return invoke(prompt)
+
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+def test_textbook_generation_keeps_good_chapters_and_retries_only_failed_ones(monkeypatch, use_llm):
+    """A chapter that keeps failing does not undo the committed ones, and a retry generates only that chapter."""
+    import knowledge
+    from sqlalchemy.orm import Session
+    from main import SessionLocal, engine
+    from models.database import Subject, Subtopic, Topic
+
+    monkeypatch.setattr(knowledge, "RETRY_BACKOFF", 0)
+    subject_id, _ = make_generation_job("Textbook test")
+    calls = []
+    try:
+        with Session(engine) as db:
+            subject_name = db.get(Subject, subject_id).name
+        with SessionLocal() as db:
+            use_llm(make_textbook_llm({"Middle"}, calls))
+            first = asyncio.run(knowledge.agenerate_subject(db, subject_name, max_retries=1))
+            first_calls, calls[:] = sorted(calls), []
+            with Session(engine) as check:
+                stored_after_failure = [topic.name for topic in check.query(Topic).filter(Topic.subject_id == subject_id).order_by(Topic.position)]
+
+            use_llm(make_textbook_llm(set(), calls))
+            retry = asyncio.run(knowledge.agenerate_subject(db, subject_name, chapters=first["chapter_list"], max_retries=1))
+        with Session(engine) as check:
+            topics = check.query(Topic).filter(Topic.subject_id == subject_id).order_by(Topic.position).all()
+            stored = [
+                (topic.name, topic.position, [name for (name,) in check.query(Subtopic.name).filter(Subtopic.topic_id == topic.id)])
+                for topic in topics
+            ]
+    finally:
+        delete_generation_job(subject_id)
+
+    assert not first["success"] and first["failed_chapters"] == ["Middle"] and first["chapters"] == 2
+    assert first_calls == ["Advanced", "Basics", "Middle", "Middle", "chapter list"]  # Only the bad chapter was retried
+    assert stored_after_failure == ["Basics", "Advanced"]
+    assert retry["success"] and calls == ["Middle"]
+    assert [(name, position) for name, position, _ in stored] == [("Basics", 0), ("Middle", 1), ("Advanced", 2)]
+    assert all(sorted(subtopics) == [f"{name} 0", f"{name} 1"] for name, _, subtopics in stored)
+
+def test_bulk_chapter_insert_round_trips_and_orders_by_difficulty():
+    """add_topics_and_subtopics stores a chapter list in two INSERTs, each subtopic under its own chapter."""
+    import httpx
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from knowledge import add_topics_and_subtopics
+    from main import app, async_engine, engine
+    from models.database import Subject, Subtopic, Topic
+
+    chapters = {
+        f"Chapter {n}": {
+            "difficulty": n / 10,
+            "subtopics": [{"subtopic": f"Chapter {n} part {k}", "difficulty": round(0.9 - k * 0.2, 1)} for k in range(n)]
+        }
+        for n in (3, 1, 0, 4)
+    }
+    inserts = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT"):
+            inserts.append(statement)
+
+    async def read_by_difficulty(topic_ids):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            responses = [await client.get(f"/topics/{topic_id}/subtopics/by-difficulty") for topic_id in topic_ids]
+            ranged = await client.get(f"/topics/{topic_ids[-1]}/subtopics/by-difficulty", params={"min_difficulty": 0.4, "max_difficulty": 0.8})
+        await async_engine.dispose()
+        return responses, ranged
+
+    subject_id, _ = make_generation_job("Bulk insert test")
+    try:
+        with Session(engine) as db:
+            subject_name = db.get(Subject, subject_id).name
+            event.listen(engine, "before_cursor_execute", record)
+            try:
+                stored = add_topics_and_subtopics(db, subject_name, {subject_name: chapters}, start_position=3)
+            finally:
+                event.remove(engine, "before_cursor_execute", record)
+            topics = db.query(Topic).filter(Topic.subject_id == subject_id).order_by(Topic.id).all()
+            subtopics = db.query(Subtopic).filter(Subtopic.topic_id.in_([topic.id for topic in topics])).order_by(Subtopic.id).all()
+            topic_rows = [(topic.name, topic.position, topic.difficulty) for topic in topics]
+            topic_names = {topic.id: topic.name for topic in topics}
+            subtopic_rows = [(topic_names[subtopic.topic_id], subtopic.name, subtopic.difficulty) for subtopic in subtopics]
+            topic_ids = [topic.id for topic in topics]
+        responses, ranged = asyncio.run(read_by_difficulty(topic_ids))
+    finally:
+        delete_generation_job(subject_id)
+
+    assert stored and len(inserts) == 2
+    # Ids follow the order of the chapter list, so positions and parents line up with it
+    assert topic_rows == [(name, position, chapter["difficulty"]) for position, (name, chapter) in enumerate(chapters.items(), 3)]
+    assert subtopic_rows == [
+        (name, subtopic["subtopic"], subtopic["difficulty"])
+        for name, chapter in chapters.items()
+        for subtopic in chapter["subtopics"]
+    ]
+    assert [response.status_code for response in responses] == [200, 200, 404, 200]
+    for (name, chapter), response in zip(chapters.items(), responses):
+        if chapter["subtopics"]:
+            expected = sorted(chapter["subtopics"], key=lambda subtopic: subtopic["difficulty"])
+            assert [(row["name"], row["difficulty"]) for row in response.json()] == [(subtopic["subtopic"], subtopic["difficulty"]) for subtopic in expected]
+    assert [row["name"] for row in ranged.json()] == ["Chapter 4 part 2", "Chapter 4 part 1"]
+
+def test_chat_list_query_count_does_not_grow_with_page_size():
+    """GET /chats/ reads each chat's last message in the same query, not one query per chat."""
+    import httpx
+    from sqlalchemy import event
+    from main import app, async_engine
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app, client=("10.0.20.20", 1))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            token = (await client.post("/guest-token")).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            for _ in range(5):
+                await client.post("/chats/", json={"title": "Query count", "tags": []}, headers=headers)
+
+            counts = []
+            for limit in (1, 6):
+                statements.clear()
+                response = await client.get("/chats/", params={"limit": limit}, headers=headers)
+                assert response.status_code == 200
+                assert len(response.json()) == limit
+                counts.append(len(statements))
+        await async_engine.dispose()
+        return counts
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        counts = asyncio.run(run())
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+    assert counts[0] == counts[1] <= 2  # User lookup and the chat page
+
+def test_sse_stream_event_sequence(use_llm):
+    """?stream=sse sends classification, deltas, the saved reply's id and done; a failure sends error then done."""
+    import httpx
+    from main import app, async_engine
+
+    def parse(body):
+        events = []
+        for block in body.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    async def run():
+        transport = httpx.ASGITransport(app=app, client=("10.0.24.24", 1))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            token = (await client.post("/guest-token")).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            chat_id = (await client.post("/chats/", json={"title": "Events", "tags": []}, headers=headers)).json()["id"]
+            request = {"chat_id": chat_id, "question": "What is inertia?", "subjects": ["Physics"]}
+
+            async def ask():
+                response = await client.post("/generate-response/", params={"stream": "sse"}, json=request, headers=headers)
+                assert response.headers["content-type"].startswith("text/event-stream")
+                return parse(response.text)
+
+            use_llm(FakeChatModel(latency=0, tokens_per_second=0, reply="Inertia resists changes in motion."))
+            streams = await asyncio.gather(ask(), ask())
+            stored = (await client.get(f"/chats/{chat_id}/messages/", params={"limit": 10}, headers=headers)).json()
+            use_llm(FakeChatModel(latency=0, tokens_per_second=0, error_rate=1.0))
+            failed = await ask()
+        await async_engine.dispose()
+        return streams, stored, failed
+
+    streams, stored, failed = asyncio.run(run())
+
+    bot_ids = sorted(message["id"] for message in stored if message["is_bot"])
+    assert len(bot_ids) == 2
+    for events in streams:
+        names = [name for name, _ in events]
+        assert names[0] == "classification" and names[-2:] == ["message", "done"]
+        assert set(names[1:-2]) == {"delta"}
+        assert "".join(data["text"] for name, data in events if name == "delta") == "Inertia resists changes in motion."
+    # Each stream reports its own saved reply, even with both in the same chat
+    assert sorted(events[-2][1]["id"] for events in streams) == bot_ids
+    assert [name for name, _ in failed] == ["classification", "error", "done"]
+
+def test_sse_stream_records_timings_when_the_client_disconnects():
+    """Closing the SSE stream early still records its duration, and only a finished stream sends done."""
+    from main import stream_sse_response
+    from streaming import StreamTimings, stream_metrics
+
+    async def events():
+        yield "classification", {}
+        for n in range(5):
+            yield "delta", {"text": str(n)}
+
+    async def run():
+        recorded = stream_metrics["total_duration"].count
+        aborted = stream_sse_response(events(), StreamTimings())
+        received = [await aborted.__anext__() for _ in range(2)]
+        await aborted.aclose()
+        after_abort = stream_metrics["total_duration"].count - recorded
+        finished = [chunk async for chunk in stream_sse_response(events(), StreamTimings())]
+        return received, after_abort, stream_metrics["total_duration"].count - recorded, finished
+
+    received, after_abort, after_both, finished = asyncio.run(run())
+    assert not any(chunk.startswith(b"event: done") for chunk in received)
+    assert (after_abort, after_both) == (1, 2)
+    assert finished[-1].startswith(b"event: done") and b'"deltas": 5' in finished[-1]
+
+def test_chat_history_serves_sync_and_async_sessions_alike(use_llm):
+    """One history class: a Session and an AsyncSession see the same window, and the sync chain can save to it."""
+    from langchain_core.messages import HumanMessage
+    from sqlalchemy import delete
+    from sqlalchemy.orm import Session
+    from ChatMessageHistory import PostgresChatMessageHistory
+    from main import AsyncSessionLocal, async_engine, engine
+    from models.database import Chat, Message, User
+
+    with Session(engine) as db:
+        user = User(username=f"history-test-{time.time_ns()}", email=None, hashed_password="x")
+        db.add(user)
+        db.flush()
+        chat = Chat(user_id=user.id, title="History", tags=[])
+        db.add(chat)
+        db.commit()
+        user_id, chat_id = user.id, chat.id
+
+    async def read_async(budget):
+        async with AsyncSessionLocal() as db:
+            history = PostgresChatMessageHistory(chat_id, db, token_budget=budget, page_size=3)
+            messages = await history.aget_messages()
+            overflow = await history.aunsummarized_messages()
+            try:
+                history.get_messages()
+                sync_refused = False
+            except TypeError:
+                sync_refused = True
+        await async_engine.dispose()
+        return [message.content for message in messages], [message.id for message in overflow], sync_refused
+
+    try:
+        with Session(engine) as db:
+            history = PostgresChatMessageHistory(chat_id, db)
+            ids = history.add_messages([HumanMessage(content=f"question {n} " + "x" * 40) for n in range(6)])
+            history.add_message(AIMessage(content="an answer"))
+
+            windowed = PostgresChatMessageHistory(chat_id, db, token_budget=40, page_size=3)
+            sync_window = [message.content for message in windowed.get_messages()]
+            sync_overflow = [message.id for message in windowed.unsummarized_messages()]
+            async_window, async_overflow, sync_refused = asyncio.run(read_async(40))
+            thread_window = [message.content for message in asyncio.run(windowed.aget_messages())]
+
+            # The sync chain path stores its reply through the same class
+            use_llm(FakeChatModel(latency=0, tokens_per_second=0, reply="Sync reply"))
+            generator.get_llm_registry().chat_chain.invoke(
+                {"knowledge_context": "", "detail_level": "brief", "terminology_level": "simple", "input": "Hello?"},
+                config={"configurable": {"chat_id": chat_id, "db_session": db, "saved_reply_ids": None}}
+            )
+            stored = [message.content for message in PostgresChatMessageHistory(chat_id, db).get_messages()]
+    finally:
+        with Session(engine) as db:
+            db.execute(delete(Message).where(Message.chat_id == chat_id))
+            db.execute(delete(Chat).where(Chat.id == chat_id))
+            db.execute(delete(User).where(User.id == user_id))
+            db.commit()
+
+    assert ids == sorted(ids) and len(ids) == 6
+    assert sync_window == async_window == thread_window
+    assert sync_window[-1] == "an answer" and len(sync_window) < 7
+    assert sync_overflow == async_overflow and sync_overflow
+    assert sync_refused
+    assert stored[-2:] == ["Hello?", "Sync reply"]
+
+def test_chat_stream_frees_its_scheduler_slot_before_the_client_finishes(use_llm):
+    """The interactive slot is released when the provider stream ends, not when a slow client has read it all."""
+    import httpx
+    from llm_scheduler import llm_scheduler
+    from main import AsyncSessionLocal, app, async_engine
+
+    def running():
+        return llm_scheduler.stats()["classes"]["interactive"]["running"]
+
+    async def run():
+        transport = httpx.ASGITransport(app=app, client=("10.0.25.25", 1))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            token = (await client.post("/guest-token")).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            chat_id = (await client.post("/chats/", json={"title": "Slot", "tags": []}, headers=headers)).json()["id"]
+
+        observed = []
+        async with AsyncSessionLocal() as db:
+            events = generator.generate_chat_events(
+                chat_id=chat_id, db_session=db, question="What is inertia?", relevant_subjects=["Physics"],
+                relevant_topics={}, subject_knowledge={}, topic_knowledge={}
+            )
+            async for event, data in events:
+                observed.append((event, running()))
+                await asyncio.sleep(0.02)  # A slow reader
+        await async_engine.dispose()
+        return observed
+
+    use_llm(FakeChatModel(latency=0, tokens_per_second=0, chunk_sizes=(1, 1), reply="one\ntwo\nthree\nfour\nfive\nsix"))
+    observed = asyncio.run(run())
+
+    deltas = [slots for event, slots in observed if event == "delta"]
+    assert len(deltas) >= 5
+    assert all(slots == 0 for slots in deltas[1:])  # The provider was done before the client read the second piece
+    assert observed[-1][0] == "message" and running() == 0
+
+def test_keyset_pagination_walks_both_directions():
+    """Cursor pages of a chat's messages cover every message once, in order, in both directions."""
+    import httpx
+    from main import app, async_engine
+
+    async def run():
+        transport = httpx.ASGITransport(app=app, client=("10.0.21.21", 1))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            token = (await client.post("/guest-token")).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            chat_id = (await client.post("/chats/", json={"title": "Paging", "tags": []}, headers=headers)).json()["id"]
+            for i in range(7):
+                message = {"chat_id": chat_id, "content": [{"type": "text", "value": str(i)}], "is_bot": False}
+                await client.post("/messages/", json=message)
+            url = f"/chats/{chat_id}/messages/"
+
+            async def walk(direction):
+                pages, params = [], {"limit": 3, "direction": direction}
+                while True:
+                    response = await client.get(url, params=params, headers=headers)
+                    assert response.status_code == 200
+                    pages.append([message["id"] for message in response.json()])
+                    if response.headers["X-Has-More"] == "false":
+                        return pages, response
+                    cursor = response.headers["X-Older-Cursor" if direction == "older" else "X-Newer-Cursor"]
+                    params = {"limit": 3, "direction": direction, "cursor": cursor}
+
+            forward, last = await walk("newer")
+            backward, _ = await walk("older")
+            nothing_newer = await client.get(url, params={"direction": "newer", "cursor": last.headers["X-Newer-Cursor"]}, headers=headers)
+            bad_cursor = await client.get(url, params={"cursor": "not-a-cursor"}, headers=headers)
+            offsets = [(await client.get(path, params={"skip": 3}, headers=headers)).status_code for path in (url, "/chats/")]
+        await async_engine.dispose()
+        return forward, backward, nothing_newer, bad_cursor, offsets
+
+    forward, backward, nothing_newer, bad_cursor, offsets = asyncio.run(run())
+    ids = [message_id for page in forward for message_id in page]
+    assert ids == sorted(ids) and len(ids) == 7
+    assert [len(page) for page in forward] == [3, 3, 1]
+    # Scrolling up starts from the latest page; each page is still oldest-first
+    assert backward == [ids[4:], ids[1:4], ids[:1]]
+    assert nothing_newer.json() == [] and nothing_newer.headers["X-Has-More"] == "false"
+    assert bad_cursor.status_code == 400
+    assert offsets == [400, 400]  # Offset paging is gone; skip is refused rather than ignored
+
+def test_tags_union_query_orders_escapes_and_counts():
+    """/tags/ merges all three tables by name, matches search text literally and counts past the page."""
+    import httpx
+    from sqlalchemy import delete
+    from sqlalchemy.orm import Session
+    from main import app, async_engine, engine
+    from models.database import GenerationJob, Subject, Topic, Subtopic
+
+    marker = f"Tagtest{time.time_ns()}"
+    with Session(engine) as db:
+        subject = Subject(name=f"{marker} 50% zeta")
+        db.add(subject)
+        db.flush()
+        topic = Topic(subject_id=subject.id, name=f"{marker} beta")
+        db.add(topic)
+        db.flush()
+        db.add(Subtopic(topic_id=topic.id, name=f"{marker}_alpha"))
+        db.commit()
+        subject_id, topic_id = subject.id, topic.id
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            results = [
+                (await client.get("/tags/", params=params)).json()
+                for params in (
+                    {"search": marker}, {"search": marker, "limit": 2}, {"search": "50%"}, {"search": f"{marker[-4:]}_b"},
+                    {"search": marker, "skip": 20}
+                )
+            ]
+        await async_engine.dispose()
+        return results
+
+    try:
+        everything, first_two, percent, underscore, past_end = asyncio.run(run())
+    finally:
+        with Session(engine) as db:
+            db.execute(delete(Subtopic).where(Subtopic.topic_id == topic_id))
+            db.execute(delete(Topic).where(Topic.id == topic_id))
+            db.execute(delete(GenerationJob).where(GenerationJob.subject_id == subject_id))
+            db.execute(delete(Subject).where(Subject.id == subject_id))
+            db.commit()
+
+    # Byte order, as Python sorted them before: " " < "_" (a locale collation would put "_alpha" before " beta")
+    assert [(tag["type"], tag["name"]) for tag in everything["items"]] == [
+        ("subject", f"{marker} 50% zeta"), ("topic", f"{marker} beta"), ("subtopic", f"{marker}_alpha")
+    ]
+    assert everything["total"] == 3
+    assert first_two["total"] == 3 and len(first_two["items"]) == 2 and not first_two["total_capped"]
+    assert [tag["type"] for tag in percent["items"] if tag["name"].startswith(marker)] == ["subject"]
+    # "_" is not a wildcard, so "<marker>_b" must not match "<marker> beta"
+    assert underscore["total"] == 0
+    # An empty page past the last match still reports the real total, not skip
+    assert past_end["items"] == [] and past_end["total"] == 3
+
+def test_tag_index_ranks_prefixes_and_typos_and_takes_new_rows():
+    """Autocomplete ranks by type then popularity, tolerates typos in longer words and sees rows added later."""
+    from autocomplete import TagIndex
+
+    index = TagIndex()
+    index.build([
+        ("subject", 1, "Physics"),
+        ("topic", 10, "Classical Mechanics"),
+        ("topic", 11, "Quantum Mechanics"),
+        ("subtopic", 100, "Quantum Mechanics"),
+        ("subtopic", 101, "Mechanical Waves"),
+    ], popularity={"Quantum Mechanics": 3})
+
+    assert [(tag["type"], tag["name"]) for tag in index.suggest("mech")] == [
+        ("topic", "Quantum Mechanics"), ("topic", "Classical Mechanics"),
+        ("subtopic", "Quantum Mechanics"), ("subtopic", "Mechanical Waves")
+    ]
+    assert [(tag["name"], tag["typos"]) for tag in index.suggest("quantm mech", limit=1)] == [("Quantum Mechanics", 1)]
+    assert index.suggest("mecanics", fuzzy=False) == []
+    assert index.suggest("phx") == []  # Too short to guess a typo
+    assert index.suggest("th") == []
+
+    index.add([("subtopic", 102, "Thermodynamics"), ("subject", 1, "Physics")])
+    assert [tag["id"] for tag in index.suggest("th")] == [102]
+    assert [tag["id"] for tag in index.suggest("phy")] == [1]
+
+def test_taxonomy_snapshot_follows_database_version():
+    """A change committed anywhere bumps taxonomy_version; each worker's cache reloads once it checks."""
+    from sqlalchemy import delete
+    from sqlalchemy.orm import Session
+    from main import AsyncSessionLocal, async_engine, engine
+    from models.database import GenerationJob, Subject, Topic
+    from cache import classification_cache
+    from taxonomy import TaxonomyCache
+
+    this_worker = TaxonomyCache(check_interval=3600)
+    other_worker = TaxonomyCache(check_interval=0)
+    name = f"Snapshot test {time.time_ns()}"
+    created = {}
+
+    async def both():
+        return await this_worker.current(AsyncSessionLocal), await other_worker.current(AsyncSessionLocal)
+
+    async def run():
+        before = await both()
+        with Session(engine) as db:
+            subject = Subject(name=name)
+            db.add(subject)
+            db.flush()
+            db.add(Topic(subject_id=subject.id, name="Snapshot topic", position=0))
+            db.commit()
+            created["subject_id"] = subject.id
+        cached = await this_worker.current(AsyncSessionLocal)
+        this_worker.invalidate()
+        return before, cached, await both()
+
+    try:
+        (mine, theirs), cached, (mine_after, theirs_after) = asyncio.run(run())
+        asyncio.run(async_engine.dispose())
+    finally:
+        subject_id = created.get("subject_id")
+        with Session(engine) as db:
+            db.execute(delete(Topic).where(Topic.subject_id == subject_id))
+            db.execute(delete(GenerationJob).where(GenerationJob.subject_id == subject_id))
+            db.execute(delete(Subject).where(Subject.id == subject_id))
+            db.commit()
+
+    assert cached is mine  # Within check_interval nothing is re-read
+    assert mine_after.version == theirs_after.version > mine.version
+    node = theirs_after.subjects_by_name[name]
+    assert theirs_after.subjects_by_id[subject_id] is node
+    assert [topic.name for topic in node.topics] == ["Snapshot topic"]
+    assert theirs_after.topics_by_id[node.topics[0].id].subject_id == subject_id
+    assert name not in mine.subjects_by_name  # Old snapshots are left as they were
+    assert classification_cache.taxonomy_version == mine_after.version  # Cached classifications follow the reload
+    with pytest.raises(TypeError):
+        mine_after.subjects_by_name["Other"] = node
+
+def test_taxonomy_tree_is_compressed_once_and_revalidates_with_etag():
+    """/taxonomy/ serves the cached tree gzipped with a strong ETag, and 304 once the client has it."""
+    import gzip
+    import httpx
+    from main import app, get_taxonomy
+    from taxonomy import TaxonomySnapshot
+
+    subtopics = [(100 + i, 10 + i % 20, f"Subtopic {i} " + "x" * 40, i / 400) for i in range(400)]
+    topics = [(10 + i, 1 + i % 2, f"Topic {i}", i, None) for i in range(20)]
+    snapshot = TaxonomySnapshot.build(7, [(1, "Algebra"), (2, "Biology")], topics, subtopics)
+    app.dependency_overrides[get_taxonomy] = lambda: snapshot
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            full = await client.get("/taxonomy/", headers={"Accept-Encoding": "gzip"})
+            again = await client.get("/taxonomy/", headers={"Accept-Encoding": "gzip", "If-None-Match": full.headers["etag"]})
+            plain = await client.get("/taxonomy/", headers={"Accept-Encoding": "identity", "If-None-Match": full.headers["etag"]})
+            subjects_only = await client.get("/taxonomy/", params={"depth": 1})
+            biology = await client.get("/taxonomy/", params={"depth": 2, "subject_id": 2})
+            missing = await client.get("/taxonomy/", params={"subject_id": 3})
+        return full, again, plain, subjects_only, biology, missing
+
+    try:
+        full, again, plain, subjects_only, biology, missing = asyncio.run(run())
+    finally:
+        app.dependency_overrides.pop(get_taxonomy, None)
+
+    assert full.status_code == 200 and full.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in full.headers["vary"]
+    tree = full.json()
+    assert tree["version"] == 7 and [subject["name"] for subject in tree["subjects"]] == ["Algebra", "Biology"]
+    assert len(tree["subjects"][0]["topics"][0]["subtopics"]) == 20
+    assert again.status_code == 304 and again.content == b"" and again.headers["etag"] == full.headers["etag"]
+    # The uncompressed representation has its own tag, so the gzip one does not validate it
+    assert plain.status_code == 200 and plain.headers["etag"] != full.headers["etag"]
+    assert plain.json() == tree
+    assert subjects_only.json()["subjects"] == [{"id": 1, "name": "Algebra"}, {"id": 2, "name": "Biology"}]
+    assert [subject["id"] for subject in biology.json()["subjects"]] == [2]
+    assert all("subtopics" not in topic for topic in biology.json()["subjects"][0]["topics"])
+    assert missing.status_code == 404
+    # Serialized and compressed once: the snapshot keeps the bodies it produced
+    body = snapshot.tree_body(3, None)
+    assert body.raw == plain.content and gzip.decompress(body.cached("gzip")) == body.raw
+
 if __name__ == "__main__":
     # Example usage
-    # data = generate_subject_content("Algorithm Design")
-    # print(data)
-    
-    # topic, subtopic, difficulty = find_hardest_subtopic(data)
-    # print(f"\nHardest topic: {topic}")
-    # print(f"Hardest subtopic: {subtopic}")
-    # print(f"Difficulty score: {difficulty}")
-
     data  = classify_question_subjects("What is the time complexity of the bubble sort algorithm?", ["Quantum Mechanics", "Linear Algebra", "Calculus", "Computer Science"])
     print(data)
 
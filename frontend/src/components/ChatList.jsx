@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import { FiSearch, FiTag, FiPlus, FiLoader, FiX, FiMenu } from 'react-icons/fi';  // Add FiX and FiMenu
 import PropTypes from 'prop-types';
-import { fetchTags, fetchSubjects, fetchTopics, fetchSubtopics } from '../services/api';
+import { fetchTags, fetchTaxonomyTree } from '../services/api';
 import UserMenu from './UserMenu';
 
 const ChatList = ({ chats, activeChat, onChatSelect, onToggleSidebar, isDarkMode, onToggleTheme, isSidebarOpen, onStartNewChat }) => {
@@ -20,21 +20,25 @@ const ChatList = ({ chats, activeChat, onChatSelect, onToggleSidebar, isDarkMode
   useEffect(() => {
     const loadTagsAndSubjects = async () => {
       try {
-        const [tagsData, subjectsData] = await Promise.all([
+        const [tagsData, tree] = await Promise.all([
           fetchTags(),
-          fetchSubjects()
+          fetchTaxonomyTree()
         ]);
         
         setAvailableTags(tagsData);
-        setSubjects(subjectsData);
+        setSubjects(tree.subjects.map(({ id, name }) => ({ id, name })));
 
-        // Fetch topics for each subject
+        // Topics and subtopics come with the tree, so selecting them needs no further requests
         const topicsMap = {};
-        for (const subject of subjectsData) {
-          const topics = await fetchTopics(subject.id);
-          topicsMap[subject.id] = topics;
+        const subtopicsMap = {};
+        for (const subject of tree.subjects) {
+          topicsMap[subject.id] = subject.topics;
+          for (const topic of subject.topics) {
+            subtopicsMap[topic.id] = topic.subtopics;
+          }
         }
         setTopicsBySubject(topicsMap);
+        setSubtopicsByTopic(subtopicsMap);
       } catch (err) {
         console.error('Failed to load tags and subjects:', err);
       }
@@ -57,24 +61,6 @@ const ChatList = ({ chats, activeChat, onChatSelect, onToggleSidebar, isDarkMode
     loadTags();
   }, [tagSearchQuery]);
 
-  useEffect(() => {
-    // Fetch subtopics when a topic is selected
-    const loadSubtopics = async () => {
-      if (selectedTopic) {
-        try {
-          const subtopics = await fetchSubtopics(selectedTopic.id);
-          setSubtopicsByTopic(prev => ({
-            ...prev,
-            [selectedTopic.id]: subtopics
-          }));
-        } catch (error) {
-          console.error('Error loading subtopics:', error);
-        }
-      }
-    };
-    loadSubtopics();
-  }, [selectedTopic]);
-
   // Filter chats by tags and search query
   const filteredChats = chats.filter((chat) => {
     const validTags = chat.tags.filter(tag => tag && tag.trim());  // Filter out empty tags
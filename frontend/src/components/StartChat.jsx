@@ -1,7 +1,7 @@
 import { useState, useRef, useEffect, useCallback } from 'react';
 import { FiX, FiSend, FiChevronDown } from 'react-icons/fi';
 import PropTypes from 'prop-types';
-import { fetchTags, fetchSubjects, fetchTopics, classifySubject, classifyTopic } from '../services/api';
+import { fetchTags, fetchTaxonomyTree, classifyQuestionTree } from '../services/api';
 import KnowledgeSlider from './KnowledgeSlider';
 
 const MAX_CHARS = 500;
@@ -31,22 +31,16 @@ const StartChat = ({ onClose, onSubmit }) => {
         setIsLoading(true);
         setError(null);
         
-        const [tagsData, subjectsData] = await Promise.all([
+        const [tagsData, tree] = await Promise.all([
           fetchTags(),
-          fetchSubjects()
+          fetchTaxonomyTree({ depth: 2 })
         ]);
 
+        const subjectsData = tree.subjects;
         const topicsMap = {};
-        await Promise.all(
-          subjectsData.map(async (subject) => {
-            try {
-              const topics = await fetchTopics(subject.id);
-              topicsMap[subject.id] = topics;
-            } catch (err) {
-              console.error(`Failed to fetch topics for subject ${subject.id}:`, err);
-            }
-          })
-        );
+        for (const subject of subjectsData) {
+          topicsMap[subject.id] = subject.topics;
+        }
 
         // Get all subject and topic names
         const subjectNames = new Set(subjectsData.map(subject => subject.name.toLowerCase()));
@@ -134,19 +128,16 @@ const StartChat = ({ onClose, onSubmit }) => {
       // Clear existing tags before new classification
       setTags([]);
       
-      // First, classify the subject
-      const subjectResult = await classifySubject(text);
-      if (subjectResult.relevant_subjects?.length > 0) {
+      // Classify subject, topics and subtopics in one request
+      const result = await classifyQuestionTree(text);
+      if (result.subjects?.length > 0) {
         // Get the most relevant subject
-        const mainSubject = subjectResult.relevant_subjects[0];
-        
-        // Then, classify topics for this subject
-        const topicResult = await classifyTopic(text, mainSubject);
+        const mainSubject = result.subjects[0];
         
         // Update tags with both subject and topics
         const newTags = [
-          mainSubject,
-          ...(topicResult.relevant_topics || []).slice(0, 2) // Take up to 2 topics
+          mainSubject.name,
+          ...(mainSubject.topics || []).map(topic => topic.name).slice(0, 2) // Take up to 2 topics
         ];
         
         setTags(newTags.slice(0, 5)); // Limit to 5 tags maximum
@@ -279,6 +279,17 @@ export const fetchSubtopics = async (topicId) => {
   return response.json();
 };
 
+// Whole subject -> topic -> subtopic tree in one request. depth: 1 subjects, 2 topics, 3 subtopics.
+// The server sends a strong ETag with Cache-Control: no-cache, so the browser cache revalidates
+// repeat loads and gets a 304 until the taxonomy changes.
+export const fetchTaxonomyTree = async ({ depth = 3, subjectId = null } = {}) => {
+  const params = new URLSearchParams({ depth });
+  if (subjectId !== null) params.append('subject_id', subjectId);
+  const response = await fetch(`${API_URL}/taxonomy/?${params}`);
+  if (!response.ok) throw new Error('Failed to fetch taxonomy');
+  return response.json();
+};
+
 export const classifySubject = async (question) => {
   const response = await fetch(`${API_URL}/classify-subject/`, {
     method: 'POST',
@@ -307,6 +318,20 @@ export const classifyTopic = async (question, subject) => {
   return response.json();
 };
 
+export const classifyQuestionTree = async (question, timeBudget = null) => {
+  const response = await fetch(`${API_URL}/classify/`, {
+    method: 'POST',
+    headers: defaultHeaders,
+    body: JSON.stringify(timeBudget ? { question, time_budget: timeBudget } : { question }),
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to classify question');
+  }
+
+  return response.json();
+};
+
 export const generateResponse = async (chatId, question, subjects) => {
   const questionText = Array.isArray(question) 
     ? question[0]?.value || ''
@@ -372,3 +397,69 @@ export const generateStreamingResponse = async (chatId, question, subjects, onCh
 
   return accumulatedResponse;
 };
+
+// Server-Sent Events variant: handlers.onDelta(accumulatedText), onClassification(data),
+// onMessage({ id }), onError({ message }), onDone({ timings })
+export const generateStreamingEvents = async (chatId, question, subjects, handlers = {}) => {
+  const questionText = Array.isArray(question) 
+    ? question[0]?.value || ''
+    : typeof question === 'string' 
+      ? question 
+      : question?.value || '';
+
+  const response = await fetch(`${API_URL}/generate-response/?stream=sse`, {
+    method: 'POST',
+    headers: { ...defaultHeaders, Accept: 'text/event-stream' },
+    body: JSON.stringify({
+      chat_id: chatId,
+      question: questionText,
+      subjects: Array.isArray(subjects) ? subjects : [subjects]
+    }),
+  });
+
+  if (!response.ok) {
+    const error = await response.json();
+    throw new Error(error.detail || 'Failed to generate response');
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let accumulatedResponse = '';
+
+  const dispatch = (rawEvent) => {
+    let event = 'message';
+    let data = '';
+    for (const line of rawEvent.split('\n')) {
+      if (line.startsWith('event: ')) event = line.slice(7);
+      else if (line.startsWith('data: ')) data += line.slice(6);
+    }
+    const payload = data ? JSON.parse(data) : {};
+    if (event === 'delta') {
+      accumulatedResponse += payload.text;
+      handlers.onDelta?.(accumulatedResponse);
+    } else if (event === 'classification') {
+      handlers.onClassification?.(payload);
+    } else if (event === 'message') {
+      handlers.onMessage?.(payload);
+    } else if (event === 'error') {
+      handlers.onError?.(payload);
+    } else if (event === 'done') {
+      handlers.onDone?.(payload);
+    }
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+
+  return accumulatedResponse;
+};